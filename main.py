@@ -24,6 +24,10 @@ if datetime.now() >= cash_lifetime:
 
 from utils.tg_bot_core import Tg
 from utils.tools import start_scheduler, config
+from utils.db_connector import engine
+from utils.migrations import migrate
+from utils.mattress_fields import sync_mattress_fields
+from utils.label_cache import label_cache
 
 if sys.platform.startswith('win'):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -52,6 +56,10 @@ def run_bot():
     
 if __name__ == '__main__':
     #start_scheduler(17, 35)  # Запуск планировщика задач
+    migrate(engine)  # Схема БД должна быть актуальной до запуска приложений
+    sync_mattress_fields(engine)  # Пересчёт боковин, если поменялись коррекции тканей
+    # ЧБ копии этикеток готовятся в фоне, чтобы первая печать не ждала перевода
+    threading.Thread(target=label_cache.warm, name='label-cache', daemon=True).start()
     streamlit_thread = threading.Thread(target=run_streamlit_app)
     streamlit_thread.start()
 
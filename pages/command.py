@@ -3,11 +3,36 @@ import streamlit as st
 from sqlalchemy import delete
 from streamlit import session_state as state
 
+from utils.change_bus import change_notification
+from utils.db_connector import engine
+from utils.employee_roles import STATION_ROLES, employee_stations, set_employee_stations
 from utils.models import MattressRequest, Employee, EmployeeTask
 from utils.public_tunnel import get_tunnel_password
-from utils.streamlit_app_core import Page
+from utils.streamlit_app_core import Page, shift_employees
+from utils.task_events import render_task_history
+from utils.task_queries import TASK_COLUMNS, TaskFilter, read_tasks_page
 from utils.tools import barcode_link
 
+# Отбор нарядов в таблице бригадира. Ключи - TASK_STATUSES из task_queries
+TASK_STATUS_LABELS = {
+    'active': 'В работе',
+    'done': 'Завершённые',
+    'all': 'Все',
+    'components': 'Очередь заготовки',
+    'cutting': 'Очередь нарезки',
+    'gluing': 'Очередь сборки',
+    'sewing': 'Очередь шитья',
+    'packing': 'Очередь упаковки',
+}
+PAGE_SIZES = (50, 100, 200)
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def cached_tasks_page(task_filter: TaskFilter, columns: tuple, after: tuple | None, limit: int, version: tuple):
+    """Страница нарядов. version - версия журнала task_changes: пока наряды не менялись,
+    ежесекундное обновление таблицы не обращается к БД."""
+    return read_tasks_page(engine, task_filter, columns, after, limit)
+
 
 class BrigadierPage(Page):
     def __init__(self, page_name, icon):
@@ -15,14 +40,19 @@ class BrigadierPage(Page):
 
         self.TASK_STATE = 'task_dataframe'
 
-        self.SHOW_ALL_TASKS = 'MattressRequest_full_mode'
-        if self.SHOW_ALL_TASKS not in state:
-            state[self.SHOW_ALL_TASKS] = False
+        # Ключи сортировки, после которых начинается каждая из пройденных страниц. None - первая страница
+        self.PAGE_CURSORS = 'MattressRequest_page_cursors'
+        # Фильтр и размер страницы, для которых собраны PAGE_CURSORS
+        self.PAGE_QUERY = 'MattressRequest_page_query'
 
         self.REDACT_TASKS = 'MattressRequest_redact_mode'
         if self.REDACT_TASKS not in state:
             state[self.REDACT_TASKS] = False
 
+        # Таблица, показанная при входе в режим редактирования. С ней сравниваются правки при сохранении
+        self.EDIT_SNAPSHOT = 'MattressRequest_edit_snapshot'
+        self.SAVE_RESULT = 'MattressRequest_save_result'
+
     def mattress_editor(self, dataframe):
         return st.data_editor(data=dataframe,
                               column_config=self.tasks_columns_config,
@@ -32,43 +62,129 @@ class BrigadierPage(Page):
                               height=650)
 
     def mattress_viewer(self, dataframe):
-        st.dataframe(data=dataframe,
-                     column_config=self.tasks_columns_config,
-                     column_order=(column for column in self.tasks_columns_config.keys()),
-                     hide_index=False,
-                     key=self.TASK_STATE,
-                     height=650)
+        event = st.dataframe(data=dataframe,
+                             column_config=self.tasks_columns_config,
+                             column_order=(column for column in self.tasks_columns_config.keys()),
+                             hide_index=False,
+                             key=self.TASK_STATE,
+                             height=650,
+                             on_select='rerun',
+                             selection_mode='single-row')
+
+        # История собирается только для выбранного матраса, а не для всей таблицы
+        selected_rows = event.selection.rows if event else []
+        if selected_rows:
+            task_id = int(dataframe.index[selected_rows[0]])
+            with st.expander(f"История матраса №{task_id}", expanded=True):
+                st.text(render_task_history(self.session, task_id) or 'Действий пока не было')
+
+    def task_filter_form(self) -> tuple:
+        """Фильтры таблицы нарядов. Пока идёт редактирование, страница зафиксирована и фильтры недоступны.
+        :return: (TaskFilter, размер страницы)"""
+        disabled = state.get(self.REDACT_TASKS, False)
+        status_col, dates_col, article_col, organization_col, search_col, size_col = st.columns([2, 2, 1, 2, 3, 1])
+        with status_col:
+            status = st.selectbox('Наряды', options=list(TASK_STATUS_LABELS), format_func=TASK_STATUS_LABELS.get,
+                                  key='tasks_filter_status', disabled=disabled)
+        with dates_col:
+            dates = st.date_input('Срок заказа', value=(), format='DD.MM.YYYY',
+                                  key='tasks_filter_dates', disabled=disabled)
+        with article_col:
+            article = st.text_input('Артикул', key='tasks_filter_article', disabled=disabled)
+        with organization_col:
+            organization = st.text_input('Заказчик', key='tasks_filter_organization', disabled=disabled)
+        with search_col:
+            search = st.text_input('Поиск', placeholder='Размер, ткань, комментарий, адрес...',
+                                   key='tasks_filter_search', disabled=disabled)
+        with size_col:
+            page_size = st.selectbox('На странице', options=PAGE_SIZES, key='tasks_page_size', disabled=disabled)
+
+        # Пока в календаре выбрана только одна дата, она считается началом периода
+        date_from = dates[0] if len(dates) > 0 else None
+        date_to = dates[1] if len(dates) > 1 else None
+        return TaskFilter(status=status, date_from=date_from, date_to=date_to, article=article,
+                          organization=organization, search=search), page_size
+
+    def page_cursors(self, task_filter: TaskFilter, page_size: int) -> list:
+        """Пройденные страницы. При смене фильтра или размера страницы таблица начинается сначала."""
+        if state.get(self.PAGE_QUERY) != (task_filter, page_size):
+            state[self.PAGE_QUERY] = (task_filter, page_size)
+            state[self.PAGE_CURSORS] = [None]
+        return state[self.PAGE_CURSORS]
+
+    def load_tasks_page(self, task_filter: TaskFilter, page_size: int) -> tuple:
+        """Текущая страница нарядов: (DataFrame, ключи для следующей страницы, всего нарядов)"""
+        columns = tuple(column for column in [*self.tasks_columns_config, 'version'] if column in TASK_COLUMNS)
+        after = self.page_cursors(task_filter, page_size)[-1]
+        version = self.task_snapshot.version
+        if version is None:
+            df, next_after, total = read_tasks_page(engine, task_filter, columns, after, page_size)
+        else:
+            df, next_after, total = cached_tasks_page(task_filter, columns, after, page_size, version)
+        # Кэшированная таблица общая, меняем только копию
+        return self.with_photo_urls(df.copy()), next_after, total
+
+    def pagination(self, task_filter: TaskFilter, page_size: int, shown: int, next_after, total: int):
+        cursors = self.page_cursors(task_filter, page_size)
+        first = (len(cursors) - 1) * page_size
+        info_col, prev_col, next_col = st.columns([4, 1, 1])
+        with info_col:
+            st.caption(f"Наряды {first + 1 if shown else 0}–{first + shown} из {total}")
+        with prev_col:
+            if st.button('← Назад', key='tasks_page_prev', disabled=len(cursors) == 1, use_container_width=True):
+                cursors.pop()
+                st.rerun(scope='fragment')
+        with next_col:
+            if st.button('Вперёд →', key='tasks_page_next', disabled=next_after is None, use_container_width=True):
+                cursors.append(next_after)
+                st.rerun(scope='fragment')
+
+    def save_result_notice(self):
+        """Итог последнего сохранения. Фрагмент перерисовывается каждую секунду, поэтому
+        сообщение держится в session_state, пока бригадир его не закроет."""
+        save_result = state.get(self.SAVE_RESULT)
+        if not save_result or not (save_result.rejected or save_result.merged):
+            return
+        if save_result.rejected:
+            rejected = '  \n'.join(
+                f"№{task_id}: " + ', '.join(self.column_label(column) for column in save_result.clashes.get(task_id, []))
+                for task_id in save_result.rejected)
+            st.warning("Не сохранены правки матрасов, у которых эти же ячейки успели изменить на других "
+                       f"экранах. Проверьте значения и поправьте ещё раз:  \n{rejected}", icon="⚠️")
+        if save_result.merged:
+            st.info(f"Матрасы {', '.join(map(str, save_result.merged))} менялись на других экранах, "
+                    f"правки совмещены.", icon="🔀")
+        if st.button('Понятно', key='save_result_dismiss'):
+            state.pop(self.SAVE_RESULT, None)
+            st.rerun(scope='fragment')
+
+    def column_label(self, column: str) -> str:
+        config = self.tasks_columns_config.get(column)
+        if isinstance(config, str):
+            return config
+        return (config or {}).get('label') or column
 
     @st.fragment(run_every=1)
-    def all_tasks(self):
-        half_col_1, half_col_2 = st.columns([1, 1])
-        with half_col_1:
-            if state.get(self.REDACT_TASKS, False):
-                st.error('##### Режим редактирования. Изменения других не сохраняются.', icon="🚧")
-            else:
-                st.info('##### Режим просмотра. Для изменения нажмите кнопку редактирования внизу.', icon="🔎")
-
-        with half_col_2:
-            full_mode_checkbox = st.checkbox('### Показывать завершённые наряды', key=f"{self.SHOW_ALL_TASKS}_checkbox")
-            state[self.SHOW_ALL_TASKS] = True if full_mode_checkbox else False
-
-        df = self.get_sorted_tasks()
-
-        if not state[self.SHOW_ALL_TASKS]:
-            conditions = {
-                'components_is_done': False,
-                'fabric_is_done': False,
-                'gluing_is_done': False,
-                'sewing_is_done': False,
-                'packing_is_done': False
-            }
-            df = self.filter_incomplete_tasks(df, conditions)
+    def all_tasks(self, task_filter: TaskFilter, page_size: int):
+        if state.get(self.REDACT_TASKS, False):
+            st.error('##### Режим редактирования. Если ячейку успели изменить на другом экране, '
+                     'при сохранении останется чужое значение, а ваша правка будет отклонена.', icon="🚧")
+        else:
+            st.info('##### Режим просмотра. Для изменения нажмите кнопку редактирования внизу.', icon="🔎")
+
+        self.save_result_notice()
 
         if state.get(self.REDACT_TASKS, False):
-            edited_df = self.mattress_editor(df)
+            # Редактируется только показанная страница. Пока идёт редактирование, она не обновляется,
+            # чтобы правки не сбивались, а при сохранении сравнивается только с ней
+            if state.get(self.EDIT_SNAPSHOT) is None:
+                state[self.EDIT_SNAPSHOT] = self.load_tasks_page(task_filter, page_size)[0]
+            edited_df = self.mattress_editor(state[self.EDIT_SNAPSHOT])
             self.edit_mode_button(MattressRequest, edited_df)
         else:
+            df, next_after, total = self.load_tasks_page(task_filter, page_size)
             self.mattress_viewer(df)
+            self.pagination(task_filter, page_size, len(df), next_after, total)
             self.edit_mode_button(MattressRequest)
 
     def edit_mode_button(self, model, edited_dataframe=None):
@@ -82,8 +198,9 @@ class BrigadierPage(Page):
             return
 
         if state.get(redact_mode, False) and edited_dataframe is not None:
-            self.save_mattress_df_to_db(edited_dataframe, model)
+            state[self.SAVE_RESULT] = self.save_mattress_df_to_db(edited_dataframe, state[self.EDIT_SNAPSHOT])
         state[redact_mode] = not state[redact_mode]
+        state.pop(self.EDIT_SNAPSHOT, None)
 
         # Очистить данные, если таблица скрывается
         task_state = self.TASK_STATE
@@ -97,10 +214,11 @@ class BrigadierPage(Page):
         # Подготавливаем данные для отображения
         data = []
         for employee in employees:
+            stations = employee_stations(employee)
             row = {'id': employee.id,
                    'is_on_shift': employee.is_on_shift,
                    'name': employee.name,
-                   'position': employee.position,
+                   **{f'role_{station}': station in stations for station in STATION_ROLES},
                    'barcode': barcode_link(employee.id),
                    'Удалить': False}  # Инициализируем флаг удаления как False
             data.append(row)
@@ -113,7 +231,7 @@ class BrigadierPage(Page):
 
     def employees_editor(self):
         # Получаем сотрудников из базы данных
-        employees = self.session.query(Employee).all()
+        employees = self.session.query(Employee).order_by(Employee.id).all()
 
         df = self.get_df_from_employees(employees)
 
@@ -121,7 +239,8 @@ class BrigadierPage(Page):
         edited_df = st.data_editor(
             data=df,
             column_config=self.employee_columns_config,
-            column_order=['is_on_shift', 'name', 'position', 'Удалить', 'barcode'],
+            column_order=['is_on_shift', 'name', *(f'role_{station}' for station in STATION_ROLES),
+                          'Удалить', 'barcode'],
             hide_index=True,
             num_rows='fixed',
             key='employee_editor'
@@ -145,31 +264,37 @@ class BrigadierPage(Page):
                     # Обновляем данные сотрудника
                     employee.is_on_shift = row['is_on_shift']
                     employee.name = row['name']
-                    employee.position = row['position']
+                    set_employee_stations(employee, [station for station in STATION_ROLES
+                                                     if row[f'role_{station}']])
 
         self.session.commit()
+        # Терминалы рабочих мест сразу увидят новый состав смены
+        shift_employees.clear()
         st.rerun()
 
     def add_employee(self):
         with st.form(key='add_employee'):
             name = st.text_input("Имя")
-            position = st.text_input("Роли", placeholder="Перечислите через запятую")
+            stations = st.multiselect("Роли", options=list(STATION_ROLES), format_func=STATION_ROLES.get)
 
             if st.form_submit_button("Внести"):
-                if not name or not position:
+                if not name or not stations:
                     st.error("Пожалуйста, заполните оба поля.")
                 else:
                     new_employee = Employee(is_on_shift=False,
                                             name=name,
-                                            position=position,
+                                            position='',
                                             barcode=None)
+                    set_employee_stations(new_employee, stations)
                     self.session.add(new_employee)
                     self.session.commit()
+                    shift_employees.clear()
                     st.rerun()
 
     def reset_task_reservation_button(self):
         if st.button('Сбросить бронирование задач'):
             self.session.query(EmployeeTask).delete()
+            self.session.execute(change_notification({'type': 'reservations_reset'}))
             self.session.commit()
             st.toast('Бронирование сброшено')
 
@@ -183,24 +308,23 @@ with tasks_tab:
         st.title("🏭 Все наряды")
     with col2:
         st.info('''На этом экране показываются данные о нарядах в режиме реального времени. Чтобы поправить любой
-        наряд, включите режим редактирования. Он обладает высшим приоритетом - пока активен режим редактирования,
-        изменения других рабочих не сохраняются. **Не забывайте сохранять таблицу!**''', icon="ℹ️")
+        наряд, включите режим редактирования. При сохранении записываются только изменённые ячейки. Если ту же
+        ячейку успели поменять на другом экране, сохранится чужое значение, а ваша правка будет отклонена
+        с предупреждением. **Не забывайте сохранять таблицу!**''', icon="ℹ️")
 
-    Page.all_tasks()
+    Page.all_tasks(*Page.task_filter_form())
 
 with employee_tab:
     col1, col2 = st.columns([1, 2])
     with col1:
         st.title("👷 Сотрудники")
     with col2:
-        # Должность аналогична свойству page_name на файлах страниц
+        # Роли - рабочие места из STATION_ROLES, названия совпадают с page_name страниц
         st.info('Выставляйте рабочих на смену. Они будут активны при выборе ответственного на нужном экране.  \n'
-                'В поле "Роли" пропишите рабочее место сотруднику. Можно вписать несколько.', icon="ℹ️")
+                'Отметьте рабочие места, на которых сотрудник может работать. Можно несколько.', icon="ℹ️")
         if st.button("Показать пароль туннеля"):
             st.toast(get_tunnel_password())
 
-    st.warning('##### Доступно: заготовка, сборка, нарезка, шитьё, упаковка')
-
     sub_col_1, sub_col_2, sub_col_3 = st.columns([3, 1, 2])
     with sub_col_1:
         Page.employees_editor()
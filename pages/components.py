@@ -1,7 +1,7 @@
 import streamlit as st
 
 from utils.streamlit_app_core import ManufacturePage
-from utils.tools import fabric_type
+from utils.task_queries import STATION_QUEUES
 
 
 class ComponentsPage(ManufacturePage):
@@ -27,26 +27,21 @@ class ComponentsPage(ManufacturePage):
             st.warning("Сначала отметьте сотрудника.")
             return
 
-        all_tasks = self.get_sorted_tasks()
-        if all_tasks is None or all_tasks.empty:
+        # Таблица пересчитывается только при изменении нарядов, общая для всех терминалов заготовки
+        tasks = self.task_snapshot.get('components_tasks', self.components_tasks)
+        if tasks.empty:
             st.info("Заявки закончились.")
             return
 
-        tasks = self.filter_incomplete_tasks(all_tasks, {'components_is_done': False})
-
-        # Создаем копию, чтобы избежать цепных изменений одной и той же таблицы
-        tasks = tasks.copy()
-        # Формируем колонки с информацией о типе тканей, вычисляеммой динамически. Её не требуется сохранять
-        tasks.loc[:, 'base_fabric_type'] = tasks['base_fabric'].apply(fabric_type)
-        tasks.loc[:, 'side_fabric_type'] = tasks['side_fabric'].apply(fabric_type)
-
-        # Формируем порядок показа полей от словаря конфигурации
-        columns_order = list(self.components_columns_config)
-        return st.data_editor(tasks[columns_order],
+        return st.data_editor(tasks,
                               column_config=self.components_columns_config,
                               hide_index=False,
                               height=750)
 
+    def components_tasks(self):
+        # Типы тканей посчитаны при записи заявки и хранятся в БД вместе с ней
+        return self.load_station_tasks(STATION_QUEUES['components'], self.components_columns_config)
+
     def components_table(self):
         submit = st.button(label='Подтвердить')
 
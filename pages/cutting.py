@@ -1,7 +1,8 @@
 import streamlit as st
 
 from utils.streamlit_app_core import ManufacturePage
-from utils.tools import config, side_eval
+from utils.task_queries import STATION_QUEUES
+from utils.tools import config
 
 
 class CuttingPage(ManufacturePage):
@@ -14,7 +15,7 @@ class CuttingPage(ManufacturePage):
             'base_fabric': st.column_config.TextColumn("Ткань (Верх / Низ)", disabled=True),
             'side_fabric': st.column_config.TextColumn("Ткань (Бочина)", disabled=True),
             'size': st.column_config.TextColumn("Размер", disabled=True),
-            'side': st.column_config.TextColumn("Бочина", disabled=True),
+            'side_length': st.column_config.NumberColumn("Бочина", disabled=True),
             'comment': st.column_config.TextColumn("Комментарий", disabled=True),
             'photo': st.column_config.ImageColumn("Фото")
         }
@@ -28,25 +29,21 @@ class CuttingPage(ManufacturePage):
             st.warning("Сначала отметьте сотрудника.")
             return
 
-        all_tasks = self.get_sorted_tasks()
-        if all_tasks is None or all_tasks.empty:
+        # Таблица пересчитывается только при изменении нарядов, общая для всех терминалов нарезки
+        tasks = self.task_snapshot.get('cutting_tasks', self.cutting_tasks)
+        if tasks.empty:
             st.info("Заявки закончились.")
             return
 
-        tasks = self.filter_incomplete_tasks(all_tasks, {'fabric_is_done': False})
-
-        # Создаем копию, чтобы избежать цепных изменений одной и той же таблицы
-        tasks = tasks.copy()
-        # Формируем колонку с информацией о длине бочины, вычисляеммой динамически. Её не требуется сохранять
-        tasks.loc[:, 'side'] = tasks['size'].apply(side_eval, args=(str(tasks['side_fabric']),))
-
-        # Формируем порядок показа полей от словаря конфигурации
-        columns_order = list(self.cutting_columns_config)
-        return st.data_editor(tasks[columns_order],
+        return st.data_editor(tasks,
                               column_config=self.cutting_columns_config,
                               hide_index=False,
                               height=750)
 
+    def cutting_tasks(self):
+        # Длина бочины посчитана при записи заявки и хранится в БД вместе с ней
+        return self.load_station_tasks(STATION_QUEUES['cutting'], self.cutting_columns_config)
+
     def cutting_table(self):
         submit = st.button(label='Подтвердить')
 
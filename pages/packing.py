@@ -1,13 +1,11 @@
 import logging
-import os
-import time
-
-from openpyxl.reader.excel import load_workbook
-from win32ctypes.pywin32 import pywintypes  # из пакета pyinstaller
 
 from utils.streamlit_app_core import ManufacturePage
+from utils.task_queries import STATION_QUEUES
 from utils.models import MattressRequest
-from utils.tools import config, print_file, get_date_str
+from utils.label_cache import label_cache
+from utils.order_printing import Talon, render_talons, render_labels
+from utils.tools import config, get_date_str
 import streamlit as st
 
 
@@ -22,56 +20,64 @@ def form_box_text(task):
             (f"**Комментарий**: {task.comment}  " if task.comment else '') + "]")
 
 
+def task_talon(order, task) -> Talon:
+    """Данные талона. В задание печати передаются только значения, без строк DataFrame."""
+    return Talon(article=task.article,
+                 springs=task.springs,
+                 size=task.size,
+                 deadline=order.deadline.strftime('%d.%m.%Y'),
+                 address=f"{order.address}")
+
+
 class PackingPage(ManufacturePage):
     def __init__(self, name, icon):
         super().__init__(name, icon)
         self.default_printer_name = config.get('site').get('hardware').get('default_printer')
         self.label_printer_name = config.get('site').get('hardware').get('label_printer')
+        # Колонки, нужные плиткам упаковки и талону
+        self.packing_columns = ['order_id', 'high_priority', 'article', 'size', 'base_fabric', 'side_fabric',
+                                'springs', 'comment', 'photo', 'deadline', 'organization', 'contact',
+                                'delivery_type', 'region', 'address', 'order_created']
 
     def talon_button(self, order, task):
         if st.button(label=f":blue[**Талон**]", key=f"print_talon_button_{task.id}"):
-            template_path = 'static/guarantee.xlsx'
-            wb = load_workbook(template_path)
-            ws = wb.active
-
-            # Заполнение шаблона
-            ws['B4'] = "Матрас АРТ.№ " + task.article + '  |  ПБ: ' + task.springs
-            ws['B6'] = task.size
-            ws['B8'] = order.deadline.strftime('%d.%m.%Y')
-            ws['B16'] = f"{order.address}"
-
-            document_path = fr'cash\{self.page_name}_talon_{order.id}.xlsx'
-            wb.save(document_path)
-            try:
-                print_file(document_path, self.default_printer_name)
-                st.toast("Печать талона...", icon='🖨️')
-                time.sleep(1)
-            except pywintypes.error as e:
-                st.toast(f"Ошибка печати: {e}")
-            try:
-                os.remove(document_path)
-            except Exception:
-                time.sleep(0.5)
-                os.remove(document_path)
+            # Шаблон заполняется и печатается в очереди печати
+            talon = task_talon(order, task)
+            file_name = f"talon_{order.order_id}_{task.id}.xlsx"
+            self.submit_print(f"Талон {task.article}", self.default_printer_name,
+                              lambda work_dir: render_talons(work_dir, [talon], file_name))
 
     def label_button(self, task):
 
         if st.button(label=f":orange[**Этикетка**]", key=f"print_label_button_{task.id}"):
-            try:
-                label_pdf_path = fr"static\labels\{task.article}.pdf"
-                printer = self.label_printer_name
+            article = task.article
+            if not label_cache.source_path(article).exists():
+                st.toast("Ошибка печати. Шаблон для этикетки не найден.", icon='❗')
+                return
 
-                print_file(label_pdf_path, printer)
+            # Готовая ЧБ копия из кэша, переводится только при первой печати новой этикетки
+            self.submit_print(f"Этикетка {article}", self.label_printer_name,
+                              lambda work_dir: label_cache.get(article))
 
-                st.toast("Печать этикетки...", icon='🖨️')
+    def order_print_button(self, order_id, order, tasks):
+        """Все талоны и этикетки заказа: по одному заданию на принтер талонов и на принтер этикеток"""
+        if not st.button(f":violet[**Печать всего заказа ({len(tasks)} шт.)**]", key=f"print_order_button_{order_id}"):
+            return
 
-            except FileNotFoundError:
-                st.toast("Ошибка печати. Шаблон для этикетки не найден.", icon='❗')
+        talons = [task_talon(order, task) for task in tasks.itertuples()]
+        self.submit_print(f"Талоны заказа №{order_id}", self.default_printer_name,
+                          lambda work_dir: render_talons(work_dir, talons, f"talons_{order_id}.xlsx"))
 
-            except Exception as e:
-                st.toast(f"Ошибка печати: {e}")
+        articles = [task.article for task in tasks.itertuples()]
+        missing = sorted({article for article in articles if not label_cache.source_path(article).exists()})
+        if missing:
+            st.toast(f"Нет этикеток для артикулов: {', '.join(missing)}", icon='❗')
+        articles = [article for article in articles if article not in missing]
+        if articles:
+            self.submit_print(f"Этикетки заказа №{order_id}", self.label_printer_name,
+                              lambda work_dir: render_labels(work_dir, articles, f"labels_{order_id}.pdf"))
 
-    def tasks_tiles(self, order, num_columns: int = 3):
+    def tasks_tiles(self, order, tasks, num_columns: int = 3):
         """Принимает отфильтрованные данные. Выводит заявки в виде плиточек на страницу.
         Отфильтрованные данные выводятся, а потом, при нажатии "Готово" на заявке, по
     индексу изменения соотносятся с главным хранилищем и записываются"""
@@ -79,14 +85,7 @@ class PackingPage(ManufacturePage):
 
         count = 0
 
-        for task in order.mattress_requests:
-
-            if (not task.components_is_done or
-                not task.fabric_is_done or
-                not task.gluing_is_done or
-                not task.sewing_is_done or
-                    task.packing_is_done):
-                continue
+        for task in tasks.itertuples():
 
             if count % num_columns == 0:
                 row_container = st.columns(num_columns)
@@ -107,12 +106,12 @@ class PackingPage(ManufacturePage):
 
                 with button_row_1:
                     if st.button(f":green[**{self.done_button_text}**]", key=f'button_packing_done_{task.id}'):
-                        history_note = f'{self.pages_history_note()} \n'
                         db_task = self.session.get(MattressRequest, task.id)
 
                         if db_task:
                             db_task.packing_is_done = True
-                            db_task.history += history_note
+                            self.record_done_events([db_task.id])
+                            self.notify_tasks_updated([db_task.id])
                             self.update_db(db_task)
                         else:
                             logging.error(f"Task with id {task.id} not found in the database")
@@ -129,26 +128,22 @@ class PackingPage(ManufacturePage):
     @st.fragment(run_every=3)
     def tiles_rows(self):
 
+        # Результаты печати приходят из очереди, сообщаем о них при очередной перерисовке
+        self.show_print_status()
+
         employee = st.session_state.get(self.page_name)
         if not employee:
             st.warning("Сначала отметьте сотрудника.")
             return
 
-        orders = self.get_orders_with_mattress_requests()
-        if not orders:
+        # Матрасы, готовые к упаковке, берутся из общего снимка нарядов
+        tasks = self.task_snapshot.get('packing_tasks', self.packing_tasks)
+        if tasks.empty:
             st.info("Пока нечего упаковывать.")
             return
 
-        for order in orders:
-            # Проверяем, есть ли активные заявки на матрасы
-            has_active_requests = any((request.components_is_done and
-                                       request.fabric_is_done and
-                                       request.gluing_is_done and
-                                       request.sewing_is_done and
-                                       not request.packing_is_done) for request in order.mattress_requests)
-
-            if not has_active_requests:
-                continue
+        for order_id, order_tasks in tasks.groupby('order_id', sort=False):
+            order = order_tasks.iloc[0]
 
             contact = order.organization or order.contact or 'Клиент'
             delivery_type = order.delivery_type or 'Самовывоз'
@@ -156,8 +151,15 @@ class PackingPage(ManufacturePage):
             address = order.address or 'Цех'
 
             st.markdown(f"#### {region} {delivery_type}, {contact}, {address}")
-            with st.expander(f"№{order.id}: {get_date_str(order.created)}", expanded=True):
-                self.tasks_tiles(order, 4)
+            with st.expander(f"№{order_id}: {get_date_str(order.order_created)}", expanded=True):
+                self.order_print_button(order_id, order, order_tasks)
+                self.tasks_tiles(order, order_tasks, 4)
+
+    def packing_tasks(self):
+        """Матрасы, прошедшие все этапы кроме упаковки. Заказы идут от новых к старым, как раньше."""
+        return self.load_station_tasks(STATION_QUEUES['packing'],
+                                       self.packing_columns,
+                                       order_by=[MattressRequest.order_id.desc(), MattressRequest.id]).reset_index()
 
 
 Page = PackingPage("Упаковка", "📦")
@@ -32,26 +32,44 @@ $(document).ready(function() {
         });
     }
 
-    // Загрузка данных из указанного URL
-    function loadOptions(url, callback) {
-        $.getJSON(url, function(data) {
-            var options = data['data'].map(function(item) {
-                return '<option value="' + item + '">' + item + '</option>';
-            }).join('');
-            callback(options);
-        });
+    // Списки тканей и пружинных блоков загружаются одним запросом и переиспользуются для всех строк заявки.
+    // Сервер отдаёт их с ETag, поэтому при повторном открытии формы браузер получает 304
+    let catalogRequest = null;
+    function loadCatalog() {
+        if (!catalogRequest) {
+            catalogRequest = $.getJSON('/api/catalog').then(function(data) {
+                var catalog = data['data'];
+                catalog.fabricOptions = buildOptions(catalog.fabrics);
+                catalog.springOptions = buildOptions(catalog.springs);
+                return catalog;
+            }, function(error) {
+                // При ошибке пробуем загрузить каталог заново при следующем обращении
+                catalogRequest = null;
+                console.error('Ошибка загрузки каталога', error);
+            });
+        }
+        return catalogRequest;
+    }
+
+    // HTML-список вариантов для select
+    function buildOptions(items) {
+        return items.map(function(item) {
+            return '<option value="' + item + '">' + item + '</option>';
+        }).join('');
     }
 
-    // Функция инициализации автозаполнения
-    function initializeAutocomplete(selector, url, addFunction) {
+    // Функция инициализации автозаполнения. Поиск идёт на сервере, с учётом опечаток.
+    // category - категория /api/search: mattress или addition
+    function initializeAutocomplete(selector, category, addFunction) {
         $(selector).autocomplete({
             source: function (request, response) {
-                $.getJSON(url, function (data) {
-                    console.log('Данные загружены:', data);
-                    var results = $.ui.autocomplete.filter(data['data'], request.term);
-                    response(results.slice(0, 30));
+                $.getJSON('/api/search', {q: request.term, category: category, limit: 30}, function (data) {
+                    response(data['data']);
+                }).fail(function () {
+                    response([]);
                 });
             },
+            delay: 150,
             minLength: 0,
             select: function (event, ui) {
                 console.log('Выбрана позиция:', ui.item.value);
@@ -74,39 +92,39 @@ $(document).ready(function() {
     let mattressIndex = 0;
     // Функция добавления матраса
     function addMattress(mattress, quantity) {
-        loadOptions('/api/fabrics', function(fabricOptions) {
-            loadOptions('/api/springs', function(springOptions) {
-                mattressIndex++; // Увеличиваем индекс при добавлении новой позиции
-                var row = '<div class="grid-item" data-type="mattress" data-name="' + mattress + '">' +
-                          '<text class="position-label ">' + mattress + '</text>' +
-                          '<button type="button" class="btn btn-danger btn-sm remove-item">Удалить</button>' +
-                          '<div class="form-row">' +
-                          '<div class="col">' +
-                          '<label for="quantity_mattress_' + mattressIndex + '">Количество</label>' +
-                          '<input type="number" value="1" id="quantity_mattress_' + mattressIndex + '" name="quantity_mattress[' + mattressIndex + ']" class="form-control">' +
-                          '</div>' +
-                          '<div class="col">' +
-                          '<label for="price_mattress_' + mattressIndex + '">Цена</label>' +
-                          '<input type="number" id="price_mattress_' + mattressIndex + '" name="price_mattress[' + mattressIndex + ']" class="form-control">' +
-                          '</div>' +
-                          '<div class="col">' +
-                          '<label for="size_mattress_' + mattressIndex + '">Размер</label>' +
-                          '<input type="text" id="size_mattress_' + mattressIndex + '" name="size_mattress[' + mattressIndex + ']" class="form-control">' +
-                          '</div>' +
-                          '</div>' +
-                          '<label for="top_fabric_mattress_' + mattressIndex + '" class="mattress-option-label">Ткань - топ</label>' +
-                          '<select id="top_fabric_mattress_' + mattressIndex + '" name="top_fabric_mattress[' + mattressIndex + ']" class="form-control">' + fabricOptions + '</select>' +
-                          '<label for="side_fabric_mattress_' + mattressIndex + '" class="mattress-option-label">Ткань - бок</label>' +
-                          '<select id="side_fabric_mattress_' + mattressIndex + '" name="side_fabric_mattress[' + mattressIndex + ']" class="form-control">' + fabricOptions + '</select>' +
-                          '<label for="spring_block_mattress_' + mattressIndex + '" class="mattress-option-label">Пружинный блок</label>' +
-                          '<select id="spring_block_mattress_' + mattressIndex + '" name="spring_block_mattress[' + mattressIndex + ']" class="form-control">' + springOptions + '</select>' +
-                          '<label for="photo_mattress_' + mattressIndex + '" class="mattress-option-label">Фото</label>' +
-                          '<input type="file" id="photo_mattress_' + mattressIndex + '" name="photo_mattress[' + mattressIndex + ']" class="form-control file-field">' +
-                          '<input type="text" id="comment_mattress_' + mattressIndex + '" name="comment_mattress[' + mattressIndex + ']" placeholder="Комментарий" class="form-control">' +
-                          '</div>';
-                $('#mattressTable').append(row);
-                checkFormValidity();
-            });
+        loadCatalog().then(function(catalog) {
+            var fabricOptions = catalog.fabricOptions;
+            var springOptions = catalog.springOptions;
+            mattressIndex++; // Увеличиваем индекс при добавлении новой позиции
+            var row = '<div class="grid-item" data-type="mattress" data-name="' + mattress + '">' +
+                      '<text class="position-label ">' + mattress + '</text>' +
+                      '<button type="button" class="btn btn-danger btn-sm remove-item">Удалить</button>' +
+                      '<div class="form-row">' +
+                      '<div class="col">' +
+                      '<label for="quantity_mattress_' + mattressIndex + '">Количество</label>' +
+                      '<input type="number" value="1" id="quantity_mattress_' + mattressIndex + '" name="quantity_mattress[' + mattressIndex + ']" class="form-control">' +
+                      '</div>' +
+                      '<div class="col">' +
+                      '<label for="price_mattress_' + mattressIndex + '">Цена</label>' +
+                      '<input type="number" id="price_mattress_' + mattressIndex + '" name="price_mattress[' + mattressIndex + ']" class="form-control">' +
+                      '</div>' +
+                      '<div class="col">' +
+                      '<label for="size_mattress_' + mattressIndex + '">Размер</label>' +
+                      '<input type="text" id="size_mattress_' + mattressIndex + '" name="size_mattress[' + mattressIndex + ']" class="form-control">' +
+                      '</div>' +
+                      '</div>' +
+                      '<label for="top_fabric_mattress_' + mattressIndex + '" class="mattress-option-label">Ткань - топ</label>' +
+                      '<select id="top_fabric_mattress_' + mattressIndex + '" name="top_fabric_mattress[' + mattressIndex + ']" class="form-control">' + fabricOptions + '</select>' +
+                      '<label for="side_fabric_mattress_' + mattressIndex + '" class="mattress-option-label">Ткань - бок</label>' +
+                      '<select id="side_fabric_mattress_' + mattressIndex + '" name="side_fabric_mattress[' + mattressIndex + ']" class="form-control">' + fabricOptions + '</select>' +
+                      '<label for="spring_block_mattress_' + mattressIndex + '" class="mattress-option-label">Пружинный блок</label>' +
+                      '<select id="spring_block_mattress_' + mattressIndex + '" name="spring_block_mattress[' + mattressIndex + ']" class="form-control">' + springOptions + '</select>' +
+                      '<label for="photo_mattress_' + mattressIndex + '" class="mattress-option-label">Фото</label>' +
+                      '<input type="file" id="photo_mattress_' + mattressIndex + '" name="photo_mattress[' + mattressIndex + ']" class="form-control file-field">' +
+                      '<input type="text" id="comment_mattress_' + mattressIndex + '" name="comment_mattress[' + mattressIndex + ']" placeholder="Комментарий" class="form-control">' +
+                      '</div>';
+            $('#mattressTable').append(row);
+            checkFormValidity();
         });
     }
 
@@ -246,7 +264,9 @@ $(document).ready(function() {
             // Одна ошибка и ты ошибся... Активируем кнопку снова при ошибке
             error: function (error) {
                 console.error('Ошибка отправки формы', error);
-                alert("Ошибка при отправке формы.");
+                // Сервер объясняет, что не так: каталог ещё загружается или товара нет в каталоге
+                let detail = error.responseJSON && error.responseJSON.detail;
+                alert(detail || "Ошибка при отправке формы.");
                 submitBtn.prop('disabled', false).text('Создать реализацию');
             }
         });
@@ -255,8 +275,10 @@ $(document).ready(function() {
     // --------------------------- ИНИЦИАЦИЯ ---------------------------
 
     // Инициализация автозаполнения для матрасов и допов
-    initializeAutocomplete('#mattressArticle', '/api/mattresses', addMattress);
-    initializeAutocomplete('#additionalArticle', '/api/additions', addAdditional);
+    initializeAutocomplete('#mattressArticle', 'mattress', addMattress);
+    initializeAutocomplete('#additionalArticle', 'addition', addAdditional);
+    // Списки начинают грузиться сразу, пока менеджер заполняет шапку заявки
+    loadCatalog();
     // Установка сегодняшней даты в поле
     $('#delivery_date').val(formatDate(new Date()));
 
@@ -1,6 +1,7 @@
 document.addEventListener('DOMContentLoaded', function () {
     let capturing = false;
     let currentEmployeeSequence = '';
+    let currentTaskId = null;  // id матраса, который сейчас показан на экране
 
     document.addEventListener('keydown', function (event) {
         // Игнорируем нажатия клавиш-модификаторов
@@ -48,6 +49,7 @@ document.addEventListener('DOMContentLoaded', function () {
                     if (data.task_data.error) {
                         document.getElementById('task_data').innerText = data.task_data.error;
                     } else {
+                        currentTaskId = data.task_id;
                         displayTaskData(data.task_data);
                         document.getElementById('buttons').style.display = 'block';
                         document.getElementById('complete_button').dataset.employeeSequence = currentEmployeeSequence;
@@ -95,11 +97,54 @@ document.addEventListener('DOMContentLoaded', function () {
     });
 
     function resetPage() {
+        currentTaskId = null;
         document.getElementById('message').innerText = '';
         document.getElementById('task_data').innerHTML = 'Жду штрих-код...';
         document.getElementById('buttons').style.display = 'none';
     }
 
+    // Подписка на изменения нарядов. Сервер сообщает, если бригадир сбросил бронь,
+    // поменял наряд или в очереди появились задачи. EventSource сам переподключается при обрыве
+    function subscribeToChanges() {
+        const events = new EventSource('/events/sewing');
+
+        // После переподключения EventSource события, пришедшие за время обрыва, потеряны
+        events.onopen = function () {
+            refreshCurrentTask();
+        };
+
+        events.onmessage = function (message) {
+            const event = JSON.parse(message.data);
+            console.log('Изменение нарядов:', event);
+
+            if (event.type === 'resync') {
+                // Часть событий могла потеряться, поэтому наряд на экране перечитывается целиком
+                refreshCurrentTask();
+                return;
+            }
+
+            if (currentTaskId !== null) {
+                if (event.type === 'reservations_reset') {
+                    resetPage();
+                    document.getElementById('task_data').innerText = 'Бригадир сбросил бронирование.\n\nЖду штрих-код...';
+                } else if (event.type === 'tasks_updated' && event.task_ids.includes(currentTaskId)) {
+                    // Наряд на экране изменили, перечитываем его. Бронь за сотрудником сохраняется
+                    processSequence(currentEmployeeSequence);
+                }
+            }
+
+            document.getElementById('queue_status').innerText = `Очередь обновлена в ${new Date().toLocaleTimeString()}`;
+        };
+    }
+
+    // Перечитывает наряд, показанный на экране. Бронь за сотрудником сохраняется, а если её
+    // сбросили, сервер выдаст сотруднику следующую задачу, как при повторном сканировании
+    function refreshCurrentTask() {
+        if (currentTaskId !== null) {
+            processSequence(currentEmployeeSequence);
+        }
+    }
+
     function displayTaskData(taskData) {
         var taskContainer = document.getElementById('task_data');
         taskContainer.innerHTML = ''; // Очищаем контейнер перед заполнением
@@ -126,4 +171,6 @@ document.addEventListener('DOMContentLoaded', function () {
             taskContainer.appendChild(imgElement);
         }
     }
+
+    subscribeToChanges();
 });
@@ -0,0 +1,110 @@
+import sys
+from dataclasses import dataclass
+from types import MappingProxyType
+
+# Категории позиций каталога. Допники (additions) - все позиции, кроме матрасов
+MATTRESS = 'mattress'
+FABRIC = 'fabric'
+SPRINGS = 'springs'
+OTHER = 'other'
+
+# Пустая позиция в списке пружинных блоков
+NO_SPRINGS = 'Нет'
+
+
+def intern(value) -> str:
+    """Строки каталога часто повторяются (артикулы, размеры, составы), поэтому хранятся в одном экземпляре."""
+    return sys.intern(str(value)) if value is not None else ''
+
+
+@dataclass(frozen=True, slots=True)
+class CatalogItem:
+    """Позиция номенклатуры СБИС. Хранит только поля, которые нужны заявкам и реализации."""
+    name: str
+    code: str  # nomNumber, код товара в СБИС
+    article: str
+    price: float
+    category: str
+    size: str = ''
+    structure: str = ''  # Состав начинки матраса
+
+    @classmethod
+    def create(cls, name, code, article, price, category, size='', structure=''):
+        return cls(intern(name), intern(code), intern(article), price or 0, category,
+                   intern(size), intern(structure))
+
+    @property
+    def is_mattress(self) -> bool:
+        return self.category == MATTRESS
+
+    def to_record(self) -> dict:
+        return {'code': self.code, 'article': self.article, 'price': self.price, 'category': self.category,
+                'size': self.size, 'structure': self.structure}
+
+    @classmethod
+    def from_record(cls, name: str, record: dict):
+        """Позиция из снимка на диске. Понимает и старый формат с флагами is_mattress/is_fabric/is_springs."""
+        category = record.get('category')
+        if category is None:
+            category = (MATTRESS if record.get('is_mattress') else
+                        FABRIC if record.get('is_fabric') else
+                        SPRINGS if record.get('is_springs') else OTHER)
+        return cls.create(name, record.get('code', ''), record.get('article', 'Неизвестен'), record.get('price', 0),
+                          category, record.get('size', ''), record.get('structure', ''))
+
+
+class Catalog:
+    """Неизменяемый каталог номенклатуры. Все списки и индексы строятся один раз при создании,
+    обработчики запросов только читают готовые структуры. Для обновления собирается новый
+    каталог, и ссылка на него подменяется целиком, поэтому запрос никогда не увидит
+    наполовину обновлённые данные."""
+
+    __slots__ = ('by_name', 'by_code', 'by_article', 'names', 'mattresses', 'fabrics', 'springs', 'additions')
+
+    def __init__(self, items=()):
+        by_name = {item.name: item for item in items}
+        by_code, by_article = {}, {}
+        for item in by_name.values():
+            by_code.setdefault(item.code, item)
+            by_article.setdefault(item.article, []).append(item)
+
+        self.by_name = MappingProxyType(by_name)
+        self.by_code = MappingProxyType(by_code)
+        self.by_article = MappingProxyType({article: tuple(items) for article, items in by_article.items()})
+
+        self.names = tuple(by_name)
+        self.mattresses = tuple(name for name, item in by_name.items() if item.category == MATTRESS)
+        self.additions = tuple(name for name, item in by_name.items() if item.category != MATTRESS)
+        # Ткани показываются в обратном алфавитном порядке, как раньше в /api/fabrics
+        self.fabrics = tuple(sorted((name for name, item in by_name.items() if item.category == FABRIC),
+                                    reverse=True))
+        self.springs = (*(name for name, item in by_name.items() if item.category == SPRINGS), NO_SPRINGS)
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __getitem__(self, name) -> CatalogItem:
+        return self.by_name[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def get(self, name, default=None):
+        return self.by_name.get(name, default)
+
+    def merge(self, changes: 'Catalog') -> 'Catalog':
+        """Новый каталог, в котором позиции из changes заменили или дополнили текущие."""
+        merged = dict(self.by_name)
+        merged.update(changes.by_name)
+        return Catalog(merged.values())
+
+    def to_records(self) -> dict:
+        """Компактное представление для снимка на диске: {название: поля позиции}."""
+        return {name: item.to_record() for name, item in self.by_name.items()}
+
+    @classmethod
+    def from_records(cls, records: dict):
+        return cls(CatalogItem.from_record(name, record) for name, record in records.items())
@@ -0,0 +1,89 @@
+import re
+
+from rapidfuzz import fuzz, process
+
+from utils.catalog import MATTRESS, FABRIC, SPRINGS
+
+# Категории поиска. addition - всё, что не матрас, как в списке допников формы заявок
+SEARCH_CATEGORIES = (MATTRESS, FABRIC, SPRINGS, 'addition')
+# Префиксы слов какой длины попадают в индекс. Слова запроса длиннее дорабатываются проверкой startswith
+PREFIX_LENGTH = 3
+# Минимальная оценка rapidfuzz, ниже которой позиция с опечаткой не показывается
+FUZZY_CUTOFF = 60
+
+non_word = re.compile(r'[^\w]+')
+
+
+def normalize(text: str) -> str:
+    """Приводит название к виду для сравнения: без регистра, ё как е, знаки препинания как пробелы."""
+    return non_word.sub(' ', str(text).casefold().replace('ё', 'е')).strip()
+
+
+class CatalogSearch:
+    """Поиск по названиям и артикулам каталога. Индекс строится один раз на версию каталога.
+
+    Сначала ищутся позиции, где каждое слово запроса является началом какого-нибудь
+    слова названия или артикула, их находит индекс префиксов. Если таких меньше limit,
+    оставшиеся места занимают похожие названия по оценке rapidfuzz, это покрывает опечатки."""
+
+    def __init__(self, catalog):
+        items = [catalog[name] for name in catalog.names]
+        self.names = catalog.names
+        self.texts = [normalize(f'{item.name} {item.article}') for item in items]
+        self.words = [frozenset(text.split()) for text in self.texts]
+
+        self.categories = {
+            MATTRESS: [index for index, item in enumerate(items) if item.category == MATTRESS],
+            FABRIC: [index for index, item in enumerate(items) if item.category == FABRIC],
+            SPRINGS: [index for index, item in enumerate(items) if item.category == SPRINGS],
+            'addition': [index for index, item in enumerate(items) if item.category != MATTRESS],
+            None: list(range(len(items))),
+        }
+        # Тексты по категориям для rapidfuzz, чтобы не собирать список при каждом запросе
+        self.choices = {category: [self.texts[index] for index in indexes]
+                        for category, indexes in self.categories.items()}
+        self.category_sets = {category: frozenset(indexes) for category, indexes in self.categories.items()}
+
+        self.prefixes = {}
+        for index, words in enumerate(self.words):
+            for word in words:
+                for length in range(1, PREFIX_LENGTH + 1):
+                    self.prefixes.setdefault(word[:length], set()).add(index)
+
+    def prefix_matches(self, query_words: list, category) -> list:
+        """Позиции, у которых каждое слово запроса - начало одного из слов."""
+        candidates = None
+        for query_word in query_words:
+            found = self.prefixes.get(query_word[:PREFIX_LENGTH], set())
+            candidates = found if candidates is None else candidates & found
+            if not candidates:
+                return []
+
+        allowed = self.category_sets[category]
+        return [index for index in sorted(candidates & allowed)
+                if all(any(word.startswith(query_word) for word in self.words[index]) for query_word in query_words)]
+
+    def search(self, query: str, category: str = None, limit: int = 10) -> list:
+        """Названия позиций, лучшие совпадения первыми. Пустой запрос возвращает начало списка категории."""
+        text = normalize(query)
+        if not text:
+            return [self.names[index] for index in self.categories[category][:limit]]
+
+        # Совпадения по началу слов сортируются по похожести на запрос
+        prefix_hits = {index: self.texts[index] for index in self.prefix_matches(text.split(), category)}
+        result = [index for _, _, index in process.extract(text, prefix_hits, scorer=fuzz.WRatio,
+                                                           processor=None, limit=limit)]
+
+        if len(result) < limit:
+            seen = set(result)
+            indexes = self.categories[category]
+            for _, score, position in process.extract(text, self.choices[category], scorer=fuzz.WRatio,
+                                                      processor=None, limit=limit, score_cutoff=FUZZY_CUTOFF):
+                index = indexes[position]
+                if index not in seen:
+                    result.append(index)
+                    seen.add(index)
+                if len(result) >= limit:
+                    break
+
+        return [self.names[index] for index in result]
@@ -0,0 +1,79 @@
+import asyncio
+import json
+import logging
+
+from sqlalchemy import select, func
+
+# Канал PostgreSQL, в который все приложения (FastAPI и Streamlit) сообщают об изменениях нарядов
+CHANGES_CHANNEL = 'task_changes'
+
+
+def change_notification(event: dict):
+    """Запрос NOTIFY с событием изменения. Выполняется в той же транзакции, что и само изменение,
+    и доставляется слушателям только после коммита. Подходит и для синхронной, и для асинхронной сессии:
+    session.execute(change_notification(...)) / await session.execute(change_notification(...))"""
+    return select(func.pg_notify(CHANGES_CHANNEL, json.dumps(event, ensure_ascii=False)))
+
+
+class ChangeBus:
+    """Внутрипроцессная шина изменений нарядов.
+
+    Один LISTEN-коннект к БД на процесс принимает уведомления и раздаёт их
+    всем подписчикам (экранам сборки и шитья) через очереди asyncio. Сколько бы
+    станций ни было подключено, база видит одно соединение, а не опрос от каждой."""
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._task = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event: dict):
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Станция не успевает читать. Старые события ей уже не нужны, просим перечитать всё
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({'type': 'resync'})
+
+    def _on_notification(self, connection, pid, channel, payload):
+        try:
+            self.publish(json.loads(payload))
+        except json.JSONDecodeError:
+            logging.warning(f"Некорректное уведомление в канале {channel}: {payload}")
+
+    async def listen(self, engine, channel: str = CHANGES_CHANNEL):
+        """Держит LISTEN-соединение с БД и переподключается при обрыве."""
+        while True:
+            try:
+                async with engine.connect() as connection:
+                    raw_connection = await connection.get_raw_connection()
+                    driver_connection = raw_connection.driver_connection  # asyncpg.Connection
+                    await driver_connection.add_listener(channel, self._on_notification)
+                    logging.info(f"Подписка на изменения нарядов ({channel}) активна")
+                    # Пока соединения не было, события могли потеряться
+                    self.publish({'type': 'resync'})
+                    while not driver_connection.is_closed():
+                        await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Соединение с каналом изменений потеряно: {e}")
+            await asyncio.sleep(5)
+
+    def start(self, engine):
+        self._task = asyncio.create_task(self.listen(engine))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
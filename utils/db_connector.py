@@ -6,7 +6,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 
-from utils.models import Base, MattressRequest, Order
+from utils.models import MattressRequest, Order
 from utils.tools import load_conf
 
 config = load_conf()
@@ -66,5 +66,8 @@ def load_tasks(session):
 
 
 if __name__ == "__main__":
-    # Создаёт таблицы, если их нет
-    Base.metadata.create_all(engine)
+    # Создаёт таблицы, если их нет, и доводит схему до последней миграции
+    from utils.migrations import migrate
+    from utils.mattress_fields import sync_mattress_fields
+    migrate(engine)
+    sync_mattress_fields(engine)
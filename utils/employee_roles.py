@@ -0,0 +1,58 @@
+"""Роли сотрудников: на каких рабочих местах им можно работать.
+
+Роли хранятся в таблице employee_roles парами (сотрудник, рабочее место) вместо поиска
+подстроки в свободном тексте employees.position. Список сотрудников на смене и проверка
+доступа при сканировании штрих-кода идут по индексам, а опечатка в должности больше не
+закрывает сотруднику доступ.
+"""
+from sqlalchemy import select, exists, text
+
+from utils.models import Employee, EmployeeRole
+
+# Ключ рабочего места (как в STATION_QUEUES и адресах FastAPI) -> название страницы
+STATION_ROLES = {
+    'components': 'Заготовка',
+    'cutting': 'Нарезка',
+    'gluing': 'Сборка',
+    'sewing': 'Шитьё',
+    'packing': 'Упаковка',
+}
+STATION_BY_NAME = {name: station for station, name in STATION_ROLES.items()}
+
+
+def shift_employees_query(station: str):
+    """(имя, id) сотрудников на смене, у которых есть роль рабочего места."""
+    return (select(Employee.name, Employee.id)
+            .join(EmployeeRole, EmployeeRole.employee_id == Employee.id)
+            .where(EmployeeRole.station == station,
+                   Employee.is_on_shift.is_(True))
+            .order_by(Employee.name))
+
+
+def has_role_query(employee_id: int, station: str):
+    """Есть ли у сотрудника роль рабочего места."""
+    return select(exists().where(EmployeeRole.employee_id == employee_id,
+                                 EmployeeRole.station == station))
+
+
+def employee_stations(employee: Employee) -> set:
+    return {role.station for role in employee.roles}
+
+
+def set_employee_stations(employee: Employee, stations):
+    """Оставляет сотруднику ровно эти роли. Неизменившиеся строки employee_roles не трогаются."""
+    stations = set(stations)
+    employee.roles = ([role for role in employee.roles if role.station in stations] +
+                      [EmployeeRole(station=station) for station in sorted(stations - employee_stations(employee))])
+
+
+def backfill_employee_roles(connection):
+    """Шаг миграции: роли из текста employees.position. Сопоставление то же, что было
+    при поиске по подстроке: название рабочего места без учёта регистра, ё и е не различаются."""
+    for station, name in STATION_ROLES.items():
+        connection.execute(text("""
+            INSERT INTO employee_roles (employee_id, station)
+            SELECT id, :station FROM employees
+            WHERE replace(lower(coalesce(position, '')), 'ё', 'е') LIKE '%' || replace(lower(:name), 'ё', 'е') || '%'
+            ON CONFLICT DO NOTHING
+        """), {'station': station, 'name': name})
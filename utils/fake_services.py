@@ -0,0 +1,321 @@
+"""Локальная замена СБИС и Telegram для тестов и нагрузочных замеров без внешних сервисов.
+
+Отвечает на те же запросы, что делает приложение:
+    POST /auth/service/          СБИС.Аутентифицировать
+    POST /service/               СБИС.ЗаписатьДокумент
+    POST /oauth/service/         сервисная авторизация API розницы
+    GET  /retail/point/list      точки продаж
+    GET  /retail/nomenclature/price-list
+    GET  /retail/nomenclature/list
+    POST /bot<token>/<метод>     Telegram Bot API (sendMessage, getMe, getUpdates и прочие)
+
+Чтобы приложение ходило сюда, в app_config.toml указываются
+    [sbis] online_url = "http://127.0.0.1:8090", api_url = "http://127.0.0.1:8090/retail"
+    [telegram] api_url = "http://127.0.0.1:8090"
+
+Задержка и доля ошибок задаются в [fake_services] или ключами запуска, а на ходу меняются
+через GET/POST /_fake/settings. Записанные документы и сообщения видны в GET /_fake/log.
+
+Запись и воспроизведение:
+    --record DIR  запросы проксируются в настоящие СБИС и Telegram, ответы сохраняются в DIR
+    --replay DIR  ответы берутся из DIR. Если точного совпадения нет, отдаётся последний
+                  записанный ответ того же метода, а если нет и его - сгенерированный
+В файлы записи тела запросов не попадают, только их хэш: в них бывают пароли и токены.
+
+Запуск: python -m utils.fake_services [--port 8090] [--latency 0.2] [--jitter 0.1]
+                                      [--error-rate 0.05] [--record DIR | --replay DIR]
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import uuid
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+import niquests
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+from utils.tools import config
+
+fake_conf = config.get('fake_services', {})
+sbis_conf = config.get('sbis')
+
+# Куда проксировать запросы в режиме записи
+UPSTREAMS = {'sbis_online': 'https://online.sbis.ru',
+             'sbis_api': 'https://api.sbis.ru',
+             'telegram': 'https://api.telegram.org'}
+
+FAKE_SID = 'fake-sbis-session'
+FAKE_TOKEN = 'fake-sbis-access-token'
+
+
+@dataclass
+class FakeSettings:
+    latency: float = fake_conf.get('latency', 0.0)
+    jitter: float = fake_conf.get('jitter', 0.0)
+    error_rate: float = fake_conf.get('error_rate', 0.0)
+    error_status: int = fake_conf.get('error_status', 500)
+    nomenclature_items: int = fake_conf.get('nomenclature_items', 2000)
+    record_dir: str = ''
+    replay_dir: str = ''
+
+
+settings = FakeSettings()
+# Что приложение отправило в СБИС и Telegram, для проверок в тестах
+sent_log = {'documents': [], 'messages': []}
+
+app = FastAPI(title='Fake SBIS & Telegram')
+
+
+def upstream_for(path: str) -> str:
+    if path.startswith('/retail/'):
+        return UPSTREAMS['sbis_api']
+    if path.startswith('/bot') or path.startswith('/file/bot'):
+        return UPSTREAMS['telegram']
+    return UPSTREAMS['sbis_online']
+
+
+def route_key(request: Request, body: bytes) -> str:
+    """Ключ для подбора записи, если точного совпадения нет: HTTP-метод, путь без токена бота
+    и метод JSON-RPC, если это он."""
+    path = request.url.path
+    if path.startswith('/bot'):
+        path = '/bot/' + path.rsplit('/', 1)[-1]
+    rpc_method = ''
+    if body:
+        try:
+            rpc_method = json.loads(body).get('method', '')
+        except (ValueError, AttributeError):
+            pass
+    return f'{request.method} {path} {rpc_method}'.strip()
+
+
+def exact_key(request: Request, body: bytes) -> str:
+    query = '&'.join(sorted(f'{key}={value}' for key, value in request.query_params.multi_items()))
+    return hashlib.sha256(f'{request.method} {request.url.path}?{query}\n'.encode() + body).hexdigest()[:24]
+
+
+def safe_name(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()[:24]
+
+
+def load_recording(directory: Path, request: Request, body: bytes):
+    for name in (exact_key(request, body), f'latest-{safe_name(route_key(request, body))}'):
+        path = directory / f'{name}.json'
+        if path.exists():
+            return json.loads(path.read_text(encoding='utf-8'))
+    return None
+
+
+def save_recording(directory: Path, request: Request, body: bytes, response: niquests.Response):
+    directory.mkdir(parents=True, exist_ok=True)
+    record = {'request': {'method': request.method,
+                          'path': request.url.path,
+                          'query': dict(request.query_params),
+                          'route': route_key(request, body),
+                          'body_sha256': hashlib.sha256(body).hexdigest()},
+              'response': {'status': response.status_code,
+                           'content_type': response.headers.get('content-type', 'application/json'),
+                           'body': response.text}}
+    text = json.dumps(record, ensure_ascii=False, indent=2)
+    (directory / f'{exact_key(request, body)}.json').write_text(text, encoding='utf-8')
+    (directory / f'latest-{safe_name(route_key(request, body))}.json').write_text(text, encoding='utf-8')
+
+
+@app.middleware('http')
+async def inject_faults(request: Request, call_next):
+    """Задержка, ошибки, запись и воспроизведение. Служебные /_fake/* не затрагиваются."""
+    if request.url.path.startswith('/_fake/'):
+        return await call_next(request)
+
+    delay = settings.latency + random.uniform(0, settings.jitter)
+    if delay > 0:
+        await asyncio.sleep(delay)
+    if settings.error_rate and random.random() < settings.error_rate:
+        return JSONResponse(status_code=settings.error_status,
+                            content={'error': {'message': 'Внедрённая ошибка fake_services'}})
+
+    if not (settings.replay_dir or settings.record_dir):
+        return await call_next(request)
+
+    body = await request.body()
+    if settings.replay_dir:
+        record = load_recording(Path(settings.replay_dir), request, body)
+        if record is not None:
+            return Response(record['response']['body'], status_code=record['response']['status'],
+                            media_type=record['response']['content_type'])
+
+    if settings.record_dir:
+        headers = {key: value for key, value in request.headers.items()
+                   if key.lower() not in ('host', 'content-length', 'accept-encoding')}
+        async with niquests.AsyncSession() as client:
+            response = await client.request(request.method, upstream_for(request.url.path) + request.url.path,
+                                            params=dict(request.query_params), data=body, headers=headers,
+                                            timeout=60)
+        save_recording(Path(settings.record_dir), request, body, response)
+        return Response(response.content, status_code=response.status_code,
+                        media_type=response.headers.get('content-type', 'application/json'))
+
+    return await call_next(request)
+
+
+@app.get('/_fake/settings')
+async def get_settings():
+    return asdict(settings)
+
+
+@app.post('/_fake/settings')
+async def update_settings(request: Request):
+    """Меняет задержку и ошибки на ходу, например посреди нагрузочного теста."""
+    for key, value in (await request.json()).items():
+        if hasattr(settings, key):
+            setattr(settings, key, type(getattr(settings, key))(value))
+    return asdict(settings)
+
+
+@app.get('/_fake/log')
+async def get_log():
+    return sent_log
+
+
+@app.delete('/_fake/log')
+async def clear_log():
+    sent_log['documents'].clear()
+    sent_log['messages'].clear()
+    return sent_log
+
+
+def rpc_result(payload: dict, result) -> dict:
+    return {'jsonrpc': '2.0', 'result': result, 'id': payload.get('id', 0)}
+
+
+@app.post('/auth/service/')
+async def sbis_auth(request: Request):
+    return rpc_result(await request.json(), FAKE_SID)
+
+
+@app.post('/service/')
+async def sbis_service(request: Request):
+    payload = await request.json()
+    if request.headers.get('X-SBISSessionID') != FAKE_SID:
+        return JSONResponse(status_code=401, content={'error': {'message': 'Неверный идентификатор сессии'}})
+
+    match payload.get('method'):
+        case 'СБИС.ЗаписатьДокумент':
+            document = payload['params']['Документ']
+            document_id = str(uuid.uuid4())
+            sent_log['documents'].append({'id': document_id,
+                                          'Примечание': document.get('Примечание'),
+                                          'Вложение': [attachment['Файл']['Имя']
+                                                       for attachment in document.get('Вложение', [])]})
+            return rpc_result(payload, {'Идентификатор': document_id, 'Тип': document.get('Тип'),
+                                        'Состояние': {'Название': 'Отправлен'}})
+    return JSONResponse(status_code=500, content={'error': {'message': f"Метод {payload.get('method')} не поддерживается"}})
+
+
+@app.post('/oauth/service/')
+async def sbis_oauth():
+    return {'sid': FAKE_SID, 'token': FAKE_TOKEN}
+
+
+def check_token(request: Request):
+    if request.headers.get('X-SBISAccessToken') != FAKE_TOKEN:
+        return JSONResponse(status_code=401, content={'error': 'Требуется авторизация'})
+
+
+@app.get('/retail/point/list')
+async def sbis_points(request: Request):
+    return check_token(request) or {'salesPoints': [{'id': 1, 'name': sbis_conf.get('sale_point_name')}]}
+
+
+@app.get('/retail/nomenclature/price-list')
+async def sbis_price_lists(request: Request):
+    return check_token(request) or {'priceLists': [{'id': 1, 'name': sbis_conf.get('price_list_name')}]}
+
+
+def fake_nomenclature(number: int) -> dict:
+    """Позиция прайс-листа. Первые 15% - матрасы, затем ткани, пружинные блоки и прочее."""
+    items = settings.nomenclature_items
+    if number < items * 0.15:
+        group, name = sbis_conf.get('mattress_group_id'), f'Матрас «Модель {number}» {160 + number % 4 * 20}/200'
+        attributes = {'Размер': f'{160 + number % 4 * 20}/200/{18 + number % 5}', 'Состав': 'ППУ, кокос, латекс'}
+    elif number < items * 0.25:
+        group, name, attributes = sbis_conf.get('fabrics_group_id'), f'Ткань {number} (жаккард)', {}
+    elif number < items * 0.28:
+        group, name, attributes = sbis_conf.get('springs_group_id'), f'ПБ {number} TFK', {}
+    else:
+        group, name, attributes = 0, f'Допник {number}', {}
+    return {'id': number, 'name': name, 'nomNumber': f'{10000 + number}', 'article': f'А-{number}',
+            'cost': 1000 + number, 'hierarchicalParent': group, 'attributes': attributes,
+            'description_simple': '', 'images': []}
+
+
+@app.get('/retail/nomenclature/list')
+async def sbis_nomenclature(request: Request, page: int = 0, pageSize: int = 300):
+    if (denied := check_token(request)) is not None:
+        return denied
+
+    items = settings.nomenclature_items
+    changed_since_param = sbis_conf.get('nomenclature_changed_since_param', '')
+    if changed_since_param and changed_since_param in request.query_params:
+        # При частичной выгрузке изменились только несколько позиций
+        items = min(items, 10)
+
+    start = page * pageSize
+    numbers = range(start, min(start + pageSize, items))
+    return {'nomenclatures': [fake_nomenclature(number) for number in numbers],
+            'outcome': {'hasMore': start + pageSize < items}}
+
+
+@app.api_route('/bot{token}/{method}', methods=['GET', 'POST'])
+async def telegram_method(request: Request, token: str, method: str):
+    """Bot API: отвечает успехом на любой метод, sendMessage запоминает, getUpdates отдаёт пустой список."""
+    if request.headers.get('content-type', '').startswith('application/json'):
+        params = await request.json()
+    else:
+        params = dict(await request.form()) or dict(request.query_params)
+
+    match method:
+        case 'sendMessage':
+            message_id = len(sent_log['messages']) + 1
+            sent_log['messages'].append({'chat_id': params.get('chat_id'), 'text': params.get('text')})
+            return {'ok': True, 'result': {'message_id': message_id, 'date': 0, 'text': params.get('text'),
+                                           'chat': {'id': params.get('chat_id'), 'type': 'private'}}}
+        case 'getMe':
+            return {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}}
+        case 'getUpdates':
+            # Длинный опрос: держим соединение, но не дольше пары секунд, чтобы бот не простаивал
+            await asyncio.sleep(min(float(params.get('timeout', 0) or 0), 2))
+            return {'ok': True, 'result': []}
+    return {'ok': True, 'result': True}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Локальная замена СБИС и Telegram')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=fake_conf.get('port', 8090))
+    parser.add_argument('--latency', type=float, default=settings.latency)
+    parser.add_argument('--jitter', type=float, default=settings.jitter)
+    parser.add_argument('--error-rate', type=float, default=settings.error_rate)
+    parser.add_argument('--error-status', type=int, default=settings.error_status)
+    parser.add_argument('--items', type=int, default=settings.nomenclature_items)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--record', default='', help='Папка для записи ответов настоящих сервисов')
+    mode.add_argument('--replay', default='', help='Папка с записанными ответами')
+    args = parser.parse_args()
+
+    settings.latency = args.latency
+    settings.jitter = args.jitter
+    settings.error_rate = args.error_rate
+    settings.error_status = args.error_status
+    settings.nomenclature_items = args.items
+    settings.record_dir = args.record
+    settings.replay_dir = args.replay
+
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -1,24 +1,39 @@
 import re
+import json
+import asyncio
 import logging
+import uuid
+from contextlib import asynccontextmanager
 from io import BytesIO
 
 # Jvybccbz? ghjcnb? xnj z gjd`kcz yf yjdjvjlysq ahtqvdjhr b htibk pfgbkbnm yf y`v ghbkj;tybt? cjdctv yt ghtlyfpyfxtyyjt lkz nfrb[ pflfx
 import barcode
 Code128 = barcode.get_barcode_class('code128')
-from datetime import datetime as dt, datetime
+from datetime import datetime as dt
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, FileResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import joinedload
 from starlette.responses import RedirectResponse
 
-from utils.models import Order, MattressRequest, Employee, EmployeeTask
-from utils.db_connector import async_session
-from utils.sbis_manager import SBISWebApp
-from utils.tools import load_conf, fabric_type, send_telegram_message, create_history_note, remove_text_in_parentheses, \
+from utils.models import Order, MattressRequest, Employee, OutboxMessage, TaskEvent
+from utils.catalog_search import CatalogSearch, SEARCH_CATEGORIES
+from utils.change_bus import ChangeBus, change_notification
+from utils.db_connector import async_session, async_engine
+from utils.employee_roles import has_role_query
+from utils.http_client import close_async_http_session
+from utils.nomenclature_cache import NomenclatureCache
+from utils.outbox import OutboxDispatcher, TerminalDeliveryError
+from utils.photo_store import save_data_url, photo_url, is_photo_digest, photo_path, thumbnail_path, \
+    photo_media_type
+from utils.prepared_response import PreparedJSON
+from utils.resilience import breakers_status, MaybeSentError
+from utils.sbis_manager import SBISWebApp, changed_since_param
+from utils.task_queries import claim_task_query, reserved_task_query
+from utils.tools import load_conf, derived_fields, send_telegram_message, remove_text_in_parentheses, \
     str_num_to_float
 
 config = load_conf()
@@ -30,10 +45,6 @@ fastapi_port = site_config.get('site_port')
 
 tg_group_chat_id = config.get('telegram', {}).get('group_chat_id')
 
-app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
-
 sbis_config = config.get('sbis')
 login = sbis_config.get('login')
 password = sbis_config.get('password')
@@ -41,7 +52,58 @@ sale_point_name = sbis_config.get('sale_point_name')
 price_list_name = sbis_config.get('price_list_name')
 sbis = SBISWebApp(login, password, sale_point_name, price_list_name)
 
-nomenclatures = {}
+# Номенклатура обновляется в фоне, обработчики запросов берут её из кэша
+# Частичная выгрузка включается, только если в app_config.toml задан параметр даты изменения
+nomenclature_cache = NomenclatureCache(sbis.get_nomenclatures,
+                                       incremental_loader=sbis.update_nomenclatures if changed_since_param else None)
+
+
+async def deliver_telegram_message(payload: dict):
+    response = await send_telegram_message(payload['text'], payload['chat_id'])
+    if not response.get('ok'):
+        raise RuntimeError(f"Telegram: {response.get('description')}")
+
+
+async def deliver_implementation(payload: dict):
+    # Реализация в СБИС собирается по кодам товаров из каталога
+    catalog = await nomenclature_cache.get()
+    document_id = payload.get('document_id')
+    try:
+        result = await asyncio.to_thread(sbis.write_implementation, payload['order'], catalog, document_id)
+    except MaybeSentError as e:
+        # С идентификатором повтор перезапишет тот же документ. Без него (сообщения, записанные
+        # до появления идентификатора) повтор может создать второй документ
+        if document_id is None:
+            raise TerminalDeliveryError(f"Реализация могла записаться в СБИС: {e}") from e
+        raise
+    if result is None:
+        raise RuntimeError("СБИС не записал документ реализации, подробности в логах")
+
+
+# Сообщения в Telegram и реализации в СБИС уходят в фоне, после сохранения заказа
+outbox = OutboxDispatcher(async_session, {'telegram': deliver_telegram_message,
+                                          'sbis_implementation': deliver_implementation})
+
+
+# Уведомления об изменениях нарядов для экранов сборки и шитья
+change_bus = ChangeBus()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    nomenclature_cache.start()
+    outbox.start()
+    change_bus.start(async_engine)
+    yield
+    await change_bus.stop()
+    await outbox.stop()
+    await nomenclature_cache.stop()
+    await close_async_http_session()
+
+
+app = FastAPI(lifespan=lifespan)
+app.mount("/static", StaticFiles(directory="static"), name="static")
+templates = Jinja2Templates(directory="templates")
 
 
 def create_order_row(order):
@@ -65,7 +127,7 @@ def get_mattress_str(mattress, sbis_data):
     comment = mattress.get('comment')
 
     return (
-            f"Арт. {sbis_data['article']}, {mattress['quantity']} шт. {mattress['size']} \n"
+            f"Арт. {sbis_data.article}, {mattress['quantity']} шт. {mattress['size']} \n"
             + (f"Топ: {base_fabric}\n" if base_fabric else '')
             + (f"Бок: {side_fabric}\n" if side_fabric else '')
             + (f"ПБ: {spring_block}\n" if spring_block else '')
@@ -77,7 +139,7 @@ def get_mattress_str(mattress, sbis_data):
 def enhance_mattress_info(mattress, sbis_data):
     # Размер по умолчанию, если не указан вручную
     if mattress['size'] == '':
-        mattress['size'] = sbis_data['size']
+        mattress['size'] = sbis_data.size
     # Символ разделителя "/" заменит символы "*", "-" и "_" для одинакового вида,
     # и чтобы markdown в дальнейшем не ломал строку типа "190*120*20"
     mattress['size'] = re.sub(r'[*_\-|]', '/', mattress['size'])
@@ -99,26 +161,30 @@ def create_mattress_row(mattress, sbis_data):
     # Если артикул в списке showed_articles, либо что-то прописали в комментарий,
     # либо размер не стандартный, то components_is_done = False
     showed_articles = config.get('components', {}).get('showed_articles', [])
-    if sbis_data['article'] in showed_articles or mattress.get('comment') != '' or mattress['size'] != sbis_data['size']:
+    if sbis_data.article in showed_articles or mattress.get('comment') != '' or mattress['size'] != sbis_data.size:
         components_field = False
 
+    base_fabric = mattress['topFabric']
+    side_fabric = mattress['sideFabric'] or mattress['topFabric']
     return MattressRequest(
         high_priority=False,
-        article=sbis_data['article'] or '0',
+        article=sbis_data.article or '0',
         components_is_done=components_field,
         fabric_is_done=False,
         gluing_is_done=False,
         sewing_is_done=False,
         packing_is_done=False,
-        base_fabric=mattress['topFabric'],
-        side_fabric=mattress['sideFabric'] or mattress['topFabric'],
+        base_fabric=base_fabric,
+        side_fabric=side_fabric,
         springs=mattress["springBlock"] or '',
         size=mattress['size'],
         photo=mattress.get('photo'),
         comment=mattress.get('comment', ''),
-        attributes=sbis_data['structure'],
+        attributes=sbis_data.structure,
         history='',
-        created=dt.now()
+        created=dt.now(),
+        # Размеры и боковина считаются один раз здесь, страницы производства их только читают
+        **derived_fields(mattress['size'], base_fabric, side_fabric)
     )
 
 
@@ -137,9 +203,8 @@ def get_order_str(order, positions, price):
 
 @app.get('/', response_class=HTMLResponse)
 async def get_index(request: Request):
-    global nomenclatures
     logging.debug("Рендеринг шаблона index.html")
-    nomenclatures = sbis.get_nomenclatures()
+    nomenclatures = await nomenclature_cache.get()
     return templates.TemplateResponse("index.html", {"request": request,
                                                      "nomenclatures": nomenclatures,
                                                      "regions": regions,
@@ -152,6 +217,17 @@ async def post_index(request: Request):
         order_data = await request.json()
         # Заранее превращаем значение предоплаты во float, записываем в JSON
         order_data['prepayment'] = str_num_to_float(order_data.get('prepayment', 0))
+        nomenclatures = await nomenclature_cache.get()
+        if not nomenclatures:
+            # Холодный старт: каталог СБИС не успел загрузиться за wait_timeout, загрузка идёт в фоне
+            raise HTTPException(status_code=503, headers={'Retry-After': '30'},
+                                detail="Каталог товаров загружается из СБИС. Отправьте заявку ещё раз через минуту.")
+        unknown = [mattress.get('name') for mattress in order_data.get('mattresses') or []
+                   if mattress.get('name') not in nomenclatures]
+        if unknown:
+            raise HTTPException(status_code=400,
+                                detail=f"Товаров нет в каталоге СБИС: {', '.join(map(str, unknown))}. "
+                                       f"Проверьте названия в заявке.")
 
         async with async_session() as session:
             async with session.begin():
@@ -186,6 +262,8 @@ async def post_index(request: Request):
                                                       'quantity': mattress['quantity'],
                                                       'price': 0})
                         mattress_message = enhance_mattress_info(mattress, item_sbis_data)
+                        # Фото сохраняется в хранилище один раз, в матрасы пишется только его хэш
+                        mattress_message['photo'] = await asyncio.to_thread(save_data_url, mattress.get('photo'))
                         total_price += mattress['price']
 
                         # Формируем сообщение для TG и сохраняем заказ и матрасы в БД
@@ -200,17 +278,32 @@ async def post_index(request: Request):
 
                 position_message += extra_positions_message
 
-                # Отправляем сформированное сообщение в группу telegram, где все заявки, и пользователю бота в ЛС
+                # Сообщение в telegram и реализация в СБИС записываются в outbox в той же транзакции,
+                # что и заказ. Отправит их фоновый диспетчер, повторяя попытки при сбоях
                 order_message = get_order_str(order_data, position_message, total_price)
-                await send_telegram_message(order_message, request.query_params.get('chat_id'))
-                # await send_telegram_message(order_message, tg_group_chat_id)
-
-                # Из JSON создаётся документ реализации в СБИС
-                sbis.write_implementation(order_data)
-                await session.commit()
-                return {"status": "success",
-                        "data": "   Заявка принята.\nРеализация записана.\nНаряды созданы."}
-
+                chat_id = request.query_params.get('chat_id')
+                if chat_id:
+                    session.add(OutboxMessage(kind='telegram',
+                                              payload={'chat_id': chat_id, 'text': order_message}))
+                # session.add(OutboxMessage(kind='telegram',
+                #                           payload={'chat_id': tg_group_chat_id, 'text': order_message}))
+
+                # Из JSON создаётся документ реализации в СБИС. Фото для реализации не нужны
+                implementation_data = {**order_data,
+                                       'mattresses': [{key: value for key, value in mattress.items() if key != 'photo'}
+                                                      for mattress in order_data.get('mattresses') or []]}
+                # Идентификатор документа задаётся сразу, чтобы повторная отправка обновила тот же документ
+                session.add(OutboxMessage(kind='sbis_implementation',
+                                          payload={'order': implementation_data, 'document_id': str(uuid.uuid4())}))
+                await session.execute(change_notification({'type': 'orders_created'}))
+
+        # Транзакция закрыта, заказ сохранён. Будим диспетчер, чтобы сообщения ушли сразу
+        outbox.wake()
+        return {"status": "success",
+                "data": "   Заявка принята.\nРеализация записывается.\nНаряды созданы."}
+
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Необработанная ошибка: - {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Сообщите администратору: {str(e)}.")
@@ -236,8 +329,8 @@ async def log_sequence_gluing(request: Request):
         message = {
             'Артикул': task.article,
             'Состав': task.attributes,
-            'Ткань (Верх / низ)': fabric_type(task.base_fabric),
-            'Ткань (Боковина)': fabric_type(task.side_fabric),
+            'Ткань (Верх / низ)': task.base_fabric_type,
+            'Ткань (Боковина)': task.side_fabric_type,
             'Пружины': task.springs,
             'Размер': task.size
         }
@@ -246,7 +339,7 @@ async def log_sequence_gluing(request: Request):
             message['Комментарий'] = f"<strong>{task.comment}</strong>"
 
         if task.photo:
-            message['Фото'] = task.photo  # Фото в формате JPEG
+            message['Фото'] = photo_url(task.photo, thumbnail=False)
 
         return message
 
@@ -258,6 +351,45 @@ async def complete_task_gluing(request: Request):
     return await complete_task(request, 'Сборка', 'Готово', 'gluing_is_done')
 
 
+# Рабочие места, экраны которых подписываются на изменения нарядов
+EVENT_STATIONS = ('gluing', 'sewing')
+
+
+def station_event(event: dict, endpoint: str) -> bool:
+    """Нужно ли событие экрану рабочего места. Брони другого рабочего места экрану не нужны,
+    а завершение задачи на соседнем месте меняет очередь, поэтому отправляется всем."""
+    return event.get('type') != 'task_reserved' or event.get('endpoint') == endpoint
+
+
+@app.get('/events/{endpoint}')
+async def station_events(endpoint: str, request: Request):
+    """Поток событий (Server-Sent Events) для экранов сборки и шитья.
+    Станция узнаёт, что её бронь сбросили или наряд поменяли, без повторного сканирования."""
+    if endpoint not in EVENT_STATIONS:
+        raise HTTPException(status_code=404, detail="Неизвестное рабочее место.")
+    queue = change_bus.subscribe()
+
+    async def event_stream():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # Пустой комментарий не даёт прокси и туннелю закрыть соединение
+                    yield ': ping\n\n'
+                    continue
+                if not station_event(event, endpoint):
+                    continue
+                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            change_bus.unsubscribe(queue)
+
+    logging.debug(f'Экран {endpoint} подписался на изменения нарядов')
+    return StreamingResponse(event_stream(),
+                             media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.get('/sewing')
 async def sewing(request: Request):
     logging.debug('Рендеринг страницы швейного стола')
@@ -279,7 +411,7 @@ async def log_sequence_sewing(request: Request):
             message['Комментарий'] = f"<strong>{task.comment}</strong>"
 
         if task.photo:
-            message['Фото'] = task.photo  # Фото в формате JPEG
+            message['Фото'] = photo_url(task.photo, thumbnail=False)
 
         return message
 
@@ -291,45 +423,114 @@ async def complete_task_sewing(request: Request):
     return await complete_task(request, 'Шитьё', 'Готово', 'sewing_is_done')
 
 
+# Производные от каталога структуры (готовые ответы, поисковый индекс) собираются один раз
+# на версию каталога: {'catalog': каталог, 'items': {ключ: структура}}
+catalog_derived = {'catalog': None, 'items': {}}
+
+
+def derived_from_catalog(catalog, key: str, build):
+    """Возвращает build(catalog), собранный для этого каталога. Пересобирается, только когда каталог обновился."""
+    if catalog_derived['catalog'] is not catalog:
+        catalog_derived.update(catalog=catalog, items={})
+    items = catalog_derived['items']
+    if key not in items:
+        items[key] = build(catalog)
+    return items[key]
+
+
+async def catalog_response(request: Request, name: str, build):
+    """Отдаёт заранее сериализованный и сжатый ответ по каталогу. build(catalog) вызывается,
+    только когда каталог обновился, повторные запросы браузера получают 304."""
+    catalog = await nomenclature_cache.get()
+    prepared = derived_from_catalog(catalog, f'response:{name}',
+                                    lambda catalog: PreparedJSON({"status": "success", "data": build(catalog)}))
+    return prepared.response(request)
+
+
+@app.get('/api/search')
+async def search_catalog(q: str = '', category: str | None = None, limit: int = 10):
+    """Поиск позиций по началу слов и с опечатками.
+    category: mattress, fabric, springs или addition (всё, кроме матрасов)"""
+    if category is not None and category not in SEARCH_CATEGORIES:
+        raise HTTPException(status_code=400, detail=f"Неизвестная категория: {category}")
+    catalog = await nomenclature_cache.get()
+    search = derived_from_catalog(catalog, 'search', CatalogSearch)
+    return JSONResponse(content={"status": "success", "data": search.search(q, category, min(max(limit, 1), 50))})
+
+
+@app.get('/api/catalog')
+async def get_catalog(request: Request):
+    """Все списки для формы заявок одним запросом"""
+    logging.debug("Получен GET-запрос к /api/catalog")
+    return await catalog_response(request, 'catalog', lambda catalog: {'mattresses': catalog.mattresses,
+                                                                       'additions': catalog.additions,
+                                                                       'fabrics': catalog.fabrics,
+                                                                       'springs': catalog.springs})
+
+
 @app.get('/api/nomenclatures')
-async def get_articles():
-    """Запрос выдаёт список строк с названиями товаров.
-    Символы строк в формате Unicode escape-последовательности"""
+async def get_articles(request: Request):
+    """Запрос выдаёт список строк с названиями товаров"""
     logging.debug("Получен GET-запрос к /api/nomenclatures")
-    return JSONResponse(content={"status": "success", "data": list(nomenclatures)})
+    return await catalog_response(request, 'nomenclatures', lambda catalog: catalog.names)
 
 
 @app.get('/api/additions')
-async def get_additions():
+async def get_additions(request: Request):
     logging.debug("Получен GET-запрос к /api/additions")
-    mattresses = {key: value for key, value in nomenclatures.items() if value['is_mattress']}
-    return JSONResponse(content={"status": "success", "data": list(set(list(nomenclatures)) - set(list(mattresses)))})
+    return await catalog_response(request, 'additions', lambda catalog: catalog.additions)
 
 
 @app.get('/api/fabrics')
-async def get_fabrics():
+async def get_fabrics(request: Request):
     """Возвращает список названий тканей, отсортированный по алфавиту"""
     logging.debug("Получен GET-запрос к /api/fabrics")
-    fabrics = {key: value for key, value in nomenclatures.items() if value['is_fabric']}
-    return JSONResponse(content={"status": "success", "data": sorted(list(fabrics), reverse=True)})
+    return await catalog_response(request, 'fabrics', lambda catalog: catalog.fabrics)
 
 
 @app.get('/api/springs')
-async def get_springs():
+async def get_springs(request: Request):
+    """Пружинные блоки и пустая позиция «Нет» в конце списка"""
     logging.debug("Получен GET-запрос к /api/springs")
-    springs = {key: value for key, value in nomenclatures.items() if value['is_springs']}
-    springs['Нет'] = ''  # Добавляем пустую позицию на ПБ
-    return JSONResponse(content={"status": "success", "data": list(springs)})
+    return await catalog_response(request, 'springs', lambda catalog: catalog.springs)
 
 
 @app.get('/api/mattresses')
-async def get_mattresses():
+async def get_mattresses(request: Request):
     """Запрос почти как /api/nomenclatures, только выдаёт
-    не все товары, а список строк с названиями матрасов.
-    Символы строк в формате Unicode escape-последовательности"""
+    не все товары, а список строк с названиями матрасов"""
     logging.debug("Получен GET-запрос к /api/mattresses")
-    mattresses = {key: value for key, value in nomenclatures.items() if value['is_mattress']}
-    return JSONResponse(content={"status": "success", "data": list(mattresses)})
+    return await catalog_response(request, 'mattresses', lambda catalog: catalog.mattresses)
+
+
+@app.get('/api/health/sbis')
+async def sbis_health():
+    """Состояние связи с СБИС: размыкатели цепи и возраст каталога, которым сейчас пользуется форма"""
+    breakers = breakers_status()
+    degraded = any(breaker['state'] != 'closed' for breaker in breakers) or nomenclature_cache.is_stale
+    return JSONResponse(content={"status": "degraded" if degraded else "ok",
+                                 "breakers": breakers,
+                                 "catalog": nomenclature_cache.status()})
+
+
+# Фото неизменны: адрес содержит хэш содержимого, поэтому браузер может кэшировать их навсегда
+PHOTO_CACHE_HEADERS = {'Cache-Control': 'public, max-age=31536000, immutable'}
+
+
+@app.get('/photos/{digest}')
+async def get_photo(digest: str):
+    if not is_photo_digest(digest) or not photo_path(digest).exists():
+        raise HTTPException(status_code=404, detail="Фото не найдено.")
+    return FileResponse(photo_path(digest),
+                        media_type=await asyncio.to_thread(photo_media_type, digest),
+                        headers=PHOTO_CACHE_HEADERS)
+
+
+@app.get('/photos/{digest}/thumb')
+async def get_photo_thumbnail(digest: str):
+    if not is_photo_digest(digest) or not thumbnail_path(digest).exists():
+        raise HTTPException(status_code=404, detail="Фото не найдено.")
+    return FileResponse(thumbnail_path(digest), media_type='image/jpeg', headers=PHOTO_CACHE_HEADERS)
 
 
 @app.get('/api/barcode/{employee_id}', response_class=HTMLResponse)
@@ -419,7 +620,7 @@ async def log_sequence(request: Request,
                                                            '\n'
                                                            'Жду штрих-код...'}})
 
-        if page_name.lower() not in employee.position.lower():
+        if not await session.scalar(has_role_query(employee_id, endpoint)):
             return JSONResponse(content={"status": "error",
                                          "data": {'sequence': employee.name,
                                                   'error': 'Нет доступа. Уточните должность у бригадира.\n'
@@ -427,80 +628,51 @@ async def log_sequence(request: Request,
                                                            'Жду штрих-код...'}})
 
         # Проверяем, есть ли у сотрудника текущая задача в таблице EmployeeTask
-        existing_task = await session.execute(
-            select(EmployeeTask).where(
-                EmployeeTask.employee_id == employee_id,
-                EmployeeTask.endpoint == endpoint))
+        existing_task = await session.execute(reserved_task_query(employee_id, endpoint))
         existing_task = existing_task.scalar_one_or_none()
         if existing_task:
             # У сотрудника уже есть назначенная задача
             task = await session.get(MattressRequest, existing_task.task_id)
             return JSONResponse(content={"status": "success",
                                          "data": {'sequence': employee.name,
+                                                  'task_id': task.id,
                                                   'task_data': transform_task_data(task)}})
 
-        # Получение доступных задач из базы данных
-        search_field = f'{endpoint}_is_done'
-        match endpoint:
-            case 'gluing':
-                result = await session.execute(
-                    select(MattressRequest)
-                    .where(MattressRequest.components_is_done == True,  # Учитываем только незавершённые задачи
-                    getattr(MattressRequest, search_field) == False) # Для корректной динамической постановки поискового поля нужен такой костыль. Нотация через точку не работает
-                    .options(joinedload(MattressRequest.order))  # Загрузка связанных заказов
-                )
-            case 'sewing':
-                result = await session.execute(
-                    select(MattressRequest)
-                    .where(MattressRequest.components_is_done == True,
-                           MattressRequest.fabric_is_done == True,
-                           MattressRequest.gluing_is_done == True,
-                           getattr(MattressRequest, search_field) == False)
-                    .options(joinedload(MattressRequest.order))
-                )
-        tasks = result.scalars().all()
-        if not tasks:
+        # Бронируем самую приоритетную свободную задачу одним запросом
+        task_id = await claim_task(session, employee_id, endpoint)
+        if task_id is None:
             return JSONResponse(content={"status": "error",
                                          "data": {'sequence': employee.name,
                                                   'error': 'Сейчас пока нет задач.\n'
                                                            '\n'
                                                            'Жду штрих-код...'}})
 
-        # Сортируем задачи по приоритетам
-        tasks = sorted(tasks, key=lambda x: (
-            not x.high_priority,  # False означает высокий приоритет
-            x.order.deadline if x.order and x.order.deadline else datetime.max,  # Дедлайн из заказа, если он есть
-            delivery_types.index(x.order.delivery_type) if x.order and x.order.delivery_type in delivery_types else len(
-                delivery_types),  # Тип доставки из заказа
-            not bool(x.comment)))  # True означает отсутствие комментария
-
-        # Поиск новой задачи
-        for task in tasks:
-            # Проверяем, назначена ли задача другим сотрудникам
-            task_assigned = await session.execute(select(EmployeeTask).where(
-                EmployeeTask.task_id == task.id,
-                EmployeeTask.endpoint == endpoint))
-            task_assigned = task_assigned.scalar_one_or_none()
-            if task_assigned:
-                continue
-
-            # Назначаем задачу сотруднику
-            employee_task = EmployeeTask(
-                employee_id=employee_id,
-                task_id=task.id,
-                endpoint=endpoint)
-            session.add(employee_task)
-            await update_task_history(session, task, page_name, employee.name, action)
-            await session.commit()
-            return JSONResponse(content={"status": "success",
-                                         "data": {'sequence': employee.name,
-                                                  'task_data': transform_task_data(task)}})
-
-        return JSONResponse(content={"status": "error",
+        task = await session.get(MattressRequest, task_id)
+        await session.execute(change_notification({'type': 'task_reserved',
+                                                   'endpoint': endpoint,
+                                                   'task_id': task_id}))
+        record_task_event(session, task, page_name, employee, action)
+        await session.commit()
+        return JSONResponse(content={"status": "success",
                                      "data": {'sequence': employee.name,
-                                              'error': 'Задач для тебя пока нет. Приходи позже.\n'
-                                                       '\n'
-                                                       'Жду штрих-код...'}})
+                                              'task_id': task.id,
+                                              'task_data': transform_task_data(task)}})
+
+
+async def claim_task(session: AsyncSession, employee_id: int, endpoint: str, attempts: int = 3) -> int | None:
+    """Бронирует за сотрудником самую приоритетную свободную задачу за один запрос к БД.
+    Возвращает id забронированного матраса или None, если свободных задач нет."""
+    for attempt in range(1, attempts + 1):
+        try:
+            # Точка сохранения: при конфликте откатывается только попытка брони, а не вся сессия
+            async with session.begin_nested():
+                result = await session.execute(claim_task_query(employee_id, endpoint))
+                return result.scalar_one_or_none()
+        except IntegrityError:
+            # Матрас успели забронировать в параллельной транзакции, уникальный индекс
+            # (task_id, endpoint) не дал выдать его второй раз. Берём следующий свободный
+            logging.info(f"Бронь на {endpoint} для сотрудника {employee_id} перехвачена, попытка {attempt}")
+    return None
 
 
 async def complete_task(request: Request, page_name: str, action: str, done_field: str):
@@ -519,9 +691,7 @@ async def complete_task(request: Request, page_name: str, action: str, done_fiel
 
     async with async_session() as session:
         # Получаем текущую задачу сотрудника
-        result = await session.execute(select(EmployeeTask).where(
-            EmployeeTask.employee_id == employee_id,
-            EmployeeTask.endpoint == endpoint))
+        result = await session.execute(reserved_task_query(employee_id, endpoint))
         employee_task = result.scalar_one_or_none()
         if not employee_task:
             logging.error(f"EmployeeTask ID doesn't found in database for Employee ID {employee_id}")
@@ -548,9 +718,12 @@ async def complete_task(request: Request, page_name: str, action: str, done_fiel
 
         # Обновление статуса задачи
         setattr(task, done_field, True)
-        await update_task_history(session, task, page_name, employee.name, action)
+        record_task_event(session, task, page_name, employee, action)
         # Удаление задачи из текущих задач сотрудника
         await session.delete(employee_task)
+        await session.execute(change_notification({'type': 'task_completed',
+                                                   'endpoint': endpoint,
+                                                   'task_id': task.id}))
 
         # Завершение
         await session.commit()
@@ -558,12 +731,14 @@ async def complete_task(request: Request, page_name: str, action: str, done_fiel
     return JSONResponse(content={"status": "success"})
 
 
-async def update_task_history(session: AsyncSession, task: MattressRequest,
-                              page_name: str,
-                              employee_name: str,
-                              action: str):
-    history_note = create_history_note(page_name, employee_name, action)
-    task.history = history_note if not task.history else history_note + task.history
-    logging.debug(f"История задачи {task.id} обновлена: {history_note}")
-
-    await session.commit()
+def record_task_event(session: AsyncSession, task: MattressRequest,
+                      page_name: str,
+                      employee: Employee,
+                      action: str):
+    """Добавляет событие в журнал task_events. Запись уходит вместе с коммитом вызывающего кода."""
+    session.add(TaskEvent(task_id=task.id,
+                          stage=page_name,
+                          employee_id=employee.id,
+                          employee_name=employee.name,
+                          action=action))
+    logging.debug(f"Событие задачи {task.id}: {page_name} [ {employee.name} ] -> {action}")
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import threading
+import time
+import weakref
+
+import niquests
+
+from utils.tools import config
+
+http_conf = config.get('http', {})
+connect_timeout = http_conf.get('connect_timeout', 5)
+read_timeout = http_conf.get('read_timeout', 30)
+pool_maxsize = http_conf.get('pool_maxsize', 10)
+
+# Таймаут по умолчанию для всех запросов к внешним сервисам: (подключение, чтение)
+DEFAULT_TIMEOUT = (connect_timeout, read_timeout)
+
+_session = None
+_session_lock = threading.Lock()
+# AsyncSession привязана к event loop, поэтому у каждого цикла своя
+_async_sessions = weakref.WeakKeyDictionary()
+
+
+def http_session() -> niquests.Session:
+    """Общая для процесса сессия с пулом keep-alive соединений (HTTP/2, если сервер умеет).
+    TLS-рукопожатие делается один раз на соединение, а не на каждый запрос."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = niquests.Session(pool_maxsize=pool_maxsize)
+    return _session
+
+
+def async_http_session() -> niquests.AsyncSession:
+    """Асинхронный вариант http_session() для текущего event loop."""
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None:
+        session = niquests.AsyncSession(pool_maxsize=pool_maxsize)
+        _async_sessions[loop] = session
+    return session
+
+
+def close_http_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+async def close_async_http_session():
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+class TokenStore:
+    """Токен авторизации в памяти процесса со сроком жизни.
+
+    fetch() получает новый токен у сервиса. Обновление однопоточное: если несколько
+    запросов одновременно получили 401, токен перевыпустит только первый, остальные
+    дождутся его и возьмут уже новый."""
+
+    def __init__(self, fetch, lifetime: float):
+        self.fetch = fetch
+        self.lifetime = lifetime
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires = 0.0
+
+    def _valid(self) -> bool:
+        return self._token is not None and time.monotonic() < self._expires
+
+    def get(self):
+        """Действующий токен. Если его нет или он истёк, получает новый."""
+        if self._valid():
+            return self._token
+        return self.refresh(self._token)
+
+    def refresh(self, stale=None):
+        """Перевыпускает токен, которым получили отказ. Если его уже заменил
+        другой поток, возвращает новый без повторной авторизации."""
+        with self._lock:
+            if self._valid() and self._token != stale:
+                return self._token
+
+            logging.info('Получаем новый токен авторизации...')
+            token = self.fetch()
+            # Неудачная авторизация не кэшируется, следующий запрос попробует снова
+            if token is not None:
+                self._token = token
+                self._expires = time.monotonic() + self.lifetime
+            return token
+
+    def invalidate(self):
+        with self._lock:
+            self._token = None
+            self._expires = 0.0
@@ -0,0 +1,105 @@
+"""Документ реализации для СБИС.
+
+Шаблон templates/implementation.xml компилируется один раз при импорте, документ
+собирается в памяти и сразу кодируется в base64 для вложения. Временного файла нет,
+поэтому одновременные заказы не перезаписывают документы друг друга.
+
+Замер скорости: python -m utils.implementation_xml
+"""
+import base64
+import json
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from jinja2 import Environment, FileSystemLoader
+
+from utils.tools import config
+
+imp_filepath = Path(config.get('sbis').get('implementation_filepath'))
+
+template_env = Environment(loader=FileSystemLoader('templates'),
+                           autoescape=True,
+                           trim_blocks=True,
+                           lstrip_blocks=True)
+implementation_template = template_env.get_template('implementation.xml')
+
+
+def implementation_positions(data: dict, catalog) -> list:
+    """Позиции документа: матрасы, затем допники. Код товара берётся из каталога по названию."""
+    positions = []
+    for position in [*data.get('mattresses', []), *data.get('additionalItems', [])]:
+        price = float(position['price'])
+        quantity = int(position.get('quantity', '1'))
+        positions.append({'code': catalog[position['name']].code,
+                          'name': position['name'],
+                          'quantity': quantity,
+                          'price': price,
+                          'item_price': price / quantity})
+    return positions
+
+
+def implementation_context(data: dict, catalog) -> dict:
+    # Если поле "Компания" оставить пустым при создании заявки, счёт оформится как розница,
+    # а если нет, то в счёте будет юрлицо
+    customer_inn, customer_kpp, company_address = None, None, None
+    wholesale = bool(data.get('organization'))
+    if wholesale:
+        customer_info = json.loads(data.get('organization_data', {}) or '{}')
+        customer_inn = customer_info.get('data', {}).get('inn', None)
+        customer_kpp = customer_info.get('data', {}).get('kpp', None)
+        company_address = customer_info.get('address_data', {}).get('value', None)
+
+    positions = implementation_positions(data, catalog)
+    return {'today': datetime.today().strftime('%d.%m.%Y'),
+            'wholesale': wholesale,
+            'customer_inn': customer_inn,
+            'customer_kpp': customer_kpp,
+            # Кавычки и прочие спецсимволы экранирует шаблон
+            'customer_name': data.get('organization', ''),
+            'company_address': company_address,
+            'delivery_date': datetime.strptime(data.get('deliveryDate', '2000-01-01'), '%Y-%m-%d').strftime('%d.%m.%Y'),
+            'positions': positions,
+            'total_quantity': sum(position['quantity'] for position in positions),
+            'total_price': sum(position['price'] for position in positions)}
+
+
+def render_implementation(data: dict, catalog) -> bytes:
+    """XML документа в кодировке из его заголовка. Символы вне cp1251 записываются ссылками &#...;"""
+    xml_content = implementation_template.render(implementation_context(data, catalog))
+    return xml_content.encode('cp1251', errors='xmlcharrefreplace')
+
+
+def implementation_attachment(data: dict, catalog) -> dict:
+    """Вложение для СБИС.ЗаписатьДокумент. Имя файла уникально для каждого документа."""
+    file_name = f"{imp_filepath.stem}_{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}{imp_filepath.suffix}"
+    return {'Имя': file_name,
+            'ДвоичныеДанные': base64.b64encode(render_implementation(data, catalog)).decode('ascii')}
+
+
+if __name__ == "__main__":
+    import time
+
+    from utils.catalog import Catalog, CatalogItem, MATTRESS, OTHER
+
+    catalog = Catalog([*(CatalogItem.create(f'Матрас "Модель {number}" 160/200', 1000 + number, f'М-{number}',
+                                            25000, MATTRESS, '160/200/20') for number in range(100)),
+                       *(CatalogItem.create(f'Допник {number}', 5000 + number, f'Д-{number}', 500, OTHER)
+                         for number in range(100))])
+    order = {'organization': 'ООО "Ромашка"',
+             'organization_data': json.dumps({'data': {'inn': '2309000000', 'kpp': '230901001'},
+                                              'address_data': {'value': 'г. Краснодар'}}),
+             'deliveryDate': '2024-06-01',
+             'mattresses': [{'name': f'Матрас "Модель {number}" 160/200', 'price': 25000.0, 'quantity': 2}
+                            for number in range(100)],
+             'additionalItems': [{'name': f'Допник {number}', 'price': '500', 'quantity': 1}
+                                 for number in range(100)]}
+
+    documents = 200
+    started = time.perf_counter()
+    for _ in range(documents):
+        attachment = implementation_attachment(order, catalog)
+    elapsed = time.perf_counter() - started
+    print(f"{documents} документов по {len(order['mattresses']) + len(order['additionalItems'])} позиций: "
+          f"{elapsed:.2f} с, {documents / elapsed:.0f} документов/с, "
+          f"{len(attachment['ДвоичныеДанные']) / 1024:.0f} КБ base64 на документ")
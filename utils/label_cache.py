@@ -0,0 +1,135 @@
+"""Чёрно-белые копии этикеток из static/labels, готовые к печати.
+
+Этикетки в цветных PDF, а на ЧБ термопринтере картинки печатаются чёрными квадратами,
+поэтому перед печатью страницы переводятся в оттенки серого. Файлы этикеток не меняются
+от печати к печати, так что перевод делается один раз: копия лежит в label_cache_dir
+под именем из хэша содержимого исходного PDF. Если PDF в static/labels заменили, у него
+другой хэш, и при следующей печати или прогреве появится новая копия, а старая удалится.
+
+Перевод в оттенки серого: Aspose, если установлен (Windows), иначе Ghostscript.
+
+Прогреть кэш вручную: python -m utils.label_cache
+"""
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+from pathlib import Path
+
+from utils.tools import config
+
+printing_conf = config.get('printing', {})
+labels_dir = Path(printing_conf.get('labels_dir', 'static/labels'))
+label_cache_dir = Path(printing_conf.get('label_cache_dir', 'cash/labels_gray'))
+ghostscript_command = printing_conf.get('ghostscript_command', 'gs')
+command_timeout = printing_conf.get('command_timeout', 60)
+
+
+def convert_with_aspose(source: Path, target: Path):
+    import aspose.pdf as ap  # из aspose-pdf
+
+    document = ap.Document(str(source))
+    strategy = ap.RgbToDeviceGrayConversionStrategy()
+    for page in document.pages:
+        strategy.convert(page)
+    document.save(str(target))
+
+
+def convert_with_ghostscript(source: Path, target: Path):
+    subprocess.run([ghostscript_command, '-q', '-dNOPAUSE', '-dBATCH', '-dSAFER', '-sDEVICE=pdfwrite',
+                    '-sColorConversionStrategy=Gray', '-dProcessColorModel=/DeviceGray',
+                    f'-sOutputFile={target}', str(source)],
+                   check=True, capture_output=True, timeout=command_timeout)
+
+
+def convert_to_grayscale(source: Path, target: Path):
+    try:
+        import aspose.pdf  # noqa: F401
+    except ImportError:
+        convert_with_ghostscript(source, target)
+    else:
+        convert_with_aspose(source, target)
+
+
+class LabelCache:
+    """Кэш ЧБ этикеток по артикулу. Хэш файла пересчитывается, только когда у него
+    поменялись время изменения или размер, поэтому печать из кэша - это проверка stat и путь к файлу."""
+
+    def __init__(self, source_dir: Path = labels_dir, cache_dir: Path = label_cache_dir, convert=convert_to_grayscale):
+        self.source_dir = Path(source_dir)
+        self.cache_dir = Path(cache_dir)
+        self.convert = convert
+        self._digests = {}  # путь -> ((mtime_ns, size), хэш содержимого)
+        self._locks = {}  # хэш -> блокировка: разные этикетки переводятся параллельно, одна и та же - один раз
+        self._locks_guard = threading.Lock()
+
+    def source_path(self, article: str) -> Path:
+        return self.source_dir / f"{article}.pdf"
+
+    def digest(self, source: Path) -> str:
+        stat = source.stat()
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._digests.get(source)
+        if cached and cached[0] == signature:
+            return cached[1]
+        digest = hashlib.sha256(source.read_bytes()).hexdigest()
+        self._digests[source] = (signature, digest)
+        return digest
+
+    def cached_path(self, digest: str) -> Path:
+        return self.cache_dir / f"{digest}.pdf"
+
+    def prepare(self, source: Path) -> Path:
+        """ЧБ копия файла этикетки. Переводится, только если копии с таким хэшем ещё нет."""
+        target = self.cached_path(self.digest(source))
+        if target.exists():
+            return target
+
+        with self._locks_guard:
+            lock = self._locks.setdefault(target.name, threading.Lock())
+        with lock:
+            if target.exists():
+                return target
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # Пишем во временный файл: процессы Streamlit и FastAPI могут переводить одну этикетку одновременно
+            tmp_path = target.with_suffix(f'.{os.getpid()}.tmp')
+            try:
+                self.convert(source, tmp_path)
+                tmp_path.replace(target)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+            logging.info(f"Этикетка {source.name} переведена в оттенки серого")
+            return target
+
+    def get(self, article: str) -> Path:
+        """Файл этикетки артикула, готовый к печати. FileNotFoundError, если этикетки нет."""
+        return self.prepare(self.source_path(article))
+
+    def warm(self) -> int:
+        """Готовит ЧБ копии всех этикеток и удаляет копии заменённых файлов. Возвращает число этикеток."""
+        actual = set()
+        for source in sorted(self.source_dir.glob('*.pdf')):
+            try:
+                actual.add(self.prepare(source).name)
+            except Exception as e:
+                logging.error(f"Не удалось подготовить этикетку {source.name}: {e}")
+
+        if self.cache_dir.exists():
+            for stale in self.cache_dir.glob('*.pdf'):
+                if stale.name not in actual:
+                    stale.unlink(missing_ok=True)
+        logging.info(f"Кэш этикеток готов: {len(actual)} шт.")
+        return len(actual)
+
+
+label_cache = LabelCache()
+
+
+if __name__ == "__main__":
+    import time
+
+    logging.basicConfig(level=logging.INFO)
+    started = time.perf_counter()
+    count = label_cache.warm()
+    print(f"Этикеток в кэше: {count}, {time.perf_counter() - started:.2f} с")
@@ -0,0 +1,97 @@
+"""Размеры, типы тканей и длина боковины матраса, хранящиеся в mattress_requests.
+
+Поля считаются один раз: при записи заявки (create_mattress_row) и при правке размера
+или тканей бригадиром (utils/task_edits.py). Страницы нарезки и заготовки читают
+готовые числа и могут сортировать и считать по ним прямо в SQL.
+
+Длина боковины и типы тканей зависят от [fabric_corrections] в app_config.toml.
+Отпечаток коррекций хранится в app_settings; если при запуске он не совпал,
+поля пересчитываются для всех строк.
+
+Пересчитать вручную, например после правки данных в обход приложения:
+python -m utils.mattress_fields
+"""
+import hashlib
+import json
+import logging
+
+import pandas as pd
+from sqlalchemy import select, update, values, column, cast, Integer, text
+from sqlalchemy.dialects.postgresql import insert
+
+from utils.models import MattressRequest, AppSetting
+from utils.tools import fabric_corrections, derived_frame, DERIVED_COLUMNS
+
+# Произвольный ключ pg_advisory_xact_lock, чтобы пересчёт не запускался из двух процессов сразу
+RECOMPUTE_LOCK_KEY = 72_410_002
+FINGERPRINT_KEY = 'fabric_corrections'
+BATCH_SIZE = 2000
+
+tasks_table = MattressRequest.__table__
+
+
+def corrections_fingerprint() -> str:
+    """Отпечаток [fabric_corrections]. Порядок ключей важен: при нескольких совпадениях побеждает первый."""
+    return hashlib.sha1(json.dumps(list(fabric_corrections.items()), ensure_ascii=False).encode()).hexdigest()
+
+
+def recompute_batch(connection, after_id: int, batch_size: int = BATCH_SIZE) -> pd.Index:
+    """Пересчитывает поля для batch_size строк с id больше after_id одним UPDATE ... FROM (VALUES ...).
+    Возвращает id обработанных строк, пустой индекс - строк больше нет."""
+    tasks = pd.read_sql(select(tasks_table.c.id, tasks_table.c.size, tasks_table.c.base_fabric,
+                               tasks_table.c.side_fabric)
+                        .where(tasks_table.c.id > after_id)
+                        .order_by(tasks_table.c.id)
+                        .limit(batch_size),
+                        connection, index_col='id')
+    if tasks.empty:
+        return tasks.index
+
+    frame = derived_frame(tasks)
+    rows = [(int(task_id), *(value.item() if hasattr(value, 'item') else value for value in row))
+            for task_id, row in zip(frame.index, frame.itertuples(index=False))]
+    derived = values(column('id', Integer),
+                     *(column(name, tasks_table.c[name].type) for name in DERIVED_COLUMNS),
+                     name='derived').data(rows)
+    # Версия строки не меняется: данные, которые правит бригадир, остаются прежними
+    connection.execute(update(tasks_table)
+                       .where(tasks_table.c.id == cast(derived.c.id, Integer))
+                       .values({name: cast(derived.c[name], tasks_table.c[name].type) for name in DERIVED_COLUMNS}))
+    return tasks.index
+
+
+def recompute_all(connection) -> int:
+    """Пересчитывает поля всех матрасов и запоминает отпечаток коррекций. Возвращает число строк."""
+    total, last_id = 0, 0
+    while len(task_ids := recompute_batch(connection, last_id)):
+        total += len(task_ids)
+        last_id = int(task_ids[-1])
+    fingerprint = corrections_fingerprint()
+    connection.execute(insert(AppSetting)
+                       .values(key=FINGERPRINT_KEY, value=fingerprint)
+                       .on_conflict_do_update(index_elements=[AppSetting.key], set_={'value': fingerprint}))
+    return total
+
+
+def sync_mattress_fields(engine, force: bool = False) -> int | None:
+    """Пересчитывает поля, если [fabric_corrections] поменялись с прошлого пересчёта.
+    Возвращает число пересчитанных строк или None, если пересчёт не понадобился."""
+    with engine.begin() as connection:
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': RECOMPUTE_LOCK_KEY})
+        stored = connection.execute(select(AppSetting.value)
+                                    .where(AppSetting.key == FINGERPRINT_KEY)).scalar_one_or_none()
+        if not force and stored == corrections_fingerprint():
+            return None
+        logging.info("Коррекции тканей изменились, пересчитываем размеры и боковины матрасов")
+        total = recompute_all(connection)
+        logging.info(f"Пересчитано матрасов: {total}")
+        return total
+
+
+if __name__ == "__main__":
+    from utils.db_connector import engine
+    from utils.migrations import migrate
+
+    logging.basicConfig(level=logging.INFO)
+    migrate(engine)
+    print(f"Пересчитано матрасов: {sync_mattress_fields(engine, force=True)}")
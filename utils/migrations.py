@@ -0,0 +1,216 @@
+"""Версионированные миграции схемы БД.
+
+Применённые версии хранятся в таблице schema_migrations. Миграции выполняются по порядку
+в одной транзакции под advisory-блокировкой, поэтому одновременный запуск из нескольких
+процессов безопасен, а упавшая миграция не оставляет схему наполовину изменённой.
+Новая миграция добавляется в конец MIGRATIONS со следующим номером, старые не меняются.
+
+Запуск: python -m utils.migrations
+"""
+import logging
+
+from sqlalchemy import text
+
+from utils.employee_roles import backfill_employee_roles
+from utils.models import MattressRequest, EmployeeTask, OutboxMessage, AppSetting, EmployeeRole, TaskChange, \
+    TASK_CHANGES_DDL
+
+# Произвольный ключ pg_advisory_xact_lock, общий для всех процессов приложения
+MIGRATIONS_LOCK_KEY = 72_410_001
+
+
+def create_indexes(table, *names):
+    """Шаг миграции: создаёт индексы таблицы, описанные в models.py, если их ещё нет."""
+    def step(connection):
+        for index in table.indexes:
+            if index.name in names:
+                index.create(connection, checkfirst=True)
+    return step
+
+
+def create_tables(*tables):
+    """Шаг миграции: создаёт таблицы, описанные в models.py, если их ещё нет."""
+    def step(connection):
+        for table in tables:
+            table.create(connection, checkfirst=True)
+    return step
+
+
+# Схема на момент появления миграций. Не меняется вместе с models.py: всё, что добавлено позже,
+# описывают следующие миграции. IF NOT EXISTS - для баз, созданных до таблицы schema_migrations.
+# Счётчик task_versions из той схемы не создаётся, его заменила миграция 7
+BASELINE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS employees (
+        id serial PRIMARY KEY,
+        is_on_shift boolean,
+        name varchar,
+        position varchar,
+        barcode varchar
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS orders (
+        id serial PRIMARY KEY,
+        organization varchar,
+        delivery_type varchar,
+        contact varchar,
+        address varchar,
+        region varchar,
+        deadline date,
+        created date
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS mattress_requests (
+        id serial PRIMARY KEY,
+        high_priority boolean,
+        article varchar,
+        size varchar,
+        base_fabric varchar,
+        side_fabric varchar,
+        springs varchar,
+        photo varchar,
+        components_is_done boolean,
+        fabric_is_done boolean,
+        gluing_is_done boolean,
+        sewing_is_done boolean,
+        packing_is_done boolean,
+        comment varchar,
+        history varchar,
+        attributes varchar,
+        created date,
+        order_id integer REFERENCES orders (id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS employee_tasks (
+        id serial PRIMARY KEY,
+        employee_id integer REFERENCES employees (id),
+        task_id integer REFERENCES mattress_requests (id),
+        endpoint varchar,
+        timestamp timestamp
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS task_events (
+        id bigserial PRIMARY KEY,
+        task_id integer NOT NULL REFERENCES mattress_requests (id) ON DELETE CASCADE,
+        stage varchar NOT NULL,
+        employee_id integer REFERENCES employees (id) ON DELETE SET NULL,
+        employee_name varchar,
+        action varchar NOT NULL,
+        timestamp timestamp NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_task_events_task_id_timestamp ON task_events (task_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_task_events_stage_timestamp ON task_events (stage, timestamp)",
+    """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id serial PRIMARY KEY,
+        kind varchar,
+        payload json,
+        status varchar,
+        attempts integer,
+        last_error varchar,
+        next_attempt_at timestamp,
+        created timestamp,
+        sent timestamp
+    )
+    """,
+]
+
+
+# (версия, описание, шаги). Шаг - SQL-строка или функция, принимающая соединение
+MIGRATIONS = [
+    (1, 'Базовая схема', BASELINE_SCHEMA),
+    (2, 'Версия строки матраса для оптимистичной блокировки', [
+        "ALTER TABLE mattress_requests ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1",
+    ]),
+    (3, 'Частичные индексы очередей рабочих мест и outbox', [
+        create_indexes(MattressRequest.__table__,
+                       'ix_mattress_requests_order_id',
+                       'ix_mattress_requests_components_queue',
+                       'ix_mattress_requests_cutting_queue',
+                       'ix_mattress_requests_gluing_queue',
+                       'ix_mattress_requests_sewing_queue',
+                       'ix_mattress_requests_packing_queue'),
+        create_indexes(EmployeeTask.__table__, 'ix_employee_tasks_employee_endpoint'),
+        create_indexes(OutboxMessage.__table__, 'ix_outbox_pending'),
+    ]),
+    (4, 'Матрас бронируется на рабочем месте только один раз', [
+        # Из задвоенных броней остаётся самая ранняя
+        """
+        DELETE FROM employee_tasks duplicate
+        USING employee_tasks original
+        WHERE duplicate.task_id = original.task_id
+          AND duplicate.endpoint = original.endpoint
+          AND duplicate.id > original.id
+        """,
+        create_indexes(EmployeeTask.__table__, 'uq_employee_tasks_task_endpoint'),
+    ]),
+    (5, 'Разобранные размеры, типы тканей и длина боковины матраса', [
+        "ALTER TABLE mattress_requests ADD COLUMN IF NOT EXISTS length integer",
+        "ALTER TABLE mattress_requests ADD COLUMN IF NOT EXISTS width integer",
+        "ALTER TABLE mattress_requests ADD COLUMN IF NOT EXISTS height integer",
+        "ALTER TABLE mattress_requests ADD COLUMN IF NOT EXISTS base_fabric_type varchar",
+        "ALTER TABLE mattress_requests ADD COLUMN IF NOT EXISTS side_fabric_type varchar",
+        "ALTER TABLE mattress_requests ADD COLUMN IF NOT EXISTS side_length integer",
+        # Значения для существующих строк заполнит utils.mattress_fields.sync_mattress_fields
+        # при запуске: отпечатка коррекций тканей в app_settings ещё нет
+        create_tables(AppSetting.__table__),
+    ]),
+    (6, 'Роли сотрудников по рабочим местам вместо текста должности', [
+        create_tables(EmployeeRole.__table__),
+        backfill_employee_roles,
+    ]),
+    (7, 'Журнал изменений нарядов вместо общего счётчика task_versions', [
+        create_tables(TaskChange.__table__),
+        *TASK_CHANGES_DDL,
+        "DROP TRIGGER IF EXISTS mattress_requests_bump_version ON mattress_requests",
+        "DROP TRIGGER IF EXISTS orders_bump_version ON orders",
+        "DROP FUNCTION IF EXISTS bump_task_version()",
+        "DROP TABLE IF EXISTS task_versions",
+    ]),
+]
+
+
+def applied_versions(connection) -> set:
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version integer PRIMARY KEY,
+            description varchar NOT NULL,
+            applied timestamp NOT NULL DEFAULT now()
+        )
+    """))
+    return set(connection.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+
+def migrate(engine) -> list:
+    """Применяет недостающие миграции. Возвращает номера применённых версий."""
+    applied = []
+    with engine.begin() as connection:
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': MIGRATIONS_LOCK_KEY})
+        done = applied_versions(connection)
+        for version, description, steps in MIGRATIONS:
+            if version in done:
+                continue
+            logging.info(f"Миграция {version}: {description}")
+            for step in steps:
+                if callable(step):
+                    step(connection)
+                else:
+                    connection.execute(text(step))
+            connection.execute(text("INSERT INTO schema_migrations (version, description) "
+                                    "VALUES (:version, :description)"),
+                               {'version': version, 'description': description})
+            applied.append(version)
+    return applied
+
+
+if __name__ == "__main__":
+    from utils.db_connector import engine
+
+    logging.basicConfig(level=logging.INFO)
+    versions = migrate(engine)
+    print(f"Применены миграции: {versions}" if versions else "Схема БД актуальна")
@@ -1,5 +1,6 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Date, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, Date, Boolean, ForeignKey, DateTime, JSON, DDL, Index, \
+    event, text
 from sqlalchemy.orm import relationship, declarative_base
 
 Base = declarative_base()
@@ -11,9 +12,25 @@ class Employee(Base):
     id = Column(Integer, primary_key=True)
     is_on_shift = Column(Boolean, default=False)
     name = Column(String)
+    # Роли свободным текстом, как их вписывали до таблицы employee_roles. Больше не используется
     position = Column(String)
     barcode = Column(String)
 
+    roles = relationship('EmployeeRole', cascade='all, delete-orphan', lazy='selectin')
+
+
+class EmployeeRole(Base):
+    """Рабочее место, на котором сотруднику можно работать. station - ключ из STATION_ROLES."""
+    __tablename__ = 'employee_roles'
+
+    employee_id: Column[int] = Column(Integer, ForeignKey('employees.id', ondelete='CASCADE'), primary_key=True)
+    station: Column[str] = Column(String, primary_key=True)
+
+    __table_args__ = (
+        # Сотрудники рабочего места. Проверка роли одного сотрудника идёт по первичному ключу
+        Index('ix_employee_roles_station', 'station', 'employee_id'),
+    )
+
 
 class EmployeeTask(Base):
     __tablename__ = 'employee_tasks'
@@ -27,6 +44,13 @@ class EmployeeTask(Base):
     employee = relationship('Employee')
     task = relationship('MattressRequest')
 
+    __table_args__ = (
+        # Текущая задача сотрудника на рабочем месте
+        Index('ix_employee_tasks_employee_endpoint', 'employee_id', 'endpoint'),
+        # Матрас бронируется на рабочем месте только один раз
+        Index('uq_employee_tasks_task_endpoint', 'task_id', 'endpoint', unique=True),
+    )
+
 
 class MattressRequest(Base):
     __tablename__ = 'mattress_requests'
@@ -45,13 +69,65 @@ class MattressRequest(Base):
     sewing_is_done = Column(Boolean, default=False)
     packing_is_done = Column(Boolean, default=False)
     comment = Column(String, default='')
-    history = Column(String, default='')
+    history = Column(String, default='')  # Старая текстовая история. Новые действия пишутся в task_events
     attributes = Column(String)
     created = Column(Date)
+    # Разобранные size, base_fabric и side_fabric (tools.derived_fields). Пишутся вместе с ними,
+    # при смене [fabric_corrections] пересчитываются utils/mattress_fields.py
+    length = Column(Integer)
+    width = Column(Integer)
+    height = Column(Integer)
+    base_fabric_type = Column(String)
+    side_fabric_type = Column(String)
+    side_length = Column(Integer)  # Длина отреза боковины с коррекцией по ткани, в сантиметрах
+    # Версия строки для оптимистичной блокировки. ORM увеличивает её при каждом UPDATE
+    # и не даёт перезаписать строку, которую успели изменить в другом месте
+    version = Column(Integer, default=1, nullable=False)
 
     order_id = Column(Integer, ForeignKey('orders.id'))
     order = relationship("Order", back_populates="mattress_requests")
 
+    __mapper_args__ = {'version_id_col': version}
+
+    # Частичные индексы очередей рабочих мест. Условия совпадают с фильтрами страниц и
+    # station_queue_conditions, в индекс попадают только незавершённые наряды, поэтому он
+    # остаётся маленьким, сколько бы выполненных матрасов ни накопилось в таблице
+    __table_args__ = (
+        Index('ix_mattress_requests_order_id', 'order_id'),
+        Index('ix_mattress_requests_components_queue', 'id',
+              postgresql_where=text('components_is_done = false')),
+        Index('ix_mattress_requests_cutting_queue', 'id',
+              postgresql_where=text('fabric_is_done = false')),
+        Index('ix_mattress_requests_gluing_queue', 'id',
+              postgresql_where=text('components_is_done = true AND gluing_is_done = false')),
+        Index('ix_mattress_requests_sewing_queue', 'id',
+              postgresql_where=text('components_is_done = true AND fabric_is_done = true '
+                                    'AND gluing_is_done = true AND sewing_is_done = false')),
+        Index('ix_mattress_requests_packing_queue', 'order_id', 'id',
+              postgresql_where=text('components_is_done = true AND fabric_is_done = true '
+                                    'AND gluing_is_done = true AND sewing_is_done = true '
+                                    'AND packing_is_done = false')),
+    )
+
+
+class TaskEvent(Base):
+    """Журнал действий с нарядами: кто, на каком этапе и что сделал.
+    Строки только добавляются, поэтому запись не растёт вместе с историей наряда."""
+    __tablename__ = 'task_events'
+
+    id = Column(BigInteger, primary_key=True)
+    task_id = Column(Integer, ForeignKey('mattress_requests.id', ondelete='CASCADE'), nullable=False)
+    stage = Column(String, nullable=False)  # Название страницы (процесса): Сборка, Шитьё, Упаковка...
+    employee_id = Column(Integer, ForeignKey('employees.id', ondelete='SET NULL'))
+    employee_name = Column(String)  # Имя на момент события, сотрудника могут удалить
+    action = Column(String, nullable=False)  # Отметка, Готово
+    timestamp = Column(DateTime, default=datetime.now, nullable=False)
+
+    __table_args__ = (
+        Index('ix_task_events_task_id_timestamp', 'task_id', 'timestamp'),
+        Index('ix_task_events_stage_timestamp', 'stage', 'timestamp'),
+    )
+
 
 class Order(Base):
     __tablename__ = 'orders'
@@ -66,4 +142,79 @@ class Order(Base):
     created = Column(Date)
 
     # Отношение "один-ко-многим" к MattressRequest
-    mattress_requests = relationship("MattressRequest", back_populates="order")
\ No newline at end of file
+    mattress_requests = relationship("MattressRequest", back_populates="order")
+
+
+class OutboxMessage(Base):
+    """Исходящее сообщение во внешний сервис (Telegram, СБИС).
+    Пишется в одной транзакции с заказом, доставляется фоновым диспетчером."""
+    __tablename__ = 'outbox'
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String)  # Тип доставки: telegram, sbis_implementation
+    payload = Column(JSON)
+    status = Column(String, default='pending')  # pending, sent, failed
+    attempts = Column(Integer, default=0)
+    last_error = Column(String, default='')
+    next_attempt_at = Column(DateTime, default=datetime.now)
+    created = Column(DateTime, default=datetime.now)
+    sent = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_outbox_pending', 'next_attempt_at', postgresql_where=text("status = 'pending'")),
+    )
+
+
+class AppSetting(Base):
+    """Служебные значения приложения, которые нужно помнить между запусками"""
+    __tablename__ = 'app_settings'
+
+    key = Column(String, primary_key=True)
+    value = Column(String)
+
+
+class TaskChange(Base):
+    """Журнал изменений нарядов. Триггеры добавляют строку на каждый запрос, пишущий в mattress_requests
+    и orders, а страницы Streamlit по нему решают, нужно ли перечитывать таблицу нарядов.
+
+    Вставки разных транзакций не ждут друг друга, поэтому пишущие транзакции не выстраиваются в очередь.
+    Версия - (max(id), count(*)): её видно только после коммита изменения, и она сдвигается, даже
+    если транзакция с меньшим id закоммитилась позже. Старые строки удаляет сам триггер (TASK_CHANGES_DDL)."""
+    __tablename__ = 'task_changes'
+
+    id = Column(BigInteger, primary_key=True)
+
+
+# Функция и триггеры журнала. Ставятся после создания всех таблиц, так как ссылаются на mattress_requests
+# и orders. Синтаксис EXECUTE FUNCTION требует PostgreSQL 11 или новее
+TASK_CHANGES_DDL = (
+    """
+    CREATE OR REPLACE FUNCTION record_task_change() RETURNS trigger AS $$
+    DECLARE
+        change_id bigint;
+    BEGIN
+        INSERT INTO task_changes DEFAULT VALUES RETURNING id INTO change_id;
+        -- Раз в 1000 изменений журнал укорачивается. Строки незакоммиченных транзакций не удаляются
+        IF change_id % 1000 = 0 THEN
+            DELETE FROM task_changes WHERE id <= change_id - 1000;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS mattress_requests_task_change ON mattress_requests",
+    """
+    CREATE TRIGGER mattress_requests_task_change
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON mattress_requests
+    FOR EACH STATEMENT EXECUTE FUNCTION record_task_change()
+    """,
+    "DROP TRIGGER IF EXISTS orders_task_change ON orders",
+    """
+    CREATE TRIGGER orders_task_change
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON orders
+    FOR EACH STATEMENT EXECUTE FUNCTION record_task_change()
+    """,
+)
+
+for ddl in TASK_CHANGES_DDL:
+    event.listen(Base.metadata, 'after_create', DDL(ddl).execute_if(dialect='postgresql'))
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+from pathlib import Path
+
+from utils.catalog import Catalog
+from utils.resilience import CircuitOpenError
+from utils.tools import config
+
+sbis_conf = config.get('sbis')
+refresh_interval = sbis_conf.get('nomenclature_refresh_interval', 600)
+full_refresh_interval = sbis_conf.get('nomenclature_full_refresh_interval', 86400)
+wait_timeout = sbis_conf.get('nomenclature_wait_timeout', 10)
+snapshot_filepath = Path(sbis_conf.get('nomenclature_snapshot_filepath', 'cash/nomenclatures.json'))
+
+
+class NomenclatureCache:
+    """Кэш номенклатуры из СБИС.
+
+    Каталог отдаётся из памяти сразу, даже если он устарел, а свежая версия
+    подтягивается фоновой задачей. Последний удачный каталог сохраняется на диск,
+    поэтому после перезапуска форма заявок открывается без обращения к СБИС.
+
+    Если задан incremental_loader, между полными выгрузками раз в full_interval
+    секунд подтягиваются только изменения: incremental_loader(каталог, datetime
+    прошлого обновления) возвращает новый каталог целиком.
+
+    Пока СБИС недоступен, отдаётся последний удачный каталог: обновление пробуется
+    снова, но запросы формы его не ждут."""
+
+    def __init__(self, loader, snapshot_path: Path = snapshot_filepath, interval: int = refresh_interval,
+                 incremental_loader=None, full_interval: int = full_refresh_interval,
+                 wait_timeout: float = wait_timeout):
+        self.loader = loader  # Синхронная функция, возвращающая Catalog
+        self.incremental_loader = incremental_loader
+        self.snapshot_path = Path(snapshot_path)
+        self.interval = interval
+        self.full_interval = full_interval
+        self.wait_timeout = wait_timeout
+        self.data = Catalog()
+        self.updated = 0.0
+        self.full_updated = 0.0
+        self._refresh_task = None
+        self._tasks = set()
+        self.load_snapshot()
+
+    @property
+    def is_stale(self) -> bool:
+        return time.time() - self.updated > self.interval
+
+    def load_snapshot(self):
+        """Загружает каталог из снимка на диске, если он есть."""
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as file:
+                snapshot = json.load(file)
+            self.data = Catalog.from_records(snapshot['data'])
+            self.updated = snapshot['updated']
+            self.full_updated = snapshot.get('full_updated', self.updated)
+            logging.info(f"Номенклатура загружена из снимка {self.snapshot_path}: {len(self.data)} позиций")
+        except FileNotFoundError:
+            logging.info("Снимка номенклатуры нет, каталог будет загружен из СБИС")
+        except (OSError, KeyError, AttributeError, json.JSONDecodeError):
+            logging.warning(f"Не удалось прочитать снимок номенклатуры {self.snapshot_path}", exc_info=True)
+
+    def save_snapshot(self):
+        """Сохраняет каталог на диск. Запись идёт через временный файл, чтобы снимок не бился при падении."""
+        self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.snapshot_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'updated': self.updated, 'full_updated': self.full_updated, 'data': self.data.to_records()},
+                      file, ensure_ascii=False)
+        tmp_path.replace(self.snapshot_path)
+
+    def load(self) -> tuple:
+        """Выбирает полную или частичную выгрузку. Возвращает (каталог, была ли выгрузка полной)."""
+        started = time.time()
+        if self.incremental_loader and self.data and started - self.full_updated < self.full_interval:
+            return self.incremental_loader(self.data, datetime.fromtimestamp(self.updated)), False
+        return self.loader(), True
+
+    async def refresh(self):
+        """Загружает номенклатуру из СБИС в отдельном потоке, не блокируя цикл событий.
+        Если СБИС недоступен или вернул пустой список, остаётся прежний каталог.
+        Напрямую не вызывается: одновременные обновления объединяет revalidate()."""
+        started = time.time()
+        try:
+            data, full = await asyncio.to_thread(self.load)
+        except CircuitOpenError as e:
+            logging.warning(f"Номенклатура не обновлена, отдаём каталог из кэша: {e}")
+            return
+        except Exception as e:
+            logging.error(f"Ошибка обновления номенклатуры: {e}", exc_info=True)
+            return
+
+        if not data:
+            logging.warning("СБИС вернул пустую номенклатуру, оставляем прежний каталог")
+            return
+
+        # Каталог подменяется одной ссылкой: запросы видят либо старый, либо новый целиком
+        self.data = data
+        # Время начала выгрузки: изменения, сделанные во время неё, попадут в следующую
+        self.updated = started
+        if full:
+            self.full_updated = started
+        logging.info(f"Номенклатура обновлена{'' if full else ' частично'}: {len(data)} позиций")
+
+        try:
+            await asyncio.to_thread(self.save_snapshot)
+        except OSError:
+            logging.error("Не удалось сохранить снимок номенклатуры", exc_info=True)
+
+    def revalidate(self) -> asyncio.Task:
+        """Запускает обновление в фоне. Если обновление уже идёт, второй раз в СБИС
+        не ходим и возвращаем уже запущенную задачу."""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.refresh())
+            self._tasks.add(self._refresh_task)
+            self._refresh_task.add_done_callback(self._tasks.discard)
+        return self._refresh_task
+
+    async def get(self) -> Catalog:
+        """Возвращает каталог. Ждать СБИС приходится, только если каталога ещё нет совсем,
+        и не дольше wait_timeout секунд: загрузка продолжится в фоне, а запрос получит
+        пустой каталог. Устаревший каталог отдаётся сразу и обновляется в фоне."""
+        if not self.data:
+            # asyncio.wait не отменяет задачу по таймауту: загрузка продолжится для следующих запросов
+            await asyncio.wait({self.revalidate()}, timeout=self.wait_timeout)
+        elif self.is_stale:
+            self.revalidate()
+        return self.data
+
+    def status(self) -> dict:
+        """Состояние каталога для мониторинга."""
+        return {'items': len(self.data),
+                'updated': datetime.fromtimestamp(self.updated).isoformat() if self.updated else None,
+                'stale': self.is_stale,
+                'refreshing': self._refresh_task is not None and not self._refresh_task.done()}
+
+    async def run(self):
+        """Цикл фонового обновления с интервалом из app_config.toml."""
+        while True:
+            if self.is_stale:
+                await self.revalidate()
+            # Спим до момента, когда каталог устареет. Если СБИС не ответил, пробуем снова через минуту
+            delay = self.updated + self.interval - time.time()
+            await asyncio.sleep(delay if delay > 0 else min(self.interval, 60))
+
+    def start(self):
+        task = asyncio.create_task(self.run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,160 @@
+"""Документы для печати на упаковке: гарантийные талоны и этикетки.
+
+Талоны заполняются по шаблону static/guarantee.xlsx. Несколько талонов собираются в одну
+книгу: шаблон повторяется на листе друг под другом с разрывом страницы, так что принтер
+получает одно задание, а каждый талон печатается на своей странице.
+
+Этикетки всего заказа склеиваются в один PDF из ЧБ копий utils/label_cache.py.
+Копии разных артикулов готовятся параллельно.
+
+Замер для заказа из 50 матрасов: python -m utils.order_printing
+"""
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+
+from openpyxl.drawing.image import Image
+from openpyxl.reader.excel import load_workbook
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.cell import coordinate_from_string, column_index_from_string
+from openpyxl.worksheet.pagebreak import Break
+from pypdf import PdfReader, PdfWriter
+
+from utils.label_cache import label_cache
+from utils.tools import config
+
+printing_conf = config.get('printing', {})
+talon_template_path = Path(printing_conf.get('talon_template', 'static/guarantee.xlsx'))
+label_workers = printing_conf.get('label_workers', 4)
+
+
+@dataclass(frozen=True)
+class Talon:
+    article: str
+    springs: str
+    size: str
+    deadline: str  # Уже в виде строки ДД.ММ.ГГГГ
+    address: str
+
+    def cells(self) -> dict:
+        """Ячейки шаблона и их значения"""
+        return {'B4': "Матрас АРТ.№ " + self.article + '  |  ПБ: ' + self.springs,
+                'B6': self.size,
+                'B8': self.deadline,
+                'B16': self.address}
+
+
+def template_images(ws) -> list:
+    """Картинки листа вместе с их данными. openpyxl закрывает файл картинки после первого
+    чтения, поэтому данные читаются один раз и картинке возвращается свежая копия."""
+    images = []
+    for image in ws._images:
+        data = image._data()
+        image.ref = BytesIO(data)
+        images.append((image, data))
+    return images
+
+
+def copy_block(ws, height: int, offset: int, images: list):
+    """Повторяет первые height строк листа начиная со строки offset + 1: значения, стили,
+    объединённые ячейки, высоту строк и картинки из template_images."""
+    for row in ws.iter_rows(min_row=1, max_row=height):
+        for cell in row:
+            target = ws.cell(row=cell.row + offset, column=cell.column, value=cell.value)
+            if cell.has_style:
+                target._style = copy(cell._style)
+    for merged in list(ws.merged_cells.ranges):
+        if merged.max_row <= height:
+            ws.merge_cells(start_row=merged.min_row + offset, start_column=merged.min_col,
+                           end_row=merged.max_row + offset, end_column=merged.max_col)
+    for row_number in range(1, height + 1):
+        if row_number in ws.row_dimensions:
+            ws.row_dimensions[row_number + offset].height = ws.row_dimensions[row_number].height
+    for image, data in images:
+        anchor = copy(image.anchor)
+        if hasattr(anchor, '_from') and anchor._from.row < height:
+            anchor._from = copy(anchor._from)
+            anchor._from.row += offset
+            if getattr(anchor, 'to', None) is not None:
+                anchor.to = copy(anchor.to)
+                anchor.to.row += offset
+            duplicate = Image(BytesIO(data))
+            duplicate.width, duplicate.height = image.width, image.height
+            duplicate.anchor = anchor
+            ws.add_image(duplicate)
+
+
+def render_talons(work_dir: Path, talons: list, file_name: str) -> Path:
+    """Книга с талонами друг под другом, по талону на страницу. Выполняется в потоке очереди печати."""
+    wb = load_workbook(talon_template_path)
+    ws = wb.active
+    height = ws.max_row
+    images = template_images(ws) if len(talons) > 1 else []
+
+    for number, talon in enumerate(talons):
+        offset = number * height
+        if number:
+            copy_block(ws, height, offset, images)
+            ws.row_breaks.append(Break(id=offset))
+        for coordinate, value in talon.cells().items():
+            column, row = coordinate_from_string(coordinate)
+            ws.cell(row=row + offset, column=column_index_from_string(column), value=value)
+
+    if len(talons) > 1:
+        ws.print_area = f"A1:{get_column_letter(ws.max_column)}{height * len(talons)}"
+
+    document_path = work_dir / file_name
+    wb.save(document_path)
+    return document_path
+
+
+def render_labels(work_dir: Path, articles: list, file_name: str, cache=label_cache,
+                  workers: int = label_workers) -> Path:
+    """Один PDF с этикетками в порядке articles. ЧБ копии различных артикулов готовятся параллельно."""
+    distinct = list(dict.fromkeys(articles))
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(distinct)), 1)) as pool:
+        readers = {article: PdfReader(path) for article, path in zip(distinct, pool.map(cache.get, distinct))}
+
+    writer = PdfWriter()
+    for article in articles:
+        for page in readers[article].pages:
+            writer.add_page(page)
+
+    document_path = work_dir / file_name
+    with open(document_path, 'wb') as file:
+        writer.write(file)
+    return document_path
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    units = 50
+    label_articles = sorted(path.stem for path in label_cache.source_dir.glob('*.pdf'))[:5]
+    if not label_articles:
+        raise SystemExit(f"Нет этикеток в {label_cache.source_dir}")
+    talons = [Talon(article=label_articles[number % len(label_articles)], springs='Независимый',
+                    size='160/200/20', deadline='01.06.2025', address='г. Краснодар, ул. Красная, д. 1')
+              for number in range(units)]
+    articles = [talon.article for talon in talons]
+    label_cache.warm()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_dir = Path(work_dir)
+
+        started = time.perf_counter()
+        for number, talon in enumerate(talons):
+            render_talons(work_dir, [talon], f"talon_{number}.xlsx")
+            label_cache.get(talon.article)
+        single = time.perf_counter() - started
+
+        started = time.perf_counter()
+        render_talons(work_dir, talons, "talons.xlsx")
+        render_labels(work_dir, articles, "labels.pdf")
+        batch = time.perf_counter() - started
+
+    print(f"{units} матрасов по одному: {single:.2f} с, {single / units * 1000:.1f} мс на матрас, {units * 2} заданий")
+    print(f"{units} матрасов одним заказом: {batch:.2f} с, {batch / units * 1000:.1f} мс на матрас, 2 задания")
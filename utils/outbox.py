@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+from utils.models import OutboxMessage
+from utils.tools import config
+
+outbox_conf = config.get('outbox', {})
+poll_interval = outbox_conf.get('poll_interval', 5)
+max_attempts = outbox_conf.get('max_attempts', 8)
+backoff_base = outbox_conf.get('backoff_base', 5)
+backoff_max = outbox_conf.get('backoff_max', 600)
+batch_size = outbox_conf.get('batch_size', 20)
+claim_timeout = outbox_conf.get('claim_timeout', 300)
+
+
+class TerminalDeliveryError(Exception):
+    """Повторять доставку нельзя: сообщение сразу помечается failed и ждёт ручной проверки.
+    Например, внешний сервис мог принять сообщение, а повтор создаст дубликат."""
+
+
+def retry_delay(attempts: int) -> timedelta:
+    """Экспоненциальная задержка перед повтором со случайным разбросом,
+    чтобы сообщения после сбоя не уходили во внешний сервис пачкой."""
+    delay = min(backoff_base * 2 ** (attempts - 1), backoff_max)
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+class OutboxDispatcher:
+    """Фоновая доставка сообщений из таблицы outbox.
+
+    handlers - словарь {тип сообщения: асинхронная функция(payload)}. Если функция
+    выбросила исключение, доставка повторяется с растущей задержкой, а после
+    max_attempts попыток сообщение помечается как failed. TerminalDeliveryError
+    помечает его failed сразу. Функции вызываются
+    вне транзакции с блокировками строк outbox."""
+
+    def __init__(self, session_factory, handlers: dict):
+        self.session_factory = session_factory
+        self.handlers = handlers
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def wake(self):
+        """Будит диспетчер, чтобы новое сообщение ушло сразу, а не по таймеру."""
+        self._wakeup.set()
+
+    async def claim(self) -> list:
+        """Берёт в отправку пачку сообщений, у которых подошло время, короткой транзакцией.
+        Строки выбираются с SKIP LOCKED, а next_attempt_at сдвигается на claim_timeout,
+        так что другие процессы и следующие проходы их не возьмут, пока идёт доставка.
+        Попытка засчитывается сразу: сообщение, на котором процесс падает, не будет повторяться бесконечно.
+        :return: [(id, тип, payload, номер попытки)]"""
+        async with self.session_factory() as session:
+            async with session.begin():
+                result = await session.execute(
+                    select(OutboxMessage)
+                    .where(OutboxMessage.status == 'pending',
+                           OutboxMessage.next_attempt_at <= datetime.now())
+                    .order_by(OutboxMessage.id)
+                    .limit(batch_size)
+                    .with_for_update(skip_locked=True))
+                claimed = []
+                for message in result.scalars().all():
+                    message.attempts += 1
+                    message.next_attempt_at = datetime.now() + timedelta(seconds=claim_timeout)
+                    claimed.append((message.id, message.kind, message.payload, message.attempts))
+        return claimed
+
+    async def deliver(self, message_id: int, kind: str, payload, attempts: int) -> dict:
+        """Отправляет одно сообщение. Возвращает значения полей строки outbox по итогам попытки."""
+        try:
+            handler = self.handlers[kind]
+            await handler(payload)
+        except TerminalDeliveryError as e:
+            logging.error(f"Сообщение outbox {message_id} ({kind}) не доставлено, повтор отменён, "
+                          f"проверьте вручную: {e}")
+            return {'status': 'failed', 'last_error': str(e)}
+        except Exception as e:
+            if attempts >= max_attempts:
+                logging.error(f"Сообщение outbox {message_id} ({kind}) не доставлено "
+                              f"за {attempts} попыток: {e}")
+                return {'status': 'failed', 'last_error': str(e)}
+            next_attempt_at = datetime.now() + retry_delay(attempts)
+            logging.warning(f"Сообщение outbox {message_id} ({kind}) не доставлено, "
+                            f"повтор в {next_attempt_at:%H:%M:%S}: {e}")
+            return {'next_attempt_at': next_attempt_at, 'last_error': str(e)}
+        logging.info(f"Сообщение outbox {message_id} ({kind}) доставлено")
+        return {'status': 'sent', 'sent': datetime.now(), 'last_error': ''}
+
+    async def record(self, message_id: int, values: dict):
+        async with self.session_factory() as session:
+            async with session.begin():
+                await session.execute(update(OutboxMessage).where(OutboxMessage.id == message_id).values(**values))
+
+    async def dispatch_pending(self) -> int:
+        """Доставляет пачку сообщений. Блокировки держатся только на время взятия пачки, результат
+        каждой доставки сохраняется своей транзакцией: если процесс упадёт посреди пачки,
+        уже доставленные сообщения не уйдут повторно, а недоставленные повторятся через claim_timeout."""
+        claimed = await self.claim()
+        for message in claimed:
+            await self.record(message[0], await self.deliver(*message))
+        return len(claimed)
+
+    async def run(self):
+        while True:
+            try:
+                delivered = await self.dispatch_pending()
+            except Exception as e:
+                logging.error(f"Ошибка диспетчера outbox: {e}", exc_info=True)
+                delivered = 0
+
+            if delivered >= batch_size:
+                # Очередь не разобрана до конца, продолжаем без паузы
+                continue
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
@@ -0,0 +1,141 @@
+import base64
+import binascii
+import hashlib
+import logging
+import re
+import uuid
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from utils.tools import config
+
+hardware = config.get('site').get('hardware')
+photos_dir = Path(hardware.get('photos_path', 'cash/photos'))
+thumbnail_size = (320, 320)
+
+DATA_URL_PATTERN = re.compile(r'^data:[\w/+.-]*;base64,(?P<data>.+)$', re.DOTALL)
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def is_photo_digest(value) -> bool:
+    """Проверяет, что в поле photo лежит хэш из хранилища, а не старая base64-строка."""
+    return isinstance(value, str) and bool(DIGEST_PATTERN.match(value))
+
+
+def photo_path(digest: str) -> Path:
+    return photos_dir / digest
+
+
+def thumbnail_path(digest: str) -> Path:
+    return photos_dir / f'{digest}.thumb.jpg'
+
+
+def write_atomic(path: Path, data: bytes):
+    # Своё имя временного файла у каждой записи: одно фото могут сохранять одновременно
+    tmp_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def make_thumbnail(data: bytes) -> bytes:
+    """Уменьшенная копия фото в JPEG для таблиц и плиток."""
+    with Image.open(BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        image.thumbnail(thumbnail_size)
+        buffer = BytesIO()
+        image.save(buffer, format='JPEG', quality=80, optimize=True)
+    return buffer.getvalue()
+
+
+def save_photo(data: bytes) -> str:
+    """Сохраняет фото по SHA-256 содержимого и возвращает хэш.
+    Одинаковые фото хранятся один раз, сколько бы матрасов на них ни ссылалось."""
+    digest = hashlib.sha256(data).hexdigest()
+    if photo_path(digest).exists() and thumbnail_path(digest).exists():
+        return digest
+
+    # Миниатюра заодно проверяет, что это изображение. Пока она не готова, на диск ничего не пишется,
+    # поэтому от битого фото не остаётся оригинала без миниатюры
+    thumbnail = make_thumbnail(data)
+    photos_dir.mkdir(parents=True, exist_ok=True)
+    write_atomic(thumbnail_path(digest), thumbnail)
+    write_atomic(photo_path(digest), data)
+    return digest
+
+
+def save_data_url(data_url: str) -> str:
+    """Принимает фото из формы заявки в виде data URL (data:image/jpeg;base64,...),
+    возвращает хэш сохранённого файла или пустую строку, если фото нет или оно битое."""
+    if not data_url:
+        return ''
+    if is_photo_digest(data_url):
+        return data_url
+
+    match = DATA_URL_PATTERN.match(data_url)
+    if not match:
+        logging.warning("Фото пришло не в формате data URL, пропускаем")
+        return ''
+
+    try:
+        return save_photo(base64.b64decode(match.group('data')))
+    except (binascii.Error, UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as e:
+        logging.error(f"Не удалось сохранить фото: {e}")
+        return ''
+
+
+def photo_media_type(digest: str) -> str:
+    """MIME-тип оригинала. Файлы хранятся без расширения, тип определяется по содержимому."""
+    try:
+        with Image.open(photo_path(digest)) as image:
+            return Image.MIME.get(image.format, 'application/octet-stream')
+    except (UnidentifiedImageError, OSError):
+        return 'application/octet-stream'
+
+
+def photo_url(value: str, thumbnail: bool = True, base_url: str = '') -> str:
+    """Ссылка на фото для страниц. Старые записи с base64 отдаются как есть до миграции."""
+    if not is_photo_digest(value):
+        return value or ''
+    return f"{base_url}/photos/{value}" + ('/thumb' if thumbnail else '')
+
+
+def migrate_base64_photos(batch_size: int = 50) -> int:
+    """Переносит фото из mattress_requests.photo в хранилище, оставляя в строках только хэш.
+    Возвращает количество обновлённых строк."""
+    from sqlalchemy import select, update
+
+    from utils.db_connector import session
+    from utils.models import MattressRequest
+
+    migrated = 0
+    with session() as db:
+        while True:
+            rows = db.execute(select(MattressRequest.id, MattressRequest.photo)
+                              .where(MattressRequest.photo.like('data:%'))
+                              .limit(batch_size)).all()
+            if not rows:
+                break
+
+            # Одно фото раньше копировалось в каждый матрас заказа, сохраняем его один раз
+            digests = {}
+            for task_id, data_url in rows:
+                if data_url not in digests:
+                    digests[data_url] = save_data_url(data_url)
+                db.execute(update(MattressRequest)
+                           .where(MattressRequest.id == task_id)
+                           .values(photo=digests[data_url]))
+            db.commit()
+            migrated += len(rows)
+            logging.info(f"Перенесено фото: {migrated}")
+
+    return migrated
+
+
+if __name__ == "__main__":
+    # Однократная миграция старых записей: python -m utils.photo_store
+    print(f"Фото перенесены в {photos_dir}: {migrate_base64_photos()} строк")
@@ -0,0 +1,191 @@
+"""Проверка планов горячих запросов.
+
+Создаёт отдельную базу {db_name}_plan_check, доводит её до последней миграции, заполняет
+правдоподобными данными (почти все наряды выполнены, в очередях несколько десятков строк)
+и для каждого горячего запроса выполняет EXPLAIN (FORMAT JSON). Проверка падает, если
+в плане есть Seq Scan по таблице, которую запрос должен читать по индексу.
+
+Перебор таблицы запрещается через enable_seqscan = off: если подходящий индекс есть,
+планировщик его выберет даже на маленькой таблице. Без подходящего индекса в плане будет
+Seq Scan или чтение другого индекса целиком с Filter, а ожидаемого индекса в плане не будет.
+Так проверка не зависит от объёма тестовых данных.
+
+Запуск: python -m utils.plan_check (код возврата 1, если планы регрессировали)
+"""
+import json
+import logging
+import sys
+
+from sqlalchemy import create_engine, text, select, func
+from sqlalchemy.dialects import postgresql
+
+from utils.db_connector import db_user, db_password, db_host, db_port, db_name
+from utils.employee_roles import shift_employees_query, has_role_query
+from utils.migrations import migrate
+from utils.models import Order, OutboxMessage
+from utils.task_queries import TASK_COLUMNS, STATION_QUEUES, tasks_query, claim_task_query, reserved_task_query
+
+check_db_name = f"{db_name}_plan_check"
+server_url = f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}"
+
+SEED_SQL = [
+    """
+    INSERT INTO employees (name, position, is_on_shift, barcode)
+    SELECT 'Сотрудник ' || n, 'Сборка Шитьё Упаковка', n % 2 = 0, ''
+    FROM generate_series(1, 50) n
+    """,
+    """
+    INSERT INTO employee_roles (employee_id, station)
+    SELECT id, station FROM employees, unnest(ARRAY['gluing', 'sewing', 'packing']) station
+    """,
+    """
+    INSERT INTO orders (organization, delivery_type, contact, address, region, deadline, created)
+    SELECT 'Организация ' || n, (ARRAY['Самовывоз', 'Город', 'Регионы'])[n % 3 + 1], '', '', '',
+           current_date + n % 30, current_date - n % 365
+    FROM generate_series(1, 20000) n
+    """,
+    # Выполненные матрасы составляют подавляющее большинство, очереди маленькие
+    """
+    INSERT INTO mattress_requests (order_id, high_priority, article, size, base_fabric, side_fabric, comment,
+                                   components_is_done, fabric_is_done, gluing_is_done, sewing_is_done,
+                                   packing_is_done, version)
+    SELECT n % 20000 + 1, n % 97 = 0, 'Артикул ' || n % 40, '160/200/20', 'Жаккард', 'Жаккард', '',
+           n % 400 <> 0, n % 400 <> 1, n % 400 NOT IN (0, 2), n % 400 NOT IN (0, 1, 2, 3),
+           n % 400 NOT IN (0, 1, 2, 3, 4), 1
+    FROM generate_series(1, 100000) n
+    """,
+    """
+    INSERT INTO employee_tasks (employee_id, task_id, endpoint, timestamp)
+    SELECT n, n * 400 + 3, 'sewing', now()
+    FROM generate_series(1, 20) n
+    """,
+    """
+    INSERT INTO outbox (kind, payload, status, attempts, last_error, next_attempt_at, created)
+    SELECT 'telegram', '{}', CASE WHEN n % 100 = 0 THEN 'pending' ELSE 'sent' END, 0, '', now(), now()
+    FROM generate_series(1, 10000) n
+    """,
+]
+
+
+def hot_queries() -> dict:
+    """Горячие запросы приложения:
+    {название: (запрос, таблицы, которые нельзя читать целиком, индексы, которые должны быть в плане)}."""
+    station_columns = [column for column in TASK_COLUMNS if column != 'photo']
+    queries = {
+        f'Очередь: {station}': (tasks_query(conditions, station_columns), {'mattress_requests'},
+                                {f'ix_mattress_requests_{station}_queue'})
+        for station, conditions in STATION_QUEUES.items()
+    }
+    queries.update({
+        'Бронь задачи: сборка': (claim_task_query(1, 'gluing'), {'mattress_requests', 'employee_tasks'},
+                                 {'ix_mattress_requests_gluing_queue'}),
+        'Бронь задачи: шитьё': (claim_task_query(1, 'sewing'), {'mattress_requests', 'employee_tasks'},
+                                {'ix_mattress_requests_sewing_queue'}),
+        'Текущая задача сотрудника': (reserved_task_query(1, 'sewing'), {'employee_tasks'},
+                                      {'ix_employee_tasks_employee_endpoint'}),
+        'Сотрудники на смене: шитьё': (shift_employees_query('sewing'), {'employee_roles'},
+                                       {'ix_employee_roles_station'}),
+        'Роль сотрудника': (has_role_query(1, 'sewing'), {'employee_roles'}, {'employee_roles_pkey'}),
+        'Последние заказы': (select(Order).order_by(Order.id.desc()).limit(100), {'orders'}, {'orders_pkey'}),
+        'Outbox к отправке': (select(OutboxMessage)
+                              .where(OutboxMessage.status == 'pending',
+                                     OutboxMessage.next_attempt_at <= func.now())
+                              .order_by(OutboxMessage.id)
+                              .limit(20)
+                              .with_for_update(skip_locked=True), {'outbox'}, {'ix_outbox_pending'}),
+    })
+    return queries
+
+
+def compile_query(query) -> str:
+    return str(query.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+
+def table_scans(plan: dict, relation: str = None):
+    """Узлы плана, читающие таблицы: (тип узла, таблица, индекс или None, есть ли условие по индексу).
+    Bitmap Index Scan берёт таблицу у родительского Bitmap Heap Scan."""
+    relation = plan.get('Relation Name', relation)
+    node_type = plan.get('Node Type')
+    if node_type in ('Seq Scan', 'Index Scan', 'Index Only Scan', 'Bitmap Index Scan'):
+        yield node_type, relation, plan.get('Index Name'), 'Index Cond' in plan
+    for child in plan.get('Plans', []):
+        yield from table_scans(child, relation if node_type == 'Bitmap Heap Scan' else None)
+
+
+def plan_problems(plan: dict, indexed_tables: set, expected_indexes: set) -> list:
+    """Проблемы одного плана. Перебор запрещён через enable_seqscan = off, поэтому без подходящего
+    индекса планировщик обычно читает таблицу целиком по первичному ключу с Filter, а не Seq Scan.
+    Поэтому кроме Seq Scan ловим чтение индекса без Index Cond (кроме ожидаемых частичных индексов,
+    у которых условие в самом индексе) и проверяем, что ожидаемые индексы вообще есть в плане."""
+    problems = []
+    used_indexes = set()
+    for node_type, relation, index_name, has_condition in table_scans(plan):
+        used_indexes.add(index_name)
+        if relation not in indexed_tables:
+            continue
+        if node_type == 'Seq Scan':
+            problems.append(f"читает {relation} через Seq Scan")
+        elif not has_condition and index_name not in expected_indexes:
+            problems.append(f"читает {relation} целиком через {node_type} по {index_name}")
+    problems.extend(f"не использует индекс {index_name}" for index_name in sorted(expected_indexes - used_indexes))
+    return problems
+
+
+def recreate_database():
+    server = create_engine(f"{server_url}/postgres", isolation_level='AUTOCOMMIT')
+    with server.connect() as connection:
+        connection.execute(text(f'DROP DATABASE IF EXISTS "{check_db_name}"'))
+        connection.execute(text(f'CREATE DATABASE "{check_db_name}"'))
+    server.dispose()
+
+
+def drop_database():
+    server = create_engine(f"{server_url}/postgres", isolation_level='AUTOCOMMIT')
+    with server.connect() as connection:
+        connection.execute(text(f'DROP DATABASE IF EXISTS "{check_db_name}"'))
+    server.dispose()
+
+
+def check_plans(engine) -> list:
+    """Возвращает список проблем: (запрос, описание проблемы)."""
+    problems = []
+    with engine.connect() as connection:
+        connection.execute(text("SET enable_seqscan = off"))
+        for name, (query, indexed_tables, expected_indexes) in hot_queries().items():
+            plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {compile_query(query)}")).scalar_one()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            found = plan_problems(plan[0]['Plan'], indexed_tables, expected_indexes)
+            logging.info(f"{name}: {'; '.join(found) if found else 'ok'}")
+            problems.extend((name, problem) for problem in found)
+        connection.rollback()
+    return problems
+
+
+def main(keep_database: bool = False) -> int:
+    recreate_database()
+    engine = create_engine(f"{server_url}/{check_db_name}")
+    try:
+        migrate(engine)
+        with engine.begin() as connection:
+            for statement in SEED_SQL:
+                connection.execute(text(statement))
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text("ANALYZE"))
+
+        problems = check_plans(engine)
+    finally:
+        engine.dispose()
+        if not keep_database:
+            drop_database()
+
+    for name, problem in problems:
+        print(f"Регрессия плана: «{name}» {problem}")
+    if not problems:
+        print("Планы горячих запросов используют индексы")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(keep_database='--keep' in sys.argv))
@@ -0,0 +1,44 @@
+import gzip
+import hashlib
+import json
+
+from fastapi import Request
+from fastapi.responses import Response
+
+
+def etag_matches(if_none_match: str, etags) -> bool:
+    """Совпадает ли заголовок If-None-Match с одним из ETag ответа."""
+    if not if_none_match:
+        return False
+    candidates = {candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')}
+    return '*' in candidates or any(etag in candidates for etag in etags)
+
+
+class PreparedJSON:
+    """JSON-ответ, который сериализуется и сжимается один раз, а отдаётся много раз.
+
+    ETag строится по содержимому, поэтому одинаковые данные дают одинаковый ETag и после
+    перезапуска. У сжатого варианта свой ETag, как того требует строгое сравнение.
+    Cache-Control: no-cache заставляет браузер каждый раз переспрашивать сервер,
+    и если данные не менялись, он получает пустой 304 вместо всего списка."""
+
+    __slots__ = ('body', 'gzipped', 'etag', 'gzip_etag')
+
+    def __init__(self, content):
+        self.body = json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.gzipped = gzip.compress(self.body, compresslevel=6, mtime=0)
+        digest = hashlib.sha256(self.body).hexdigest()[:32]
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gzip"'
+
+    def response(self, request: Request) -> Response:
+        accepts_gzip = 'gzip' in request.headers.get('accept-encoding', '')
+        etag = self.gzip_etag if accepts_gzip else self.etag
+        headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+
+        if etag_matches(request.headers.get('if-none-match', ''), (self.etag, self.gzip_etag)):
+            return Response(status_code=304, headers=headers)
+        if accepts_gzip:
+            return Response(self.gzipped, media_type='application/json',
+                            headers={**headers, 'Content-Encoding': 'gzip'})
+        return Response(self.body, media_type='application/json', headers=headers)
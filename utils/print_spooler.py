@@ -0,0 +1,196 @@
+"""Очередь печати.
+
+Страницы только ставят задание в очередь и сразу продолжают работу, документ готовится
+и уходит на принтер в отдельном потоке. Задание - это функция render(рабочая папка) -> путь
+к файлу для печати: она выполняется в потоке очереди, поэтому не должна обращаться к Streamlit.
+Рабочая папка удаляется после отправки задания.
+
+Куда отправлять, задаёт [printing] backend в app_config.toml:
+cups - команда lp (Linux), windows - печать через оболочку Windows,
+directory - файлы складываются в папку spool_dir (для тестов и отладки без принтера),
+auto - windows на Windows, cups на остальных системах.
+"""
+import logging
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+from utils.tools import config
+
+printing_conf = config.get('printing', {})
+backend_name = printing_conf.get('backend', 'auto')
+spool_dir = Path(printing_conf.get('spool_dir', 'cash/print_spool'))
+command_timeout = printing_conf.get('command_timeout', 60)
+office_command = printing_conf.get('office_command', 'soffice')
+jobs_history = printing_conf.get('jobs_history', 200)
+shell_print_delay = printing_conf.get('shell_print_delay', 5)
+
+QUEUED, PRINTING, DONE, FAILED = 'queued', 'printing', 'done', 'failed'
+
+
+@dataclass
+class PrintJob:
+    title: str
+    printer: str
+    render: Callable[[Path], Path]
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = QUEUED
+    error: str = ''
+    created: float = field(default_factory=time.time)
+    finished: float | None = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+
+class CupsBackend:
+    """Печать командой lp. Документы, отличные от PDF (талоны xlsx), сначала переводятся
+    в PDF через LibreOffice, так как CUPS не умеет печатать таблицы."""
+    name = 'cups'
+
+    def to_pdf(self, path: Path) -> Path:
+        if path.suffix.lower() == '.pdf':
+            return path
+        subprocess.run([office_command, '--headless', '--convert-to', 'pdf', '--outdir', str(path.parent), str(path)],
+                       check=True, capture_output=True, timeout=command_timeout)
+        return path.with_suffix('.pdf')
+
+    def send(self, path: Path, printer: str, title: str):
+        result = subprocess.run(['lp', '-d', printer, '-t', title, '-o', 'print-color-mode=monochrome',
+                                 str(self.to_pdf(path))],
+                                capture_output=True, text=True, timeout=command_timeout)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip() or f"lp завершился с кодом {result.returncode}")
+
+
+class WindowsBackend:
+    """Печать на Windows: PDF через Aspose, остальное через приложение, связанное с типом файла.
+    pywin32 и aspose импортируются при первой печати, поэтому на Linux модуль загружается без них."""
+    name = 'windows'
+
+    def send(self, path: Path, printer: str, title: str):
+        import win32api  # из pywin32
+        import win32print  # из pywin32
+
+        # Устанавливаем дефолтный принтер
+        win32print.SetDefaultPrinterW(printer)
+        win32print.SetDefaultPrinter(printer)
+
+        if path.suffix.lower() == '.pdf':
+            import aspose.pdf as ap  # из aspose-pdf
+
+            # Этикетки приходят уже чёрно-белыми из utils/label_cache.py
+            viewer = ap.facades.PdfViewer()
+            viewer.bind_pdf(str(path))
+            viewer.print_document()
+            viewer.close()
+        else:
+            win32api.ShellExecute(0, "print", str(path), f'/d:"{printer}"', ".", 0)
+            # ShellExecute возвращается сразу, а приложение открывает файл позже.
+            # Рабочая папка удаляется после send, поэтому ждём здесь, в потоке очереди
+            time.sleep(shell_print_delay)
+
+
+class DirectoryBackend:
+    """Складывает документы в папку принтера внутри spool_dir вместо печати."""
+    name = 'directory'
+
+    def __init__(self, directory: Path = spool_dir):
+        self.directory = Path(directory)
+
+    def send(self, path: Path, printer: str, title: str):
+        printer_dir = self.directory / printer
+        printer_dir.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(path, printer_dir / f"{datetime.now():%Y%m%d_%H%M%S_%f}_{title}{path.suffix}")
+
+
+BACKENDS = {backend.name: backend for backend in (CupsBackend, WindowsBackend, DirectoryBackend)}
+
+
+def make_backend(name: str = backend_name):
+    if name == 'auto':
+        name = 'windows' if sys.platform == 'win32' else 'cups'
+    if name not in BACKENDS:
+        raise ValueError(f"Неизвестный способ печати: {name}. Доступны: auto, {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
+
+
+class PrintSpooler:
+    """Очередь заданий печати с одним рабочим потоком. Задания выполняются по порядку,
+    незавершённые и последние jobs_history заданий хранятся, чтобы страницы могли узнать их статус."""
+
+    def __init__(self, backend, history: int = jobs_history):
+        self.backend = backend
+        self.history = history
+        self.jobs = OrderedDict()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def submit(self, title: str, printer: str, render: Callable[[Path], Path]) -> PrintJob:
+        """Ставит задание в очередь и сразу возвращает его."""
+        job = PrintJob(title=title, printer=printer, render=render)
+        with self._lock:
+            self.jobs[job.id] = job
+            self.trim_history()
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self.run, name='print-spooler', daemon=True)
+                self._worker.start()
+        self._queue.put(job)
+        logging.info(f"Печать: задание {job.title!r} на {printer} поставлено в очередь")
+        return job
+
+    def trim_history(self):
+        """Забывает самые старые завершённые задания сверх history. Задания в очереди и в печати
+        не удаляются, иначе страница не узнает их результат. Вызывается под self._lock."""
+        excess = len(self.jobs) - self.history
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.is_finished][:excess]:
+            del self.jobs[job_id]
+
+    def get(self, job_id: str) -> PrintJob | None:
+        return self.jobs.get(job_id)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def process(self, job: PrintJob):
+        job.status = PRINTING
+        started = time.perf_counter()
+        try:
+            with tempfile.TemporaryDirectory(prefix='print_') as work_dir:
+                path = Path(job.render(Path(work_dir)))
+                self.backend.send(path, job.printer, job.title)
+            job.status = DONE
+            logging.info(f"Печать: {job.title!r} отправлено на {job.printer} "
+                         f"за {time.perf_counter() - started:.2f} с")
+        except Exception as e:
+            job.status = FAILED
+            job.error = str(e) or type(e).__name__
+            logging.error(f"Печать: ошибка задания {job.title!r} на {job.printer}: {e}", exc_info=True)
+        finally:
+            job.finished = time.time()
+
+    def run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self.process(job)
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Ждёт, пока очередь опустеет. Нужно для скриптов и тестов."""
+        self._queue.join()
@@ -0,0 +1,194 @@
+import logging
+import threading
+import time
+
+import niquests
+from tenacity import Retrying, AsyncRetrying, stop_after_attempt, stop_after_delay, wait_random_exponential, \
+    retry_if_exception_type, retry_if_exception
+
+from utils.http_client import connect_timeout, read_timeout
+from utils.tools import config
+
+resilience_conf = config.get('resilience', {})
+failure_threshold = resilience_conf.get('failure_threshold', 5)
+reset_timeout = resilience_conf.get('reset_timeout', 30)
+retry_attempts = resilience_conf.get('retry_attempts', 3)
+retry_base = resilience_conf.get('retry_base', 0.5)
+retry_max_wait = resilience_conf.get('retry_max_wait', 5)
+call_deadline = resilience_conf.get('call_deadline', 20)
+
+# Ответы, после которых запрос имеет смысл повторить. 500 сюда не входит:
+# им СБИС сообщает об ошибке в самом вызове, повтор её не исправит
+TRANSIENT_STATUSES = {429, 502, 503, 504}
+
+
+class CircuitOpenError(ConnectionError):
+    """Сервис недавно много раз подряд не отвечал, запрос не отправлялся."""
+
+
+class MaybeSentError(ConnectionError):
+    """Неидемпотентный вызов не получил ответа, но сервис мог его уже выполнить.
+    Слепой повтор может создать дубликат."""
+
+
+class TransientHTTPError(ConnectionError):
+    def __init__(self, response):
+        super().__init__(f"Сервис ответил {response.status_code}")
+        self.response = response
+
+
+TRANSIENT_ERRORS = (niquests.exceptions.ConnectionError, niquests.exceptions.Timeout, TransientHTTPError,
+                    TimeoutError)
+
+
+def not_sent(error: Exception) -> bool:
+    """Ошибки, после которых сервис точно не начинал выполнять запрос: соединение не установилось
+    или сервис отказал по лимиту. Только их можно повторять для вызовов, которые что-то создают."""
+    if isinstance(error, TransientHTTPError):
+        return error.response.status_code == 429
+    return isinstance(error, niquests.exceptions.ConnectTimeout)
+
+
+class CircuitBreaker:
+    """Размыкатель цепи для внешнего сервиса.
+
+    После failure_threshold неудачных вызовов подряд размыкается, и запросы сразу получают
+    CircuitOpenError, не дожидаясь таймаутов. Через reset_timeout секунд пропускает один
+    пробный запрос: удачный замыкает цепь, неудачный снова размыкает её."""
+
+    def __init__(self, name: str, threshold: int = failure_threshold, timeout: float = reset_timeout):
+        self.name = name
+        self.threshold = threshold
+        self.timeout = timeout
+        self.state = 'closed'  # closed, open, half_open
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_error = ''
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if time.monotonic() - self.opened_at >= self.timeout:
+                # Пропускаем один пробный запрос, остальные ждут его результата. Если пробный
+                # запрос так и не отчитался, через timeout пропускается следующий
+                self.state = 'half_open'
+                self.opened_at = time.monotonic()
+                return
+            raise CircuitOpenError(f"{self.name}: сервис недоступен, повтор через "
+                                   f"{max(self.timeout - (time.monotonic() - self.opened_at), 0):.0f} с")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logging.info(f"{self.name}: сервис снова отвечает")
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self, error: Exception):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+            if self.state == 'half_open' or self.failures >= self.threshold:
+                if self.state != 'open':
+                    logging.warning(f"{self.name}: цепь разомкнута после {self.failures} ошибок подряд: {error}")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def status(self) -> dict:
+        """Состояние для мониторинга."""
+        with self._lock:
+            retry_in = max(self.timeout - (time.monotonic() - self.opened_at), 0) if self.state == 'open' else 0
+            return {'name': self.name,
+                    'state': self.state,
+                    'failures': self.failures,
+                    'retry_in': round(retry_in, 1),
+                    'last_error': self.last_error}
+
+
+breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Общий на процесс размыкатель для сервиса."""
+    with _breakers_lock:
+        if name not in breakers:
+            breakers[name] = CircuitBreaker(name)
+        return breakers[name]
+
+
+def breakers_status() -> list:
+    return [breaker.status() for breaker in list(breakers.values())]
+
+
+def call_timeout(started: float, deadline: float) -> tuple:
+    """Таймаут очередной попытки: не дольше обычного и не дольше, чем осталось до срока."""
+    remaining = deadline - (time.monotonic() - started)
+    if remaining <= 0:
+        raise TimeoutError(f"Истёк срок вызова {deadline} с")
+    return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+
+def log_retry(retry_state):
+    logging.warning(f"Повтор запроса через {retry_state.next_action.sleep:.1f} с после ошибки: "
+                    f"{retry_state.outcome.exception()}")
+
+
+def retry_policy(deadline: float, idempotent: bool = True) -> dict:
+    """Повторы со случайной экспоненциальной задержкой, пока не кончились попытки или срок вызова.
+    Неидемпотентный вызов после таймаута чтения или 5xx мог уже выполниться, его повторяет
+    только вызывающий код (outbox), а здесь - лишь при ошибках из not_sent."""
+    return {'stop': stop_after_attempt(retry_attempts) | stop_after_delay(deadline),
+            'wait': wait_random_exponential(multiplier=retry_base, max=retry_max_wait),
+            'retry': retry_if_exception_type(TRANSIENT_ERRORS) if idempotent else retry_if_exception(not_sent),
+            'before_sleep': log_retry,
+            'reraise': True}
+
+
+def check_response(response):
+    if response.status_code in TRANSIENT_STATUSES:
+        raise TransientHTTPError(response)
+    return response
+
+
+def raise_maybe_sent(error: Exception, idempotent: bool):
+    """Для неидемпотентного вызова ошибку, после которой запрос мог выполниться, заменяет на MaybeSentError."""
+    if not idempotent and not not_sent(error):
+        raise MaybeSentError(f"Ответ не получен, запрос мог быть выполнен: {error}") from error
+
+
+def resilient_call(breaker: CircuitBreaker, send, deadline: float = call_deadline, idempotent: bool = True):
+    """Вызывает send(timeout) -> response с повторами, общим сроком deadline секунд и через размыкатель.
+    idempotent=False - для вызовов, повтор которых создаст дубликат (см. retry_policy). Если такой вызов
+    упал, когда запрос мог уже дойти до сервиса, выбрасывается MaybeSentError."""
+    breaker.before_call()
+    started = time.monotonic()
+    try:
+        response = Retrying(**retry_policy(deadline, idempotent))(
+            lambda: check_response(send(call_timeout(started, deadline))))
+    except TRANSIENT_ERRORS as e:
+        breaker.record_failure(e)
+        raise_maybe_sent(e, idempotent)
+        raise
+    breaker.record_success()
+    return response
+
+
+async def resilient_call_async(breaker: CircuitBreaker, send, deadline: float = call_deadline,
+                               idempotent: bool = True):
+    """Асинхронный вариант resilient_call: send(timeout) - корутина."""
+    breaker.before_call()
+    started = time.monotonic()
+    try:
+        async for attempt in AsyncRetrying(**retry_policy(deadline, idempotent)):
+            with attempt:
+                response = check_response(await send(call_timeout(started, deadline)))
+    except TRANSIENT_ERRORS as e:
+        breaker.record_failure(e)
+        raise_maybe_sent(e, idempotent)
+        raise
+    breaker.record_success()
+    return response
+
@@ -1,28 +1,49 @@
-import base64
-import os
+import asyncio
 import json
 import logging
-import requests
-from datetime import datetime
-
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, date, timedelta
+from functools import partial
+
+from utils.catalog import Catalog, CatalogItem, MATTRESS, FABRIC, SPRINGS, OTHER
+from utils.implementation_xml import render_implementation, implementation_attachment
+from utils.http_client import http_session, async_http_session, TokenStore
+from utils.resilience import get_breaker, resilient_call, resilient_call_async
 from utils.tools import load_conf
 
 config = load_conf()
-imp_filepath = config.get('sbis').get('implementation_filepath')
+sbis_conf = config.get('sbis')
+online_url = sbis_conf.get('online_url', 'https://online.sbis.ru').rstrip('/')
+api_url = sbis_conf.get('api_url', 'https://api.sbis.ru/retail').rstrip('/')
+# Через сколько секунд перевыпускать токены СБИС, не дожидаясь 401
+token_lifetime = sbis_conf.get('token_lifetime', 43200)
+# Номенклатура выгружается страницами по page_size позиций, до page_window страниц параллельно
+page_size = sbis_conf.get('nomenclature_page_size', 300)
+page_window = sbis_conf.get('nomenclature_page_window', 4)
+# Параметр /nomenclature/list для выгрузки только изменённых позиций. Пустая строка - всегда полная выгрузка
+changed_since_param = sbis_conf.get('nomenclature_changed_since_param', '')
+changed_since_format = sbis_conf.get('nomenclature_changed_since_format', '%Y-%m-%d %H:%M:%S')
+
+# Размыкатели общие для всех клиентов процесса: если СБИС лежит, запросы не ждут таймаутов
+online_breaker = get_breaker('sbis_online')
+api_breaker = get_breaker('sbis_api')
 
 
 class SBISManager:
+    """Клиент JSON-RPC СБИС (online.sbis.ru). Соединения берутся из общего пула,
+    идентификатор сессии хранится в памяти и перевыпускается один раз на всю пачку 401.
+    Запросы идут через размыкатель sbis_online с повторами и общим сроком (utils/resilience.py)."""
+
     def __init__(self, login: str = '', password: str = ''):
         self.login = login
         self.password = password
-        self.base_url = 'https://online.sbis.ru'
+        self.base_url = online_url
         self.headers = {
-            'Host': 'online.sbis.ru',
             'Content-Type': 'application/json-rpc; charset=utf-8',
             'Accept': 'application/json-rpc'
         }
-        if not os.path.exists('../cash'):
-            os.makedirs('../cash')
+        self.sid = TokenStore(self.auth, token_lifetime)
 
     def auth(self):
         payload = {
@@ -32,29 +53,29 @@ class SBISManager:
             "protocol": 2,
             "id": 0
         }
-        res = requests.post(f'{self.base_url}/auth/service/', headers=self.headers, data=json.dumps(payload))
-        logging.debug(f"СБИС.Аутентифицировать: {json.loads(res.text)}")
+        res = resilient_call(online_breaker, lambda timeout: http_session().post(
+            f'{self.base_url}/auth/service/', headers=self.headers, data=json.dumps(payload), timeout=timeout))
+        logging.debug(f"СБИС.Аутентифицировать: {res.json()}")
 
         try:
-            sid = json.loads(res.text)['result']
-
-            with open(f"cash/{self.login}_sbis_token.txt", "w+") as file:
-                file.write(sid)
-            return sid
-
+            return res.json()['result']
         except KeyError:
-            logging.critical(f"Ошибка авторизации: {json.loads(res.text)['error']}")
+            logging.critical(f"Ошибка авторизации: {res.json()['error']}")
 
     def get_sid(self):
-        try:
-            with open(f"cash/{self.login}_sbis_token.txt", "r") as file:
-                sid = file.read()
-                return sid
-        except FileNotFoundError:
-            return self.auth()
-
-    def main_query(self, method: str, params: dict or str):
-        self.headers['X-SBISSessionID'] = self.get_sid()
+        return self.sid.get()
+
+    def post(self, payload: dict, sid: str, idempotent: bool = True):
+        return resilient_call(online_breaker, lambda timeout: http_session().post(
+            f'{self.base_url}/service/',
+            headers={**self.headers, 'X-SBISSessionID': sid},
+            data=json.dumps(payload),
+            timeout=timeout), idempotent=idempotent)
+
+    def main_query(self, method: str, params: dict or str, idempotent: bool = True):
+        """idempotent=False для методов, которые создают документы: их не повторяем после
+        таймаута чтения, иначе в СБИС появится второй документ. Если ответа нет, а запрос мог
+        выполниться, выбрасывается MaybeSentError: решать, можно ли повторять, вызывающему коду."""
         payload = {
             "jsonrpc": "2.0",
             "method": method,
@@ -63,90 +84,105 @@ class SBISManager:
             "id": 0
         }
 
-        res = requests.post(f'{self.base_url}/service/', headers=self.headers, data=json.dumps(payload))
+        sid = self.get_sid()
+        res = self.post(payload, sid, idempotent)
 
         logging.info(f'Method: {method} | Code: {res.status_code}')
         logging.debug(f'URL: {self.base_url}/service/ \n'
                       f'Headers: {self.headers}\n'
                       f'Parameters: {params}\n'
-                      f'Result: {json.loads(res.text)}')
+                      f'Result: {res.text}')
         try:
             match res.status_code:
                 case 200:
-                    return json.loads(res.text)['result']
+                    return res.json()['result']
                 case 401:
                     logging.info('Пробуем обновить токен...')
-                    self.headers['X-SBISSessionID'] = self.auth()
-                    res = requests.post(f'{self.base_url}/service/', headers=self.headers, data=json.dumps(payload))
-                    return json.loads(res.text)['result']
+                    # С 401 запрос не выполнялся, повтор безопасен
+                    res = self.post(payload, self.sid.refresh(sid), idempotent)
+                    return res.json()['result']
                 case 500:
-                    raise AttributeError(f"{method}: {json.loads(res.text)['error']}")
+                    raise AttributeError(f"{method}: {res.json()['error']}")
         except KeyError:
-            logging.critical(f"Ошибка: {json.loads(res.text)['error']}")
+            logging.critical(f"Ошибка: {res.json()['error']}")
 
 
 class SBISApiManager:
+    """Клиент REST API розницы СБИС (api.sbis.ru/retail). Пара (sid, token) сервисной
+    авторизации хранится в памяти, соединения берутся из общего пула."""
+
     def __init__(self, login: str = '', password: str = ''):
         self.login = login
         self.password = password
-        self.base_url = 'https://api.sbis.ru/retail'
+        self.base_url = api_url
         self.headers = {'X-SBISAccessToken': ''}
+        self.tokens = TokenStore(self.service_auth, token_lifetime)
 
     def service_auth(self):
         payload = {"app_client_id": config.get('sbis').get('app_client_id'),
                    "app_secret": config.get('sbis').get('app_secret'),
                    "secret_key": config.get('sbis').get('secret_key')}
-        response = requests.post(f'https://online.sbis.ru/oauth/service/', json=payload)
-        response.encoding = 'utf-8'
-        result = json.loads(response.text)
+        try:
+            response = resilient_call(online_breaker, lambda timeout: http_session().post(
+                f'{online_url}/oauth/service/', json=payload, timeout=timeout))
+            response.encoding = 'utf-8'
+            result = response.json()
+            return result['sid'], result['token']
+        except Exception:
+            logging.critical(f"Не удалось авторизоваться в СБИС.", exc_info=True)
 
-        sid = result['sid']
-        with open(f"cash/{self.login}_sbis_service_sid.txt", "w+") as file:
-            file.write(sid)
+    def get_tokens(self):
+        return self.tokens.get()
 
-        token = result['token']
-        with open(f"cash/{self.login}_sbis_service_token.txt", "w+") as file:
-            file.write(token)
+    def request_headers(self, tokens) -> dict:
+        return {**self.headers, 'X-SBISAccessToken': tokens[1] if tokens else ''}
 
-        return sid, token
+    @staticmethod
+    def parse_response(method: str, res):
+        match res.status_code:
+            case 200:
+                return res.json()
+            case 500:
+                raise AttributeError(f'{method}: Check debug logs.')
 
-    def get_tokens(self):
-        try:
-            with open(f"cash/{self.login}_sbis_sid.txt", "r") as file:
-                sid = file.read()
-            with open(f"cash/{self.login}_sbis_token.txt", "r") as file:
-                token = file.read()
-            return sid, token
-        except FileNotFoundError:
-            try:
-                return self.service_auth()
-            except Exception:
-                logging.critical(f"Не удалось авторизоваться в СБИС.", exc_info=True)
+    def get(self, url: str, params: dict or str, tokens):
+        return resilient_call(api_breaker, lambda timeout: http_session().get(
+            url, headers=self.request_headers(tokens), params=params, timeout=timeout))
 
-    def main_query(self, method: str, params: dict or str):
-        sid, token = self.get_tokens()
-        self.headers['X-SBISAccessToken'] = token
+    async def get_async(self, url: str, params: dict or str, tokens):
+        client = async_http_session()
+        return await resilient_call_async(api_breaker, lambda timeout: client.get(
+            url, headers=self.request_headers(tokens), params=params, timeout=timeout))
 
+    def main_query(self, method: str, params: dict or str):
         url = f'{self.base_url}{method}'
-        res = requests.get(url, headers=self.headers, params=params)
+        tokens = self.get_tokens()
+        res = self.get(url, params, tokens)
 
         logging.info(f'Method: {method} | Code: {res.status_code}')
         logging.debug(f'URL: {url}\n'
-                      f'Headers: {self.headers}\n'
                       f'Parameters: {params}\n'
-                      f'Result: {json.loads(res.text)}')
+                      f'Result: {res.text}')
 
-        match res.status_code:
-            case 200:
-                return json.loads(res.text)
-            case 401:
-                logging.info('Требуется обновление токена.')
-                sid, token = self.service_auth()
-                self.headers['X-SBISAccessToken'] = token
-                res = requests.get(f'{self.base_url}' + method, headers=self.headers, params=params)
-                return json.loads(res.text)
-            case 500:
-                raise AttributeError(f'{method}: Check debug logs.')
+        if res.status_code == 401:
+            logging.info('Требуется обновление токена.')
+            tokens = self.tokens.refresh(tokens)
+            res = self.get(url, params, tokens)
+        return self.parse_response(method, res)
+
+    async def main_query_async(self, method: str, params: dict or str):
+        """Асинхронный вариант main_query для кода, работающего в event loop FastAPI.
+        Токены общие с синхронным вариантом, авторизация выполняется в потоке."""
+        url = f'{self.base_url}{method}'
+        tokens = await asyncio.to_thread(self.get_tokens)
+        res = await self.get_async(url, params, tokens)
+
+        logging.info(f'Method: {method} | Code: {res.status_code}')
+        if res.status_code == 401:
+            logging.info('Требуется обновление токена.')
+            tokens = await asyncio.to_thread(self.tokens.refresh, tokens)
+            res = await self.get_async(url, params, tokens)
+        return self.parse_response(method, res)
 
 
 class SBISWebApp(SBISApiManager):
@@ -156,7 +192,15 @@ class SBISWebApp(SBISApiManager):
         self.reg_id = config.get('sbis').get('regalement_id_list')
         self.sale_point_name = sale_point_name
         self.price_list_name = price_list_name
-        self.nomenclatures_list = {}
+        self.nomenclatures_list = Catalog()
+        self._price_list_ids = {}
+        self._ids_lock = threading.Lock()
+        # ID товарной группы матрасов. Далее стоит проверка товара на
+        # принадлежность этой группе. Товары из группы матрасов попадают
+        # в датафрейм в качестве задания на производство
+        self.mattress_group_id = sbis_conf.get('mattress_group_id')
+        self.fabrics_group_id = sbis_conf.get('fabrics_group_id')
+        self.springs_group_id = sbis_conf.get('springs_group_id')
 
     def get_sale_point_id(self):
         res = self.main_query('/point/list?', {'withPrices': 'true'})
@@ -164,15 +208,29 @@ class SBISWebApp(SBISApiManager):
             if point['name'] == self.sale_point_name:  # 'Гаспарян Роман Славикович, ИП'
                 return point['id']
 
-    def get_price_list_id(self, point_id: str):
+    def get_price_list_id(self, point_id: str, actual_date: str = None):
         params = {'pointId': point_id,
-                  'actualDate': '2024-03-18'}
+                  'actualDate': actual_date or date.today().isoformat()}
         res = self.main_query('/nomenclature/price-list?', params)
         for price_list in res['priceLists']:
             if price_list['name'] == self.price_list_name:
                 return price_list['id']
 
-    def get_nomenclature_list(self, point_id: str, price_list_id: str, page: int):
+    def get_price_list_ids(self) -> tuple:
+        """ID точки продаж и прайс-листа. Запоминаются на текущий день, так как прайс-лист
+        выбирается на дату. Если СБИС их не вернул, при следующем вызове запрашиваются снова."""
+        today = date.today().isoformat()
+        with self._ids_lock:
+            if self._price_list_ids.get('date') != today:
+                point_id = self.get_sale_point_id()
+                price_list_id = self.get_price_list_id(point_id, today) if point_id else None
+                if not (point_id and price_list_id):
+                    raise LookupError(f"В СБИС не найдены точка продаж «{self.sale_point_name}» "
+                                      f"или прайс-лист «{self.price_list_name}»")
+                self._price_list_ids = {'date': today, 'ids': (point_id, price_list_id)}
+            return self._price_list_ids['ids']
+
+    def get_nomenclature_list(self, point_id: str, price_list_id: str, page: int, changed_since: datetime = None):
         """
         get_nomenclature_list возвращает список из словарей:
         {
@@ -208,248 +266,110 @@ class SBISWebApp(SBISApiManager):
             """
         params = {'pointId': point_id,
                   'priceListId': price_list_id,
-                  'pageSize': 300,
+                  'pageSize': page_size,
                   'page': page}
-        return self.main_query('/nomenclature/list?', params)
-
-    def get_nomenclatures(self) -> dict:
-        """Подтягивает номенклатуру из прайс-листа в разделе Бизнес - Цены
-        в виде словаря с названиями позиций в качестве ключей, а в значениях - словарь свойств позиции.
+        if changed_since is not None:
+            params[changed_since_param] = changed_since.strftime(changed_since_format)
+
+        product_list = self.main_query('/nomenclature/list?', params)
+        if product_list is None:
+            # Без этой страницы каталог был бы неполным, поэтому обновление прерывается целиком
+            raise ConnectionError(f"СБИС не вернул страницу {page} номенклатуры")
+        return product_list
+
+    @staticmethod
+    def is_last_page(product_list: dict) -> bool:
+        return not product_list['nomenclatures'] or not product_list['outcome']['hasMore']
+
+    def fetch_nomenclature_pages(self, point_id: str, price_list_id: str, changed_since: datetime = None) -> list:
+        """Загружает все страницы номенклатуры. Общее число страниц СБИС не сообщает, поэтому
+        после первой страницы следующие запрашиваются окном из page_window штук параллельно,
+        пока одна из них не окажется последней. Лишних запросов за концом списка - не больше окна."""
+        fetch = partial(self.get_nomenclature_list, point_id, price_list_id, changed_since=changed_since)
+        first_page = fetch(page=0)
+        pages = {0: first_page}
+        if self.is_last_page(first_page):
+            return [first_page]
+
+        last_page = None
+        next_page = 1
+        with ThreadPoolExecutor(max_workers=page_window) as pool:
+            running = {}
+            while True:
+                while len(running) < page_window and last_page is None:
+                    running[pool.submit(fetch, page=next_page)] = next_page
+                    next_page += 1
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page = running.pop(future)
+                    pages[page] = future.result()
+                    if self.is_last_page(pages[page]):
+                        last_page = page if last_page is None else min(last_page, page)
+
+        return [pages[page] for page in sorted(pages) if page <= last_page]
+
+    def parse_nomenclature(self, product: dict) -> CatalogItem:
+        """Позиция каталога из ответа СБИС"""
+        attributes = product.get('attributes') or {}
+
+        # Вычисляем группу позиции, типа ткань, матрас, или ещё что-либо
+        group = product['hierarchicalParent']
+        # Если товар принадлежит к группе матрасов, пишем размер и состав в отдельные поля.
+        # Тип ткани раньше брался из атрибута «Тип ткани», теперь ищется по ключевым словам в названии
+        if group == self.mattress_group_id:
+            return CatalogItem.create(product['name'], product.get('nomNumber', 0), product.get('article', 'Неизвестен'),
+                                      product.get('cost', 0), MATTRESS,
+                                      size=attributes.get('Размер', '0'), structure=attributes.get('Состав', ''))
+
+        category = {self.fabrics_group_id: FABRIC, self.springs_group_id: SPRINGS}.get(group, OTHER)
+        return CatalogItem.create(product['name'], product.get('nomNumber', 0), product.get('article', 'Неизвестен'),
+                                  product.get('cost', 0), category)
+
+    def get_nomenclatures(self, changed_since: datetime = None) -> Catalog:
+        """Подтягивает номенклатуру из прайс-листа в разделе Бизнес - Цены в виде каталога
+        (utils/catalog.py), где позиции ищутся по названию, коду и артикулу.
+        С changed_since возвращает только позиции, изменённые после этого момента (см. update_nomenclatures).
         Важно: на момент июня 2024-го СБИС не даёт подтягивать номенклатуру просто так, только из
         прайс-листа. ЕСЛИ НОМЕНКЛАТУРА НЕ ВЫГРУЖАЕТСЯ, ПРОВЕРЬ ПРАЙС-ЛИСТ "Позиции для Telegram-бота" """
-        point_id = self.get_sale_point_id()
-        price_list_id = self.get_price_list_id(point_id)
-        # ID товарной группы матрасов. Далее стоит проверка товара на
-        # принадлежность этой группе. Товары из группы матрасов попадают
-        # в датафрейм в качестве задания на производство
-        mattress_group_id = config.get('sbis').get('mattress_group_id')
-        fabrics_group_id = config.get('sbis').get('fabrics_group_id')
-        springs_group_id = config.get('sbis').get('springs_group_id')
-
-        # Это пригодится чуть ниже для пангинации
-        page = 0
-
-        # Пустой словарик, который будем заполнять данными
-        # В качестве ключа к данными о позиции будет название позиции в СБИС
-        nomenclatures_list = dict()
-
-        while True:
-            product_list = self.get_nomenclature_list(point_id, price_list_id, page)
-            logging.debug("Nomenclature list: ")
-            logging.debug(product_list)
-
-            # Выход сразу же, если список номенклатур пустой
-            if not product_list['nomenclatures']:
-                break
-            # Оп! Пангинация!
-            page += 1
-            for product in product_list['nomenclatures']:
-                # Позиции без номера это каталоги. Пропускаем
-                if not product['nomNumber']:
-                    continue
-
-                key_name = product['name']
-                nomenclatures_list[key_name] = {'code': product.get('nomNumber', 0),
-                                                'article': product.get('article', 'Неизвестен'),
-                                                'price': product.get('cost', 0),
-                                                'description': product.get('description_simple', ''),
-                                                'attributes': product.get('attributes', {'': ''}),
-                                                'images': product.get('images', None),
-                                                'is_mattress': False,
-                                                'is_fabric': False,
-                                                'is_springs': False}
-
-                # Вычисляем группу позиции, типа ткань, матрас, или ещё что-либо
-                group = product['hierarchicalParent']
-                attributes = nomenclatures_list[key_name]['attributes']
-
-                # Если товар принадлежит к группе матрасов, пишем размер в отдельное поле
-                if group == mattress_group_id:
-                    nomenclatures_list[key_name]['is_mattress'] = True
-                    nomenclatures_list[key_name]['size'] = attributes.get('Размер', '0')
-                    nomenclatures_list[key_name]['structure'] = attributes.get('Состав', '')
-                # А если к группе тканей, то ставится тип "Ткань"
-                if group == fabrics_group_id:
-                    nomenclatures_list[key_name]['is_fabric'] = True
-                    # Раньше аттрибут типа ткани использовался для коррекции бочины
-                    # Теперь поиск идёт по ключевым словам в названии ткани
-                    # nomenclatures_list[key_name]['type'] = attributes.get('Тип ткани', '')
-                if group == springs_group_id:
-                    nomenclatures_list[key_name]['is_springs'] = True
-
-            # Цикл прерывается, если позиций больше нет
-            if not product_list['outcome']['hasMore']:
-                break
-
-        self.nomenclatures_list = nomenclatures_list
-        return nomenclatures_list
-
-    def create_implementation_xml(self, data):
-        today = datetime.today().strftime('%d.%m.%Y')
-
-        # Если поле "Компания" оставить пустым при создании заявки, счёт оформится как розница,
-        # а если нет, то в счёте будет юрлицо
-        customer_inn, customer_kpp, company_address = None, None, None
-        wholesale = True if data.get('organization') else False
-        if wholesale:
-            customer_info = json.loads(data.get('organization_data', {}) or '{}')
-            customer_inn = customer_info.get('data', {}).get('inn', None)
-            customer_kpp = customer_info.get('data', {}).get('kpp', None)
-            company_address = customer_info.get('address_data', {}).get('value', None)
-
-        # Заменяем двойные кавычки на &quot;
-        # иначе программа посчитает эти кавычки за конец строки в файле и разметка сломается
-        customer_name = data.get("organization", '').replace('"', '&quot;')
-        #comment = f"{data.get('contact')} {data.get('organization')}".replace('"', '&quot;')
-        delivery_date = datetime.strptime(data.get('deliveryDate', '2000-01-01'), '%Y-%m-%d').strftime('%d.%m.%Y')
-        xml_content = f'''<?xml version="1.0" encoding="WINDOWS-1251"?>
-<Файл ВерсФорм="5.02">
-
-  <СвУчДокОбор>
-    <СвОЭДОтпр/>
-  </СвУчДокОбор>
-
-  <Документ ВремИнфПр="9.00.00" ДатаИнфПр="{today}" КНД="1175010" НаимЭконСубСост="ИП Гаспарян Роман Славикович">
-    <СвДокПТПрКроме>
-      <СвДокПТПр>
-        <НаимДок НаимДокОпр="Товарная накладная" ПоФактХЖ="Документ о передаче товара при торговых операциях"/>
-        <ИдентДок ДатаДокПТ="{today}"/>
-        <СодФХЖ1>
-          <ГрузОтпр ОКПО="0151033706">
-            <ИдСв>
-              <СвИП ИННФЛ="230911595879" СвГосРегИП="323237500002399">
-                <ФИО Имя="Роман" Отчество="Славикович" Фамилия="Гаспарян"/>
-              </СвИП>
-            </ИдСв>
-            <Адрес>
-              <АдрИнф АдрТекст="Краснодарский край, г.о. город Краснодар, г. Краснодар" КодСтр="643"/>
-            </Адрес>
-          </ГрузОтпр>'''
-        if wholesale:
-            xml_content += f''''
-          <ГрузПолуч ОКПО="20524053">
-            <ИдСв>
-              <СвОрг>
-                <СвЮЛ ИННЮЛ="{customer_inn}" '''
-            if customer_kpp:
-                xml_content += f'КПП="{customer_kpp}" '
-            xml_content += f'''НаимОрг="{customer_name}"/>
-          </СвОрг>
-        </ИдСв>
-        <Адрес>
-          <АдрИнф АдрТекст="{company_address}" КодСтр="643"/>
-        </Адрес>
-      </ГрузПолуч>'''
-        xml_content += f'''
-          <Продавец ОКПО="0151033706">
-            <ИдСв>
-              <СвИП ИННФЛ="230911595879" СвГосРегИП="323237500002399">
-                <ФИО Имя="Роман" Отчество="Славикович" Фамилия="Гаспарян"/>
-              </СвИП>
-            </ИдСв>
-            <Адрес>
-              <АдрИнф АдрТекст="Краснодарский край, г.о. город Краснодар, г. Краснодар" КодСтр="643"/>
-            </Адрес>
-          </Продавец>'''
-        if wholesale:
-            xml_content += f'''
-      <Покупатель ОКПО="20524053">
-        <ИдСв>
-          <СвОрг>
-            <СвЮЛ ИННЮЛ="{customer_inn}" КПП="{customer_kpp}" НаимОрг="{customer_name}"/>
-          </СвОрг>
-        </ИдСв>
-        <Адрес>
-          <АдрИнф АдрТекст="{company_address}" КодСтр="643"/>
-        </Адрес>
-        <Контакт Тлф="8 (861) 204-05-06" ЭлПочта="dir@le-ar.ru"/>
-        <БанкРекв НомерСчета="40702810512550035771">
-          <СвБанк БИК="044525360" КорСчет="30101810445250000360" НаимБанк="Филиал &quot;Корпоративный&quot; ПАО &quot;Совкомбанк&quot; МОСКВА"/>
-        </БанкРекв>
-      </Покупатель>'''
-        else:
-            xml_content += f'''
-          <Покупатель>
-            <ИдСв/>
-          </Покупатель>'''
-        xml_content += f'''
-          <Основание НаимОсн="-"/>
-          <ИнфПолФХЖ1>
-            <ТекстИнф Значен="{delivery_date}" Идентиф="Срок"/>
-            <ТекстИнф Значен="23:59:59" Идентиф="СрокВремя"/>
-            <ТекстИнф Значен="Основной склад" Идентиф="СкладНаименование"/>
-            <ТекстИнф Значен="ИП Гаспарян Роман Славикович" Идентиф="НаимПост"/>
-            <ТекстИнф Значен="ИП Гаспарян Роман Славикович" Идентиф="НаимГрузОтпр"/>
-          </ИнфПолФХЖ1>
-        </СодФХЖ1>
-      </СвДокПТПр>
-      <СодФХЖ2>'''
-
-        item_num = 1
-        total_quantity = 0
-        total_price = 0
-        positions = data.get('mattresses', '[]')
-        for position in positions:
-            position_price = position['price']
-            item_name = position['name'].replace('"', '&quot;')
-            item_quantity = int(position.get('quantity', '1'))
-            total_quantity += item_quantity
-            item_price = position_price / item_quantity
-
-            info = self.nomenclatures_list[position['name']]
-            code = info.get("code")
-
-            total_price += position_price
-            #  НаимЕдИзм="шт"
-            xml_content += f'''
-        <СвТов КодТов="{code}" НаимТов="{item_name}" НалСт="без НДС" НеттоПередано="{item_quantity}" НомТов="{item_num}" ОКЕИ_Тов="796" СтБезНДС="{position_price}" СтУчНДС="{position_price}" Цена="{item_price}">
-          <ИнфПолФХЖ2 Значен="{code}" Идентиф="КодПоставщика"/>
-          <ИнфПолФХЖ2 Значен="{item_name}" Идентиф="НазваниеПоставщика"/>
-          <ИнфПолФХЖ2 Значен="&quot;Type&quot;:&quot;Товар&quot;" Идентиф="ПоляНоменклатуры"/>
-          <ИнфПолФХЖ2 Значен="41-01" Идентиф="СчетУчета"/>
-        </СвТов>'''
-            item_num += 1
-
-        positions = data.get('additionalItems', '[]')
-        for position in positions:
-            position_price = float(position['price'])
-            item_name = position['name'].replace('"', '&quot;')
-            item_quantity = int(position.get('quantity', '1'))
-            total_quantity += item_quantity
-            item_price = position_price / item_quantity
-
-            info = self.nomenclatures_list[position['name']]
-            code = info.get("code")
-
-            total_price += position_price
-            #  НаимЕдИзм="шт"
-            xml_content += f'''
-        <СвТов КодТов="{code}" НаимТов="{item_name}" НалСт="без НДС" НеттоПередано="{item_quantity}" НомТов="{item_num}" ОКЕИ_Тов="796" СтБезНДС="{position_price}" СтУчНДС="{position_price}" Цена="{item_price}">
-          <ИнфПолФХЖ2 Значен="{code}" Идентиф="КодПоставщика"/>
-          <ИнфПолФХЖ2 Значен="{item_name}" Идентиф="НазваниеПоставщика"/>
-          <ИнфПолФХЖ2 Значен="&quot;Type&quot;:&quot;Товар&quot;" Идентиф="ПоляНоменклатуры"/>
-          <ИнфПолФХЖ2 Значен="41-01" Идентиф="СчетУчета"/>
-        </СвТов>'''
-            item_num += 1
-
-        xml_content += f'''
-        <Всего НеттоВс="{total_quantity}" СтБезНДСВс="{total_price}" СтУчНДСВс="{total_price}"/>
-      </СодФХЖ2>
-    </СвДокПТПрКроме>
-    <СодФХЖ3 СодОпер="Перечисленные в документе ценности переданы"/>
-    <Подписант ОблПолн="2">
-      <ИП СвГосРегИП="323237500002399">
-        <ФИО/>
-      </ИП>
-    </Подписант>
-  </Документ>
-
-</Файл>
-'''
-        with open(imp_filepath, 'w') as file:
-            return file.write(xml_content)
-
-    def write_implementation(self, order_data: dict):
+        point_id, price_list_id = self.get_price_list_ids()
+
+        items = []
+        for product_list in self.fetch_nomenclature_pages(point_id, price_list_id, changed_since):
+            logging.debug(f"Nomenclature list: {product_list}")
+            # Позиции без номера это каталоги. Пропускаем
+            items.extend(self.parse_nomenclature(product) for product in product_list['nomenclatures']
+                         if product['nomNumber'])
+
+        catalog = Catalog(items)
+        if changed_since is None:
+            self.nomenclatures_list = catalog
+        return catalog
+
+    def update_nomenclatures(self, current: Catalog, changed_since: datetime) -> Catalog:
+        """Дотягивает в каталог только позиции, изменённые после changed_since.
+        Удалённые из прайс-листа позиции так не отследить, поэтому время от времени
+        нужна полная выгрузка (nomenclature_full_refresh_interval)."""
+        if not changed_since_param:
+            return self.get_nomenclatures()
+
+        # Запас на расхождение часов с сервером СБИС
+        changes = self.get_nomenclatures(changed_since - timedelta(minutes=5))
+        logging.info(f"Изменённых позиций номенклатуры: {len(changes)}")
+        return current.merge(changes)
+
+    def create_implementation_xml(self, data, catalog: Catalog = None) -> bytes:
+        """XML документа реализации, собранный в памяти (см. utils/implementation_xml.py)"""
+        return render_implementation(data, catalog if catalog is not None else self.nomenclatures_list)
+
+    def write_implementation(self, order_data: dict, catalog: Catalog = None, document_id: str = None):
+        """Записывает документ реализации в СБИС. Коды товаров берутся из переданного каталога,
+        без него - из последней выгрузки номенклатуры этим объектом.
+        document_id - UUID документа, заданный при сохранении заказа: повторная запись с тем же
+        идентификатором обновляет уже созданный документ, а не создаёт второй.
+        MaybeSentError - ответа нет, но документ мог быть записан."""
         logging.info(f"Order data:\n{order_data}")
 
         # Такая конструкция вернёт пустой словарь, вместо None, если данных нет.
@@ -467,11 +387,7 @@ class SBISWebApp(SBISApiManager):
         prepayment = order_data['prepayment']
         amount_to_receive = total_price - prepayment
 
-        self.create_implementation_xml(order_data)
-
-        with open(imp_filepath, "rb") as file:
-            encoded_string = base64.b64encode(file.read())
-            base64_file = encoded_string.decode('ascii')
+        attachment = implementation_attachment(order_data, catalog if catalog is not None else self.nomenclatures_list)
 
         regulation = self.reg_id['direct_sell'] if customer_info == {} else self.reg_id['wholesale']
         order_contact = order_data.get('contact', '')
@@ -480,9 +396,9 @@ class SBISWebApp(SBISApiManager):
         order_address = customer_info.get('address_data', {}).get('value')
 
         params = {"Документ": {
+            **({"Идентификатор": document_id} if document_id else {}),
             "Тип": "ДокОтгрИсх",
-            "Вложение": [{'Файл': {'Имя': imp_filepath,
-                                   'ДвоичныеДанные': base64_file}}],
+            "Вложение": [{'Файл': attachment}],
             "Регламент": {"Идентификатор": regulation},
             "Контакт": order_contact,
             "Примечание": comment,
@@ -494,4 +410,4 @@ class SBISWebApp(SBISApiManager):
                                    "Контакт": order_contact,
                                    "Адрес": order_address}}}
 
-        return self.doc_manager.main_query('СБИС.ЗаписатьДокумент', params)
+        return self.doc_manager.main_query('СБИС.ЗаписатьДокумент', params, idempotent=False)
@@ -1,16 +1,47 @@
 import logging
 from pathlib import Path
 
-import pandas as pd
 import streamlit as st
 
-from sqlalchemy.orm import joinedload
+from sqlalchemy import update
 
-from utils.db_connector import session
-from utils.models import MattressRequest, Order, Employee
-from utils.tools import config, create_history_note
+from utils.change_bus import change_notification
+from utils.db_connector import session, engine
+from utils.employee_roles import STATION_ROLES, STATION_BY_NAME, shift_employees_query
+from utils.models import MattressRequest
+from utils.photo_store import photo_url
+from utils.print_spooler import PrintSpooler, make_backend, DONE, FAILED
+from utils.task_edits import save_task_edits
+from utils.task_events import task_events_insert
+from utils.task_queries import TASK_COLUMNS, read_tasks
+from utils.task_snapshot import TaskSnapshot
+from utils.tools import config, local_ip
 
 site_conf = config.get('site')
+# Фото отдаёт FastAPI-приложение, страницы Streamlit ссылаются на его миниатюры. Адрес по умолчанию
+# доступен только из локальной сети, для туннеля и HTTPS он задаётся в [site] photos_base_url
+photos_base_url = (site_conf.get('photos_base_url') or f"http://{local_ip}:{site_conf.get('site_port')}").rstrip('/')
+
+
+@st.cache_resource
+def get_task_snapshot() -> TaskSnapshot:
+    """Один снимок нарядов на процесс Streamlit, общий для всех открытых терминалов."""
+    return TaskSnapshot(session)
+
+
+@st.cache_data(ttl=site_conf.get('employees_cache_ttl', 60), show_spinner=False)
+def shift_employees(station: str) -> list:
+    """(имя, id) сотрудников рабочего места на смене. Общий для всех терминалов процесса:
+    страницы спрашивают каждые несколько секунд, а список меняет только бригадир,
+    поэтому его сохранение сбрасывает кэш через shift_employees.clear()."""
+    with session() as db:
+        return [(name, employee_id) for name, employee_id in db.execute(shift_employees_query(station))]
+
+
+@st.cache_resource
+def get_print_spooler() -> PrintSpooler:
+    """Одна очередь печати на процесс Streamlit: принтеры общие для всех терминалов."""
+    return PrintSpooler(make_backend())
 
 
 class Page:
@@ -21,7 +52,8 @@ class Page:
         self.employee_columns_config = {
             "is_on_shift": st.column_config.CheckboxColumn("На смене", default=False),
             "name": st.column_config.TextColumn("Имя", default=''),
-            "position": st.column_config.TextColumn("Роли", width='medium', default=''),
+            **{f"role_{station}": st.column_config.CheckboxColumn(name, default=False)
+               for station, name in STATION_ROLES.items()},
             "barcode": st.column_config.LinkColumn("Штрих-код", display_text="Открыть", disabled=False),
             "Удалить": st.column_config.CheckboxColumn("Удалить", default=False),
         }
@@ -31,9 +63,6 @@ class Page:
             'id': st.column_config.NumberColumn("Матрас", disabled=True),
             'order_id': st.column_config.NumberColumn("Заказ", disabled=True),
             "high_priority": st.column_config.CheckboxColumn("Приоритет", default=False),
-            "history": st.column_config.TextColumn("Действия",
-                                                   width='small',
-                                                   disabled=True),
             "components_is_done": st.column_config.CheckboxColumn("Материалы",
                                                                   default=False),
             "fabric_is_done": st.column_config.CheckboxColumn("Нарезано",
@@ -82,6 +111,7 @@ class Page:
         }
 
         self.session = session()
+        self.task_snapshot = get_task_snapshot()
         st.set_page_config(page_title=self.page_name,
                            page_icon=self.icon,
                            layout="wide")
@@ -95,104 +125,71 @@ class Page:
             self.session.rollback()
             logging.error(f"Error updating database: {e}")
 
-    def save_mattress_df_to_db(self, edited_df, model):
-        for index, row in edited_df.iterrows():
-            instance = self.session.get(model, index)
-            if instance:
-                for column in row.index:
-                    if hasattr(instance, column):
-                        setattr(instance, column, row[column])
-        self.session.commit()
+    def save_mattress_df_to_db(self, edited_df, original_df):
+        """Сохраняет только изменённые ячейки одним запросом. Строки, которые успели
+        поменять на других экранах, совмещаются по ячейкам или отклоняются."""
+        try:
+            result = save_task_edits(self.session, original_df, edited_df)
+            changed_ids = result.applied + result.merged
+            if changed_ids:
+                self.notify_tasks_updated(changed_ids)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            # Объекты в сессии могли устареть после массового UPDATE
+            self.session.expire_all()
+        return result
+
+    def notify_tasks_updated(self, task_ids):
+        """Сообщает экранам сборки и шитья, что наряды изменились. Уходит вместе с коммитом."""
+        self.session.execute(change_notification({'type': 'tasks_updated',
+                                                  'task_ids': [int(task_id) for task_id in task_ids]}))
 
     def header(self):
         st.title(f'{self.icon} {self.page_name}')
 
-    def get_orders_with_mattress_requests(self):
-        # Возвращает все заказы в порядке id. Если нужно сортировать в порядке убывания, используй Order.id.desc()
-        return (self.session.query(Order)
-                .options(joinedload(Order.mattress_requests))
-                .order_by(Order.id.desc())
-                .all())
-
-    @staticmethod
-    def get_tasks_as_df(orders):
-        data = []
-        for order in orders:
-            for mattress_request in order.mattress_requests:
-                row = {
-                    'id': mattress_request.id,
-                    'order_id': order.id,
-                    'high_priority': mattress_request.high_priority,
-                    'deadline': order.deadline,
-                    'article': mattress_request.article,
-                    'size': mattress_request.size,
-                    'base_fabric': mattress_request.base_fabric,
-                    'side_fabric': mattress_request.side_fabric,
-                    'photo': mattress_request.photo,
-                    'comment': mattress_request.comment,
-                    'springs': mattress_request.springs,
-                    'attributes': mattress_request.attributes,
-                    'components_is_done': mattress_request.components_is_done,
-                    'fabric_is_done': mattress_request.fabric_is_done,
-                    'gluing_is_done': mattress_request.gluing_is_done,
-                    'sewing_is_done': mattress_request.sewing_is_done,
-                    'packing_is_done': mattress_request.packing_is_done,
-                    'history': mattress_request.history,
-                    'organization': order.organization,
-                    'delivery_type': order.delivery_type,
-                    'address': order.address,
-                    'region': order.region,
-                    'created': mattress_request.created,
-                }
-                data.append(row)
-
-        return pd.DataFrame(data)
+    def submit_print(self, title: str, printer: str, render):
+        """Ставит документ в очередь печати, не дожидаясь принтера. О результате
+        сообщит show_print_status при следующей перерисовке страницы."""
+        job = get_print_spooler().submit(title, printer, render)
+        st.session_state.setdefault('print_jobs', []).append(job.id)
+        st.toast(f"{title}: в очереди на печать", icon='🖨️')
+        return job
 
     @staticmethod
-    def filter_incomplete_tasks(df, conditions):
-        """
-        Фильтрует DataFrame по условиям, переданным в виде словаря.
-
-        :param df: DataFrame с заявками
-        :param conditions: Словарь условий, где ключ — это название столбца, а значение — значение для фильтрации
-        :return: Отфильтрованный DataFrame
-        """
-        # Создаем фильтр, объединяя все условия через логическое "или"
-        filter_condition = None
-
-        for column, condition_value in conditions.items():
-            # Формируем условие для текущего столбца
-            current_condition = (df[column] == condition_value)
-
-            # Объединяем условия через логическое "или"
-            if filter_condition is None:
-                filter_condition = current_condition
-            else:
-                filter_condition |= current_condition
-
-        # Применяем фильтр к DataFrame и возвращаем результат
-        filtered_df = df[filter_condition]
-        return filtered_df
-
-    def get_sorted_tasks(self):
-        orders = self.get_orders_with_mattress_requests()
-        df = self.get_tasks_as_df(orders)
-        if df.empty:
-            st.write('Активных нарядов нет')
+    def show_print_status():
+        """Показывает всплывающие сообщения о завершённых заданиях печати этого терминала."""
+        job_ids = st.session_state.get('print_jobs')
+        if not job_ids:
             return
+        spooler = get_print_spooler()
+        waiting = []
+        for job_id in job_ids:
+            job = spooler.get(job_id)
+            if job is None:
+                continue
+            if job.status == DONE:
+                st.toast(f"{job.title}: отправлено на печать", icon='✅')
+            elif job.status == FAILED:
+                st.toast(f"{job.title}: ошибка печати. {job.error}", icon='❗')
+            else:
+                waiting.append(job_id)
+        st.session_state['print_jobs'] = waiting
 
-        # Преобразуем поле delivery_type в категорию с определенным порядком
-        df['delivery_type'] = pd.Categorical(df['delivery_type'],
-                                             categories=site_conf.get('delivery_types'),
-                                             ordered=True)
-
-        df.sort_values(by=['high_priority', 'deadline', 'delivery_type'],
-                       ascending=[False, True, True],
-                       ignore_index=True,
-                       inplace=True)
-        if 'id' in df.columns:
-            df.set_index('id', inplace=True)
+    @staticmethod
+    def load_station_tasks(conditions: dict, columns, order_by=None):
+        """Наряды для рабочего места. Фильтр и сортировка выполняются в БД, читаются только
+        колонки, которые показывает страница, поэтому завершённые наряды сюда не попадают."""
+        df = read_tasks(engine, conditions, [column for column in columns if column in TASK_COLUMNS], order_by)
+        return Page.with_photo_urls(df)
 
+    @staticmethod
+    def with_photo_urls(df):
+        """Заменяет хэши фото на ссылки миниатюр, которые может показать таблица"""
+        if 'photo' in df.columns:
+            df['photo'] = df['photo'].map(lambda value: photo_url(value, base_url=photos_base_url))
         return df
 
 
@@ -210,13 +207,10 @@ class ManufacturePage(Page):
             self.employee_choose()
 
     @st.fragment(run_every=3)
-    def employees_on_shift(self, searching_position: str) -> list:
+    def employees_on_shift(self, page_name: str) -> list:
         """Возвращает список кортежей (имя сотрудника, ID) сотрудников,
-        которые на смене и соответствуют заданной роли."""
-        employees = self.session.query(Employee).filter(
-            Employee.is_on_shift == True,
-            Employee.position.ilike(f'%{searching_position}%')).all()
-        return [(employee.name, employee.id) for employee in employees]
+        которые на смене и имеют роль рабочего места страницы."""
+        return shift_employees(STATION_BY_NAME[page_name])
 
     def employee_choose(self):
         """Виджет для выбора активного сотрудника для рабочего места."""
@@ -249,18 +243,32 @@ class ManufacturePage(Page):
             st.session_state[f"{self.page_name}_employee_id"] = selected_employee[1]
 
     def update_tasks(self, edited_df, done_field: str):
-        for index, row in edited_df.iterrows():
-            if not row[done_field]:
-                continue
-
-            instance = self.session.get(MattressRequest, index)
-            new_history = self.pages_history_note() + getattr(instance, 'history')
-            setattr(instance, 'history', new_history)
-            setattr(instance, done_field, True)
+        """Отмечает выполненными все отмеченные строки одним UPDATE. Строки, которые уже
+        отметили на другом терминале, не трогаются, поэтому события не дублируются."""
+        done_ids = [int(index) for index in edited_df.index[edited_df[done_field] == True]]
+        if not done_ids:
+            return
 
+        tasks_table = MattressRequest.__table__
+        updated_ids = self.session.execute(
+            update(tasks_table)
+            .where(tasks_table.c.id.in_(done_ids),
+                   tasks_table.c[done_field].is_not(True))
+            .values({done_field: True,
+                     'version': tasks_table.c.version + 1})
+            .returning(tasks_table.c.id)).scalars().all()
+
+        if updated_ids:
+            self.record_done_events(updated_ids)
+            self.notify_tasks_updated(updated_ids)
         self.session.commit()
-
-    def pages_history_note(self):
-        employee = st.session_state.get(self.page_name)
-        return create_history_note(self.page_name, employee, self.done_button_text)
+        self.session.expire_all()
+
+    def record_done_events(self, task_ids):
+        """Пишет в журнал task_events, что выбранный на странице сотрудник завершил наряды."""
+        self.session.execute(task_events_insert(task_ids,
+                                                stage=self.page_name,
+                                                employee_id=st.session_state.get(f"{self.page_name}_employee_id"),
+                                                employee_name=st.session_state.get(self.page_name),
+                                                action=self.done_button_text))
 
@@ -0,0 +1,147 @@
+import logging
+from dataclasses import dataclass, field
+
+import pandas as pd
+from sqlalchemy import update, select, values, column, cast, case, Integer, Boolean
+
+from utils.models import MattressRequest
+from utils.tools import derived_fields, DERIVED_COLUMNS, DERIVED_SOURCES
+
+tasks_table = MattressRequest.__table__
+
+# Колонки матраса, которые бригадир может править в таблице
+EDITABLE_COLUMNS = ('high_priority', 'article', 'size', 'base_fabric', 'side_fabric', 'springs', 'attributes',
+                    'comment', 'components_is_done', 'fabric_is_done', 'gluing_is_done', 'sewing_is_done',
+                    'packing_is_done')
+
+
+@dataclass
+class EditResult:
+    applied: list = field(default_factory=list)  # Сохранены одним UPDATE
+    merged: list = field(default_factory=list)  # Строку успели поменять, но другие ячейки, правки совмещены
+    rejected: list = field(default_factory=list)  # Те же ячейки поменяли в другом месте, правки отклонены
+    clashes: dict = field(default_factory=dict)  # id отклонённого матраса -> колонки, которые поменяли в другом месте
+
+
+def to_db_value(value):
+    """Приводит значение из DataFrame к типу, который понимает драйвер БД."""
+    if value is None or (not isinstance(value, (list, tuple)) and pd.isna(value)):
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+
+def same_value(first, second) -> bool:
+    return to_db_value(first) == to_db_value(second)
+
+
+def with_derived_fields(row_changes: dict, current) -> dict:
+    """Если бригадир поменял размер или ткань, добавляет к правкам пересчитанные размеры,
+    типы тканей и длину боковины. current - значения строки до правки."""
+    if not any(column_name in row_changes for column_name in DERIVED_SOURCES):
+        return row_changes
+    sources = {column_name: row_changes[column_name] if column_name in row_changes else to_db_value(current[column_name])
+               for column_name in DERIVED_SOURCES}
+    return {**row_changes, **derived_fields(**sources)}
+
+
+def diff_frames(original: pd.DataFrame, edited: pd.DataFrame, columns=EDITABLE_COLUMNS) -> dict:
+    """Сравнивает отредактированную таблицу с той, что была показана.
+    Возвращает {id матраса: {колонка: новое значение}} только для изменённых ячеек."""
+    columns = [column_name for column_name in columns if column_name in original.columns and column_name in edited.columns]
+    index = edited.index.intersection(original.index)
+    before = original.loc[index, columns]
+    after = edited.loc[index, columns]
+
+    changed_cells = before.ne(after) & ~(before.isna() & after.isna())
+    changes = {}
+    for task_id, row in changed_cells[changed_cells.any(axis=1)].iterrows():
+        changes[int(task_id)] = {column_name: to_db_value(after.at[task_id, column_name])
+                                 for column_name in columns if row[column_name]}
+    return changes
+
+
+def edited_value(edits, column_name: str):
+    value = cast(edits.c[column_name], tasks_table.c[column_name].type)
+    if column_name in DERIVED_COLUMNS:
+        # Производные поля пишутся только в строках, где правили размер или ткань, и там
+        # записываются как есть, даже NULL. В остальных строках остаётся значение из БД
+        return case((cast(edits.c.derived, Boolean), value), else_=tasks_table.c[column_name])
+    return value
+
+
+def apply_changes(db_session, original: pd.DataFrame, changes: dict) -> set:
+    """Записывает правки одним UPDATE ... FROM (VALUES ...), только для строк, версия которых
+    не изменилась с момента показа. Для таких строк значения в БД совпадают с показанными,
+    поэтому неизменённые ячейки можно записать из исходной таблицы. Возвращает id обновлённых строк."""
+    changes = {task_id: with_derived_fields(row, original.loc[task_id]) for task_id, row in changes.items()}
+    changed_columns = sorted({column_name for row in changes.values() for column_name in row})
+    # Производных полей в показанной таблице нет, поэтому у строки есть флаг derived:
+    # пересчитаны ли они для неё (см. edited_value)
+    rows = [(task_id, int(original.at[task_id, 'version']), DERIVED_COLUMNS[0] in row,
+             *(row.get(column_name) if column_name in DERIVED_COLUMNS
+               else row.get(column_name, to_db_value(original.at[task_id, column_name]))
+               for column_name in changed_columns))
+            for task_id, row in changes.items()]
+
+    edits = values(column('id', Integer),
+                   column('version', Integer),
+                   column('derived', Boolean),
+                   *(column(column_name, tasks_table.c[column_name].type) for column_name in changed_columns),
+                   name='edits').data(rows)
+
+    statement = (update(tasks_table)
+                 .where(tasks_table.c.id == cast(edits.c.id, Integer),
+                        tasks_table.c.version == cast(edits.c.version, Integer))
+                 .values({**{column_name: edited_value(edits, column_name) for column_name in changed_columns},
+                          'version': tasks_table.c.version + 1})
+                 .returning(tasks_table.c.id))
+    return set(db_session.execute(statement).scalars())
+
+
+def merge_conflicts(db_session, original: pd.DataFrame, changes: dict, result: EditResult):
+    """Строки, версия которых сдвинулась, сверяются по ячейкам. Если в другом месте
+    поменяли не те ячейки, что бригадир, правки совмещаются. Иначе строка отклоняется."""
+    current_rows = {row.id: row for row in db_session.execute(
+        select(tasks_table).where(tasks_table.c.id.in_(list(changes))))}
+
+    for task_id, row_changes in changes.items():
+        current = current_rows.get(task_id)
+        if current is None:
+            result.rejected.append(task_id)
+            continue
+
+        current_values = current._mapping
+        clashes = [column_name for column_name, value in row_changes.items()
+                   if not same_value(current_values[column_name], original.at[task_id, column_name])
+                   and not same_value(current_values[column_name], value)]
+        if clashes:
+            logging.warning(f"Правки матраса {task_id} отклонены, ячейки изменены другим пользователем: {clashes}")
+            result.rejected.append(task_id)
+            result.clashes[task_id] = clashes
+            continue
+
+        updated = db_session.execute(update(tasks_table)
+                                     .where(tasks_table.c.id == task_id,
+                                            tasks_table.c.version == current.version)
+                                     .values(**with_derived_fields(row_changes, current_values),
+                                             version=current.version + 1))
+        (result.merged if updated.rowcount else result.rejected).append(task_id)
+
+
+def save_task_edits(db_session, original: pd.DataFrame, edited: pd.DataFrame,
+                    columns=EDITABLE_COLUMNS) -> EditResult:
+    """Сохраняет изменения из data_editor. original должен содержать колонку version
+    на момент показа таблицы. Коммит остаётся за вызывающим кодом."""
+    result = EditResult()
+    changes = diff_frames(original, edited, columns)
+    if not changes:
+        return result
+
+    applied = apply_changes(db_session, original, changes)
+    result.applied = [task_id for task_id in changes if task_id in applied]
+
+    conflicts = {task_id: row for task_id, row in changes.items() if task_id not in applied}
+    if conflicts:
+        merge_conflicts(db_session, original, conflicts, result)
+
+    return result
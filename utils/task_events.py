@@ -0,0 +1,28 @@
+from sqlalchemy import select, insert
+
+from utils.models import TaskEvent, MattressRequest
+from utils.tools import create_history_note
+
+
+def task_events_insert(task_ids, stage: str, employee_id, employee_name: str, action: str):
+    """Один INSERT с событиями для нескольких нарядов, например когда заготовщик
+    отмечает много строк за раз."""
+    return insert(TaskEvent).values([{'task_id': task_id,
+                                      'stage': stage,
+                                      'employee_id': employee_id,
+                                      'employee_name': employee_name,
+                                      'action': action} for task_id in task_ids])
+
+
+def render_task_history(db_session, task_id: int) -> str:
+    """Текстовая история наряда для показа на экране, от новых событий к старым.
+    Собирается только по запросу. В конце добавляется старая история из mattress_requests.history."""
+    events = db_session.execute(select(TaskEvent)
+                                .where(TaskEvent.task_id == task_id)
+                                .order_by(TaskEvent.timestamp.desc(), TaskEvent.id.desc())).scalars()
+    history = ''.join(create_history_note(event.stage, event.employee_name, event.action, event.timestamp)
+                      for event in events)
+
+    legacy_history = db_session.execute(select(MattressRequest.history)
+                                        .where(MattressRequest.id == task_id)).scalar_one_or_none()
+    return history + (legacy_history or '')
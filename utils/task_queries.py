@@ -0,0 +1,241 @@
+from dataclasses import dataclass
+from datetime import date
+
+import pandas as pd
+from sqlalchemy import select, insert, case, func, literal, or_, and_, tuple_
+
+from utils.models import MattressRequest, Order, EmployeeTask
+from utils.tools import config
+
+delivery_types = config.get('site').get('delivery_types')
+
+# Колонки таблицы нарядов, которые страницы могут запросить, и их выражения в SQL
+TASK_COLUMNS = {
+    'id': MattressRequest.id,
+    'order_id': MattressRequest.order_id,
+    'high_priority': MattressRequest.high_priority,
+    'article': MattressRequest.article,
+    'size': MattressRequest.size,
+    'base_fabric': MattressRequest.base_fabric,
+    'side_fabric': MattressRequest.side_fabric,
+    'springs': MattressRequest.springs,
+    'photo': MattressRequest.photo,
+    'comment': MattressRequest.comment,
+    'attributes': MattressRequest.attributes,
+    'history': MattressRequest.history,
+    'components_is_done': MattressRequest.components_is_done,
+    'fabric_is_done': MattressRequest.fabric_is_done,
+    'gluing_is_done': MattressRequest.gluing_is_done,
+    'sewing_is_done': MattressRequest.sewing_is_done,
+    'packing_is_done': MattressRequest.packing_is_done,
+    'created': MattressRequest.created,
+    'length': MattressRequest.length,
+    'width': MattressRequest.width,
+    'height': MattressRequest.height,
+    'base_fabric_type': MattressRequest.base_fabric_type,
+    'side_fabric_type': MattressRequest.side_fabric_type,
+    'side_length': MattressRequest.side_length,
+    'deadline': Order.deadline,
+    'organization': Order.organization,
+    'contact': Order.contact,
+    'delivery_type': Order.delivery_type,
+    'address': Order.address,
+    'region': Order.region,
+    'order_created': Order.created,
+    'version': MattressRequest.version,
+}
+
+# Очереди рабочих мест. Частичные индексы в models.py построены по этим же условиям,
+# при изменении очереди индекс нужно поменять вместе с ней (см. utils/plan_check.py)
+STATION_QUEUES = {
+    'components': {'components_is_done': False},
+    'cutting': {'fabric_is_done': False},
+    'gluing': {'components_is_done': True,
+               'gluing_is_done': False},
+    'sewing': {'components_is_done': True,
+               'fabric_is_done': True,
+               'gluing_is_done': True,
+               'sewing_is_done': False},
+    'packing': {'components_is_done': True,
+                'fabric_is_done': True,
+                'gluing_is_done': True,
+                'sewing_is_done': True,
+                'packing_is_done': False},
+}
+
+
+# Этапы производства по порядку. Наряд завершён, когда отмечены все
+STAGE_COLUMNS = ('components_is_done', 'fabric_is_done', 'gluing_is_done', 'sewing_is_done', 'packing_is_done')
+
+
+def delivery_rank():
+    return case({delivery_type: rank for rank, delivery_type in enumerate(delivery_types)},
+                value=Order.delivery_type,
+                else_=len(delivery_types))
+
+
+def without_comment():
+    return case((func.coalesce(MattressRequest.comment, '') == '', 1), else_=0)
+
+
+def task_priority_order() -> list:
+    """Порядок выдачи задач: приоритет, срок заказа, тип доставки из app_config.toml,
+    затем матрасы с комментарием. Последним идёт id, чтобы порядок был однозначным."""
+    return [func.coalesce(MattressRequest.high_priority, False).desc(),
+            Order.deadline.asc().nulls_last(),
+            delivery_rank(),
+            without_comment(),
+            MattressRequest.id]
+
+
+def task_sort_keys() -> list:
+    """Тот же порядок, что task_priority_order, но все ключи по возрастанию и без NULL.
+    Так следующую страницу можно выбрать сравнением кортежей (ключи) > (ключи последней строки)."""
+    return [case((func.coalesce(MattressRequest.high_priority, False), 0), else_=1),
+            func.coalesce(Order.deadline, literal(date.max)),
+            delivery_rank(),
+            without_comment(),
+            MattressRequest.id]
+
+
+def tasks_query(conditions: dict, columns, order_by=None):
+    """Запрос нарядов для страницы: только нужные колонки, фильтр и сортировка выполняются в БД.
+
+    :param conditions: Словарь {колонка: значение}, все условия объединяются через "и"
+    :param columns: Колонки из TASK_COLUMNS, которые показывает страница. id добавляется всегда
+    :param order_by: Сортировка. По умолчанию - приоритет выдачи задач"""
+    selected = [TASK_COLUMNS[column].label(column) for column in dict.fromkeys(['id', *columns])]
+    return (select(*selected)
+            .select_from(MattressRequest)
+            .outerjoin(Order, MattressRequest.order_id == Order.id)
+            .where(*(TASK_COLUMNS[column] == value for column, value in conditions.items()))
+            .order_by(*(order_by if order_by is not None else task_priority_order())))
+
+
+def read_tasks(engine, conditions: dict, columns, order_by=None) -> pd.DataFrame:
+    """Читает результат tasks_query сразу в DataFrame с индексом по id матраса."""
+    with engine.connect() as connection:
+        return pd.read_sql(tasks_query(conditions, columns, order_by), connection, index_col='id')
+
+
+# Отбор нарядов на экране бригадира: название -> условие. None - без условия
+TASK_STATUSES = {
+    'active': or_(*(TASK_COLUMNS[column].is_(False) for column in STAGE_COLUMNS)),
+    'done': and_(*(TASK_COLUMNS[column].is_(True) for column in STAGE_COLUMNS)),
+    'all': None,
+    **{endpoint: and_(*(TASK_COLUMNS[column] == value for column, value in conditions.items()))
+       for endpoint, conditions in STATION_QUEUES.items()},
+}
+
+
+def contains(expression, text: str):
+    """ILIKE по подстроке. Символы % и _ в тексте ищутся как есть."""
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return expression.ilike(f'%{escaped}%', escape='\\')
+
+
+@dataclass(frozen=True)
+class TaskFilter:
+    """Фильтры таблицы нарядов бригадира. Даты относятся к сроку заказа, пустые поля не фильтруют."""
+    status: str = 'active'
+    date_from: date | None = None
+    date_to: date | None = None
+    article: str = ''
+    organization: str = ''
+    search: str = ''
+
+    def conditions(self) -> list:
+        conditions = []
+        if TASK_STATUSES[self.status] is not None:
+            conditions.append(TASK_STATUSES[self.status])
+        if self.date_from:
+            conditions.append(Order.deadline >= self.date_from)
+        if self.date_to:
+            conditions.append(Order.deadline <= self.date_to)
+        if self.article.strip():
+            conditions.append(MattressRequest.article == self.article.strip())
+        if self.organization.strip():
+            conditions.append(contains(Order.organization, self.organization.strip()))
+        if self.search.strip():
+            text = self.search.strip()
+            conditions.append(or_(*(contains(TASK_COLUMNS[column], text)
+                                    for column in ('article', 'size', 'base_fabric', 'side_fabric', 'springs',
+                                                   'comment', 'attributes', 'organization', 'contact', 'address'))))
+        return conditions
+
+
+def tasks_page_query(task_filter: TaskFilter, columns, after: tuple | None, limit: int):
+    """Страница нарядов в порядке task_sort_keys, начиная после строки с ключами after.
+    Ключи сортировки выбираются последними колонками sort_key_N."""
+    keys = task_sort_keys()
+    selected = [TASK_COLUMNS[column].label(column) for column in dict.fromkeys(['id', *columns])]
+    statement = (select(*selected, *(key.label(f'sort_key_{number}') for number, key in enumerate(keys)))
+                 .select_from(MattressRequest)
+                 .outerjoin(Order, MattressRequest.order_id == Order.id)
+                 .where(*task_filter.conditions()))
+    if after is not None:
+        statement = statement.where(tuple_(*keys) > tuple_(*(literal(value, key.type)
+                                                             for value, key in zip(after, keys))))
+    return statement.order_by(*keys).limit(limit)
+
+
+def tasks_count_query(task_filter: TaskFilter):
+    return (select(func.count())
+            .select_from(MattressRequest)
+            .outerjoin(Order, MattressRequest.order_id == Order.id)
+            .where(*task_filter.conditions()))
+
+
+def read_tasks_page(engine, task_filter: TaskFilter, columns, after: tuple | None = None,
+                    limit: int = 100) -> tuple:
+    """Одна страница нарядов и общее число подходящих под фильтр.
+    :return: (DataFrame с индексом по id, ключи последней строки для следующей страницы
+              или None, если страница последняя, всего нарядов)"""
+    keys_count = len(task_sort_keys())
+    with engine.connect() as connection:
+        # Строка сверх лимита показывает, есть ли следующая страница
+        result = connection.execute(tasks_page_query(task_filter, columns, after, limit + 1))
+        names = list(result.keys())
+        rows = result.all()
+        total = connection.execute(tasks_count_query(task_filter)).scalar_one()
+
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    next_after = tuple(rows[-1][-keys_count:]) if has_next else None
+    frame = pd.DataFrame([tuple(row[:-keys_count]) for row in rows], columns=names[:-keys_count])
+    return frame.set_index('id'), next_after, total
+
+
+def station_queue_conditions(endpoint: str) -> list:
+    """Условия, при которых матрас попадает в очередь рабочего места."""
+    if endpoint not in STATION_QUEUES:
+        raise ValueError(f"Неизвестное рабочее место: {endpoint}")
+    return [TASK_COLUMNS[column] == value for column, value in STATION_QUEUES[endpoint].items()]
+
+
+def reserved_task_query(employee_id: int, endpoint: str):
+    """Бронь сотрудника на рабочем месте."""
+    return select(EmployeeTask).where(EmployeeTask.employee_id == employee_id,
+                                      EmployeeTask.endpoint == endpoint)
+
+
+def claim_task_query(employee_id: int, endpoint: str):
+    """Один запрос, который выбирает самую приоритетную незабронированную задачу и бронирует её.
+    Строка матраса блокируется с SKIP LOCKED, поэтому два сотрудника, отсканировавшие код
+    одновременно, получат разные матрасы, а не будут ждать друг друга. Возвращает task_id брони."""
+    already_reserved = (select(EmployeeTask.id)
+                        .where(EmployeeTask.task_id == MattressRequest.id,
+                               EmployeeTask.endpoint == endpoint)
+                        .exists())
+    candidate = (select(MattressRequest.id)
+                 .outerjoin(Order, MattressRequest.order_id == Order.id)
+                 .where(*station_queue_conditions(endpoint), ~already_reserved)
+                 .order_by(*task_priority_order())
+                 .limit(1)
+                 .with_for_update(skip_locked=True, of=MattressRequest)
+                 .cte('candidate'))
+
+    return (insert(EmployeeTask)
+            .from_select(['employee_id', 'task_id', 'endpoint', 'timestamp'],
+                         select(literal(employee_id), candidate.c.id, literal(endpoint), func.now()))
+            .returning(EmployeeTask.task_id))
@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import select, func
+from sqlalchemy.exc import SQLAlchemyError
+
+from utils.models import TaskChange
+
+
+class TaskSnapshot:
+    """Общий для всех сессий Streamlit снимок таблицы нарядов.
+
+    Каждый терминал раньше сам перечитывал все заказы раз в 1-3 секунды. Теперь
+    процесс хранит одну копию каждого представления (ключ -> DataFrame) и
+    перестраивает его, только когда сдвинулась версия журнала task_changes, который
+    пополняют триггеры БД. Сама версия читается не чаще check_interval секунд,
+    сколько бы терминалов ни было открыто.
+
+    Отдаваемые DataFrame общие для всех сессий: их нельзя менять на месте,
+    только через copy() или фильтрацию."""
+
+    def __init__(self, session_factory, check_interval: float = 0.5):
+        self.session_factory = session_factory
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._frames = {}  # ключ -> (версия, DataFrame)
+        self._version = None
+        self._checked = 0.0
+        self._warned = False
+
+    def read_version(self):
+        try:
+            with self.session_factory() as db:
+                return tuple(db.execute(select(func.max(TaskChange.id), func.count()).select_from(TaskChange)).one())
+        except SQLAlchemyError:
+            if not self._warned:
+                logging.warning("Журнал task_changes недоступен, снимок нарядов будет перечитываться каждый раз",
+                                exc_info=True)
+                self._warned = True
+            return None
+
+    @property
+    def version(self):
+        """Текущая версия таблицы нарядов. В БД обращаемся не чаще check_interval."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked >= self.check_interval:
+                self._version = self.read_version()
+                self._checked = now
+            return self._version
+
+    def get(self, key, builder):
+        """Возвращает представление по ключу. builder() вызывается, только если версия
+        таблицы поменялась с прошлой сборки. Версия читается до сборки: если данные
+        изменились во время неё, следующий вызов увидит новую версию и пересоберёт снимок."""
+        version = self.version
+        cached = self._frames.get(key)
+        if cached and version is not None and cached[0] == version:
+            return cached[1]
+
+        with self._lock:
+            cached = self._frames.get(key)
+            if cached and version is not None and cached[0] == version:
+                return cached[1]
+            frame = builder()
+            self._frames[key] = (version, frame)
+            return frame
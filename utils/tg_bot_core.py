@@ -8,7 +8,7 @@ from telegram import (
 )
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 
-from utils.tools import config
+from utils.tools import config, tg_api_url
 
 
 class Tg:
@@ -18,7 +18,13 @@ class Tg:
         self.group_chat_id = group_chat_id  # ID группы, куда будут отправляться сообщения
         self.bot_token = config.get('telegram').get('token')
 
-        self.app = ApplicationBuilder().token(self.bot_token).build()  # Создаём приложение (асинхронное)
+        # Создаём приложение (асинхронное). Адрес API берётся из конфига, чтобы бота можно было
+        # запустить против локальной замены Telegram
+        self.app = (ApplicationBuilder()
+                    .token(self.bot_token)
+                    .base_url(f"{tg_api_url}/bot")
+                    .base_file_url(f"{tg_api_url}/file/bot")
+                    .build())
         self.app.add_handler(CommandHandler("start", self.cmd_start))  # Регистрируем обработчик команды /start
 
     async def cmd_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1,18 +1,14 @@
 import os
 import re
 import sys
+from functools import lru_cache
 from pathlib import Path
 
-import niquests
 import tomli
 import socket
 import locale
 
-import win32print  # из pywin32
-import win32api  # из pywin32
-
 import pandas as pd
-import aspose.pdf as ap  # из aspose-pdf
 
 import logging
 from logging import basicConfig, StreamHandler, FileHandler, INFO
@@ -52,6 +48,7 @@ site_port = site_conf.get('site_port')
 
 tg_conf = config.get('telegram')
 tg_token = tg_conf.get('token')
+tg_api_url = tg_conf.get('api_url', 'https://api.telegram.org').rstrip('/')
 
 hardware = site_conf.get('hardware')
 tasks_cash = Path(hardware.get('tasks_cash_filepath'))
@@ -75,6 +72,10 @@ def create_backup():
     pass
 
 
+SIZE_PATTERN = re.compile(r'(\d+)(?:\D+(\d+))?(?:\D+(\d+))?')
+SIZE_COLUMNS = ['length', 'width', 'height']
+
+
 def get_size_int(size: str):
     """
     Принимает строку с размером матраса типа "180х200".
@@ -85,10 +86,7 @@ def get_size_int(size: str):
     'width': 200,
     'height': 0}
     """
-
-    pattern = r'(\d+)(?:\D+(\d+))?(?:\D+(\d+))?'
-
-    match = re.search(pattern, size)
+    match = SIZE_PATTERN.search(size)
     if not match:
         return {'length': 0, 'width': 0, 'height': 0}
 
@@ -98,6 +96,41 @@ def get_size_int(size: str):
     return {'length': length, 'width': width, 'height': height}
 
 
+def get_sizes(sizes: pd.Series) -> pd.DataFrame:
+    """То же, что get_size_int, для всей колонки размеров сразу.
+    :return: Датафрейм с колонками length, width, height и индексом sizes"""
+    frame = sizes.astype(str).str.extract(SIZE_PATTERN).fillna(0).astype(int)
+    frame.columns = SIZE_COLUMNS
+    return frame
+
+
+fabric_corrections = config.get('fabric_corrections', {'Текстиль': 0})
+
+
+def compile_fabric_pattern(corrections: dict) -> re.Pattern:
+    """Одно регулярное выражение на все ключи коррекций.
+    Каждый ключ ищется опережающей проверкой по всей строке, поэтому при нескольких совпадениях
+    побеждает ключ, стоящий в app_config.toml раньше, как и при переборе ключей по очереди."""
+    alternatives = '|'.join(f'(?=.*?(?P<fabric{number}>{key}))' for number, key in enumerate(corrections))
+    return re.compile(f'^(?:{alternatives})', re.IGNORECASE | re.DOTALL)
+
+
+fabric_keys = list(fabric_corrections)
+fabric_pattern = compile_fabric_pattern(fabric_corrections)
+
+
+@lru_cache(maxsize=4096)
+def fabric_correction_key(fabric: str):
+    """Ключ из [fabric_corrections], найденный в названии ткани, или None.
+    Названий тканей в каталоге немного, поэтому результат запоминается для каждого."""
+    if not fabric_keys or not isinstance(fabric, str):
+        return None
+    match = fabric_pattern.match(fabric)
+    if not match:
+        return None
+    return fabric_keys[int(match.lastgroup.removeprefix('fabric'))]
+
+
 def side_eval(size: str, fabric: str = None) -> str:
     """
     Вычисляет сколько нужно отрезать боковины, используя размер из функции get_size_int.
@@ -108,13 +141,9 @@ def side_eval(size: str, fabric: str = None) -> str:
     size = get_size_int(size)
     try:
         result = (size.get('length', 0) * 2 + size.get('width', 0) * 2)
-        corrections = config.get('fabric_corrections', {'Текстиль': 0})
 
         # Ищет в названии ткани совпадения со словарём коррекций тканей и отсчитывает нужное кол-во сантиметров
-        correction_value = next(
-            (value for key, value in corrections.items() if re.search(key, fabric, re.IGNORECASE)), 0)
-
-        result += correction_value
+        result += fabric_corrections.get(fabric_correction_key(fabric), 0)
 
         return str(result)
 
@@ -123,14 +152,53 @@ def side_eval(size: str, fabric: str = None) -> str:
         return "Ошибка в вычислении размера"
 
 
+@lru_cache(maxsize=4096)
 def fabric_type(fabric: str = None):
     """Даёт тип ткани, основываясь на названии"""
     if fabric is None:
         return "Новый тип ткани"
 
-    fabrics = config.get('fabric_corrections', {'Текстиль': 0})
-    # Если ни одна ткань не найдётся, next вернет второе значение
-    return next((key for key in fabrics.keys() if re.search(key, fabric, re.IGNORECASE)), fabric)
+    # Если ни одна ткань не найдётся, возвращается само название
+    return fabric_correction_key(fabric) or fabric
+
+
+def fabric_types(fabrics: pd.Series) -> pd.Series:
+    """fabric_type для колонки: вычисляется по одному разу на каждую различную ткань"""
+    types = {fabric: fabric_type(fabric) for fabric in fabrics.unique()}
+    return fabrics.map(types.get)
+
+
+def fabric_corrections_of(fabrics: pd.Series) -> pd.Series:
+    """Коррекция длины боковины из [fabric_corrections] для каждой ткани колонки"""
+    corrections = {fabric: fabric_corrections.get(fabric_correction_key(fabric), 0) for fabric in fabrics.unique()}
+    return fabrics.map(corrections.get).fillna(0).astype(int)
+
+
+# Поля матраса, которые вычисляются из размера и тканей и хранятся рядом с ними в mattress_requests
+DERIVED_COLUMNS = ('length', 'width', 'height', 'base_fabric_type', 'side_fabric_type', 'side_length')
+# Поля, при изменении которых производные нужно пересчитать
+DERIVED_SOURCES = ('size', 'base_fabric', 'side_fabric')
+
+
+def derived_fields(size: str, base_fabric: str, side_fabric: str) -> dict:
+    """Размеры, типы тканей и длина боковины одного матраса, как их считают get_size_int,
+    fabric_type и side_eval."""
+    dimensions = get_size_int(size or '')
+    return {**dimensions,
+            'base_fabric_type': fabric_type(base_fabric),
+            'side_fabric_type': fabric_type(side_fabric),
+            'side_length': (dimensions['length'] * 2 + dimensions['width'] * 2
+                            + fabric_corrections.get(fabric_correction_key(side_fabric), 0))}
+
+
+def derived_frame(tasks: pd.DataFrame) -> pd.DataFrame:
+    """derived_fields для всей таблицы с колонками size, base_fabric и side_fabric.
+    Размеры разбираются одним проходом, ткани - по одному разу на каждое различное название."""
+    frame = get_sizes(tasks['size'])
+    frame['base_fabric_type'] = fabric_types(tasks['base_fabric'])
+    frame['side_fabric_type'] = fabric_types(tasks['side_fabric'])
+    frame['side_length'] = frame['length'] * 2 + frame['width'] * 2 + fabric_corrections_of(tasks['side_fabric'])
+    return frame[list(DERIVED_COLUMNS)]
 
 
 def get_date_str(dt_obj) -> str:
@@ -177,63 +245,31 @@ def barcode_link(employee_id: str) -> str:
 
 def create_history_note(page_name: str,
                         employee_name: str,
-                        action: str):
-    """Формирует строку истории для записи в БД. Содержит текущее время, название страницы (процесса),
+                        action: str,
+                        timestamp: datetime = None):
+    """Формирует строку истории наряда. Содержит время (по умолчанию текущее), название страницы (процесса),
     имя работника и действие (завершение или бронирование).
     Пример: (21.09.2024 19:12:08) Сборка [ Иван ] -> Отметка;"""
-
-    return f'({datetime.now().strftime("%d.%m.%Y %H:%M:%S")}) {page_name} [ {employee_name} ] -> {action}; \n'
+    timestamp = timestamp or datetime.now()
+    return f'({timestamp.strftime("%d.%m.%Y %H:%M:%S")}) {page_name} [ {employee_name} ] -> {action}; \n'
 
 
 async def send_telegram_message(text: str, chat_id: str):
     """Отправляет текстовое сообщение ботом в telegram в указанный chat_id.
     Id группы по заявкам прописывается в app_config"""
 
-    url = f"https://api.telegram.org/bot{tg_token}/sendMessage"
+    url = f"{tg_api_url}/bot{tg_token}/sendMessage"
 
     data = {"chat_id": chat_id, "text": text}
     logging.info(f"Отправка сообщения в Telegram. URL: {url}, данные: {data}")
 
-    response = niquests.post(url, data=data)
+    # Импорт здесь, так как http_client сам берёт настройки из этого модуля
+    from utils.http_client import async_http_session
+    response = await async_http_session().post(url, data=data, timeout=10)
     logging.debug(f"Получен ответ от Telegram API: {response.json()}")
     return response.json()
 
 
-def get_printers():
-    """Функция для получения списка принтеров в Windows."""
-    return [printer[2] for printer in win32print.EnumPrinters(win32print.PRINTER_ENUM_LOCAL)]
-
-
-def print_file(file_path, printer_name: str = win32print.GetDefaultPrinter()):
-    """Функция для печати файла в системе Windows."""
-    file_name, file_extension = os.path.splitext(file_path)
-    logging.debug(f"Available printers: {get_printers()}\n Selected printer: {printer_name}")
-
-    if file_extension.lower() == '.pdf':
-        # Устанавливаем дефолтный принтер
-        win32print.SetDefaultPrinterW(printer_name)
-        win32print.SetDefaultPrinter(printer_name)
-
-        document = ap.Document(file_path)
-        strategy = ap.RgbToDeviceGrayConversionStrategy()
-
-        # Конвертим все страницы в чёрно-белые, а то на ЧБ принтерах будут квадраты Малевича вместо картинок
-        for page in document.pages:
-            strategy.convert(page)
-
-        viewer = ap.facades.PdfViewer()  # Создать объект PDFViewer
-        viewer.bind_pdf(file_path)  # Открыть входной PDF-файл
-        viewer.print_document()  # Распечатать PDF-документ
-        viewer.close()  # Закрыть PDF-файл
-
-    else:
-        # Устанавливаем дефолтный принтер
-        win32print.SetDefaultPrinterW(printer_name)
-        win32print.SetDefaultPrinter(printer_name)
-
-        win32api.ShellExecute(0, "print", file_path, f'/d:"{printer_name}"', ".", 0)  # Да
-
-
 def start_scheduler(hour: int = 0, minute: int = 0) -> None:
     scheduler = BackgroundScheduler()
     trigger = CronTrigger(hour=hour, minute=minute)  # Запуск каждый день. По умолчанию в полночь